@@ -196,7 +196,10 @@ class AttASR(ASREncoderDecoderBase):
                                            eos=self.eos,
                                            **kwargs)
 
-    def beam_search_batch(self, batch: List[th.Tensor], **kwargs) -> List[Dict]:
+    def beam_search_batch(self,
+                          batch: List[th.Tensor],
+                          ctc_weight: float = 0,
+                          **kwargs) -> List[Dict]:
         """
         Batch version of beam search
         Args
@@ -204,10 +207,15 @@ class AttASR(ASREncoderDecoderBase):
         """
         with th.no_grad():
             enc_out, enc_len = self._batch_decoding_prep(batch)
+            # N x T x V
+            ctc_prob = self.ctc(
+                enc_out) if self.ctc and ctc_weight > 0 else None
             return att_api.beam_search_batch(self.decoder,
                                              self.att_net,
                                              enc_out,
                                              enc_len,
+                                             ctc_prob=ctc_prob,
+                                             ctc_weight=ctc_weight,
                                              sos=self.sos,
                                              eos=self.eos,
                                              **kwargs)
@@ -348,17 +356,25 @@ class XfmrASR(ASREncoderDecoderBase):
                                            eos=self.eos,
                                            **kwargs)
 
-    def beam_search_batch(self, batch: List[th.Tensor], **kwargs) -> List[Dict]:
+    def beam_search_batch(self,
+                          batch: List[th.Tensor],
+                          ctc_weight: float = 0,
+                          **kwargs) -> List[Dict]:
         """
         Beam search for Transformer (batch version)
         """
         with th.no_grad():
             enc_out, enc_len = self._batch_decoding_prep(batch,
                                                          batch_first=False)
+            # T x N x V => N x T x V
+            ctc_prob = self.ctc(enc_out).transpose(
+                0, 1) if self.ctc and ctc_weight > 0 else None
             # beam search
             return xfmr_api.beam_search_batch(self.decoder,
                                               enc_out,
                                               enc_len,
+                                              ctc_prob=ctc_prob,
+                                              ctc_weight=ctc_weight,
                                               sos=self.sos,
                                               eos=self.eos,
                                               **kwargs)
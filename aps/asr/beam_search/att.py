@@ -212,7 +212,11 @@ def beam_search(decoder: nn.Module,
         am_prob = tf.log_softmax(dec_out / temperature, dim=-1)
         if lm and beam_param.lm_weight > 0:
             # beam x V
-            lm_prob, lm_state = lm_score_impl(lm, point, pre_tok, lm_state)
+            lm_prob, lm_state = lm_score_impl(lm,
+                                              point,
+                                              pre_tok,
+                                              lm_state,
+                                              am_prob=am_prob)
         else:
             lm_prob = 0
         # one beam search step
@@ -226,6 +230,7 @@ def beam_search_batch(decoder: nn.Module,
                       enc_out: th.Tensor,
                       enc_len: th.Tensor,
                       lm: Optional[LmType] = None,
+                      ctc_prob: Optional[th.Tensor] = None,
                       lm_weight: float = 0,
                       beam_size: int = 8,
                       nbest: int = 1,
@@ -251,6 +256,7 @@ def beam_search_batch(decoder: nn.Module,
         att_net (nn.Module): attention network
         enc_out (Tensor): N x T x F, encoder output
         enc_len (Tensor): N, length of the encoder output
+        ctc_prob (Tensor): N x T x V, CTC output (used if ctc_weight > 0)
     """
     if sos < 0 or eos < 0:
         raise RuntimeError(f"Invalid SOS/EOS ID: {sos:d}/{eos:d}")
@@ -300,7 +306,10 @@ def beam_search_batch(decoder: nn.Module,
                                  cov_threshold=cov_threshold,
                                  eos_threshold=eos_threshold,
                                  ctc_beam_size=int(beam_size * 1.5))
-    beam_tracker = BatchBeamTracker(N, beam_param)
+    beam_tracker = BatchBeamTracker(N,
+                                    beam_param,
+                                    ctc_prob=ctc_prob,
+                                    ctc_len=enc_len[::beam_size])
 
     # clear states
     att_net.clear()
@@ -325,7 +334,11 @@ def beam_search_batch(decoder: nn.Module,
 
         if lm and beam_param.lm_weight > 0:
             # beam x V
-            lm_prob, lm_state = lm_score_impl(lm, point, pre_tok, lm_state)
+            lm_prob, lm_state = lm_score_impl(lm,
+                                              point,
+                                              pre_tok,
+                                              lm_state,
+                                              am_prob=am_prob)
         else:
             lm_prob = 0
 
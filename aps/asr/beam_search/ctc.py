@@ -3,30 +3,194 @@
 # Copyright 2020 Jian Wu
 # License: Apache 2.0 (http://www.apache.org/licenses/LICENSE-2.0)
 
+import numpy as np
 import torch as th
 import torch.nn as nn
 
-from collections import defaultdict
 from aps.const import MIN_F32
 from aps.utils import get_logger
-from typing import Dict, List, Union
+from typing import Dict, List, Union, Tuple, Optional
 
 logger = get_logger(__name__)
 
 
-class PrefixScore(object):
+class PrefixTree(object):
     """
-    CTC prefix score used for beam search
+    Prefix tree used in CTC prefix beam search, each prefix is represented
+    by an integer id (node of the tree) instead of the token sequence
     """
 
-    def __init__(self, log_pb: th.Tensor, log_pn: th.Tensor) -> None:
-        # score end with blank
-        self.log_pb = log_pb
-        # score end with non-blank
-        self.log_pn = log_pn
+    def __init__(self, root: int = -1) -> None:
+        # parent id & last token of each prefix
+        self.parent = [-1]
+        self.token = [root]
+        # (parent id, token) => id, so one token sequence has one id even if
+        # it's pruned and re-created later
+        self.child = {}
 
-    def score(self) -> th.Tensor:
-        return th.logaddexp(self.log_pb, self.log_pn)
+    def lookup(self, parent: np.ndarray, token: np.ndarray) -> np.ndarray:
+        """
+        Return ids of the prefixes (parent + token), -1 if not in the tree
+        """
+        ids = [
+            self.child.get(key, -1)
+            for key in zip(parent.tolist(), token.tolist())
+        ]
+        return np.array(ids, dtype=np.int64)
+
+    def add(self, parent: np.ndarray, token: np.ndarray) -> np.ndarray:
+        """
+        Add new prefixes (parent + token) and return their ids
+        """
+        ids = []
+        for key in zip(parent.tolist(), token.tolist()):
+            if key not in self.child:
+                self.child[key] = len(self.parent)
+                self.parent.append(key[0])
+                self.token.append(key[1])
+            ids.append(self.child[key])
+        return np.array(ids, dtype=np.int64)
+
+    def trace(self, prefix: int) -> List[int]:
+        """
+        Return the token sequence of the prefix (with root)
+        """
+        seq = []
+        while prefix >= 0:
+            seq.append(self.token[prefix])
+            prefix = self.parent[prefix]
+        return seq[::-1]
+
+
+class CtcPrefixBeam(object):
+    """
+    States of the vectorized CTC prefix beam search. It's updated frame by
+    frame thus also works for streaming decoding. The beam is pruned lazily
+    (at the beginning of the next step), so we keep all the candidates of the
+    last frame
+
+    Args:
+        blank: blank symbol
+        beam_size: beam size
+        sos: root symbol of the prefixes
+    """
+
+    def __init__(self, blank: int, beam_size: int = 8, sos: int = -1) -> None:
+        self.blank = blank
+        self.beam_size = beam_size
+        self.neg_inf = np.float32(MIN_F32)
+        self.tree = PrefixTree(sos)
+        # beam: prefix id, parent id & last token of the prefix, log_pb (end
+        # with blank), log_pn (end with non-blank)
+        self.beam_id = np.zeros(1, dtype=np.int64)
+        self.beam_parent = np.full(1, -1, dtype=np.int64)
+        self.beam_token = np.full(1, sos, dtype=np.int64)
+        self.beam_pb = np.zeros(1, dtype=np.float32)
+        self.beam_pn = np.full(1, self.neg_inf, dtype=np.float32)
+
+    def _add_prefix(self) -> None:
+        """
+        Add the new prefixes (with negative ids) to the tree
+        """
+        new = self.beam_id < 0
+        self.beam_id[new] = self.tree.add(self.beam_parent[new],
+                                          self.beam_token[new])
+
+    def _prune(self) -> None:
+        """
+        Keep top-#beam prefixes (already sorted)
+        """
+        self.beam_id = self.beam_id[:self.beam_size]
+        self.beam_parent = self.beam_parent[:self.beam_size]
+        self.beam_token = self.beam_token[:self.beam_size]
+        self.beam_pb = self.beam_pb[:self.beam_size]
+        self.beam_pn = self.beam_pn[:self.beam_size]
+        self._add_prefix()
+
+    def step(self,
+             topk_score: np.ndarray,
+             topk_token: np.ndarray,
+             blank_score: float,
+             blank_frame: bool = False) -> None:
+        """
+        Update the beam with one frame
+        Args:
+            topk_score, topk_token: K
+            blank_score: log probability of the blank symbol
+            blank_frame: skip the frame (only blank is considered) or not
+        """
+        self._prune()
+        neg_inf = self.neg_inf
+        beam_id, beam_parent = self.beam_id, self.beam_parent
+        beam_token = self.beam_token
+        beam_pb, beam_pn = self.beam_pb, self.beam_pn
+        score = np.logaddexp(beam_pb, beam_pn)
+        # skip blank frames: only update log_pb
+        if blank_frame:
+            self.beam_pb = score + blank_score
+            self.beam_pn = np.full_like(beam_pn, neg_inf)
+            return
+        blank = topk_token == self.blank
+        tok, logp = topk_token[~blank], topk_score[~blank]
+        # B x K
+        repeat = tok[None, :] == beam_token[:, None]
+        # 1) the prefix itself: extended with blank/repeat symbol
+        if blank.any():
+            self_pb = score + topk_score[blank][0]
+        else:
+            self_pb = np.full_like(score, neg_inf)
+        self_pn = np.where(repeat, beam_pn[:, None] + logp[None, :],
+                           neg_inf).max(-1)
+        self_keep = repeat.any(-1) | blank.any()
+        # 2) prefix + non-blank symbol
+        ext_pn = np.where(repeat, beam_pb[:, None], score[:, None])
+        ext_pn = (ext_pn + logp[None, :]).ravel()
+        ext_parent = np.repeat(beam_id, tok.size)
+        ext_token = np.tile(tok, beam_id.size)
+        # the extended prefix may already exist in the tree (and in the beam),
+        # otherwise we assign a temporary negative id to it
+        ext_id = self.tree.lookup(ext_parent, ext_token)
+        new = ext_id < 0
+        ext_id[new] = -1 - np.arange(new.sum())
+        # merge the same prefix
+        cand_id = np.concatenate([beam_id[self_keep], ext_id])
+        cand_pb = np.concatenate([
+            self_pb[self_keep],
+            np.full(ext_pn.size, neg_inf, dtype=np.float32)
+        ])
+        cand_pn = np.concatenate([self_pn[self_keep], ext_pn])
+        beam_id, first, index = np.unique(cand_id,
+                                          return_index=True,
+                                          return_inverse=True)
+        beam_parent = np.concatenate([beam_parent[self_keep],
+                                      ext_parent])[first]
+        beam_token = np.concatenate([beam_token[self_keep], ext_token])[first]
+        beam_pb = np.full(beam_id.size, neg_inf, dtype=np.float32)
+        beam_pn = np.full(beam_id.size, neg_inf, dtype=np.float32)
+        np.logaddexp.at(beam_pb, index, cand_pb)
+        np.logaddexp.at(beam_pn, index, cand_pn)
+        # sort the prefixes (pruned in next step)
+        order = np.argsort(-np.logaddexp(beam_pb, beam_pn), kind="stable")
+        self.beam_id, self.beam_parent = beam_id[order], beam_parent[order]
+        self.beam_token = beam_token[order]
+        self.beam_pb, self.beam_pn = beam_pb[order], beam_pn[order]
+
+    def prefixes(self, nbest: int = -1) -> Tuple[List, np.ndarray]:
+        """
+        Return the (sorted) prefixes and their scores
+        Args:
+            nbest: number of the prefixes to return (-1 means all)
+        Return:
+            prefixes (list[list[int]]), scores (ndarray)
+        """
+        self._add_prefix()
+        num_prefixes = self.beam_id.size if nbest < 0 else nbest
+        prefixes = [
+            self.tree.trace(prefix)
+            for prefix in self.beam_id[:num_prefixes].tolist()
+        ]
+        scores = np.logaddexp(self.beam_pb, self.beam_pn)[:num_prefixes]
+        return prefixes, scores
 
 
 class CtcApi(object):
@@ -38,6 +202,49 @@ class CtcApi(object):
         assert blank >= 0
         self.blank = blank
 
+    def _prefix_beam_search(self,
+                            topk_score: np.ndarray,
+                            topk_token: np.ndarray,
+                            blank_score: np.ndarray,
+                            blank_frame: np.ndarray,
+                            beam_size: int = 8,
+                            sos: int = -1) -> Tuple[List, np.ndarray]:
+        """
+        Vectorized CTC prefix beam search, each step we update all the
+        beam x topk candidates at once
+        Args:
+            topk_score, topk_token: T x K
+            blank_score: T, log probability of the blank symbol
+            blank_frame: T, skip the frame (only blank is considered) or not
+        Return:
+            prefixes (list[list[int]]), scores (ndarray) of the last step
+        """
+        search = CtcPrefixBeam(self.blank, beam_size=beam_size, sos=sos)
+        for t in range(topk_score.shape[0]):
+            search.step(topk_score[t],
+                        topk_token[t],
+                        blank_score[t],
+                        blank_frame=blank_frame[t])
+        return search.prefixes()
+
+    def nbest_hypos(self,
+                    prefixes: List[List[int]],
+                    scores: np.ndarray,
+                    nbest: int = 1,
+                    eos: int = -1,
+                    len_norm: bool = True) -> List[Dict]:
+        """
+        Return the nbest hypothesis (dict) given the prefixes (with sos)
+        """
+        beam = []
+        for prefix, score in zip(prefixes, scores.tolist()):
+            # exclude sos
+            num_toks = len(prefix) - 1
+            if len_norm:
+                score = score / num_toks if num_toks else MIN_F32
+            beam.append({"score": score, "trans": prefix + [eos]})
+        return sorted(beam, key=lambda n: n["score"], reverse=True)[:nbest]
+
     def beam_search(self,
                     ctc_prob: th.Tensor,
                     beam_size: int = 8,
@@ -45,73 +252,73 @@ class CtcApi(object):
                     sos: int = -1,
                     eos: int = -1,
                     len_norm: bool = True,
+                    blank_thres: float = 0,
                     **kwargs) -> List[Dict]:
         """
         Do CTC prefix beam search
         Args:
             ctc_prob: T x V
+            blank_thres: skip the frames (only blank is considered) that
+                         blank probability >= blank_thres (0 means disable)
         """
-        ctc_prob = th.log_softmax(ctc_prob, -1)
-        # T x B
-        topk_score, topk_token = th.topk(ctc_prob, beam_size, -1)
         T, V = ctc_prob.shape
         logger.info(f"--- shape of the encoder output (CTC): {T} x {V}")
-        neg_inf = th.tensor(MIN_F32).to(ctc_prob.device)
-        zero = th.tensor(0.0).to(ctc_prob.device)
-        # (prefix, log_pb, log_pn)
-        # NOTE: actually do not need sos/eos here, just place it in the sentence
-        prev_beam = [(str(sos), PrefixScore(zero, neg_inf))]
-        for t in range(T):
-            next_beam = defaultdict(lambda: PrefixScore(neg_inf, neg_inf))
-            for n in range(beam_size):
-                symb = topk_token[t, n].item()
-                logp = topk_score[t, n].item()
-
-                for prefix, prev in prev_beam[:beam_size]:
-                    # update log_pb only
-                    if symb == self.blank:
-                        other = next_beam[prefix]
-                        log_pb_update = th.logaddexp(prev.score() + logp,
-                                                     other.log_pb)
-                        next_beam[prefix] = PrefixScore(log_pb_update,
-                                                        other.log_pn)
-                    else:
-                        # str
-                        symb = str(symb)
-                        prefix_symb = prefix + f",{symb}"
-                        # str list
-                        prefix_toks = prefix.split(",")
-                        other = next_beam[prefix_symb]
-                        # repeat
-                        if prefix_toks[-1] == symb:
-                            log_pn_update = th.logaddexp(
-                                prev.log_pb + logp, other.log_pn)
-                        else:
-                            log_pn_update = th.logaddexp(
-                                prev.score() + logp, other.log_pn)
-                        # update log_pn only
-                        next_beam[prefix_symb] = PrefixScore(
-                            other.log_pb, log_pn_update)
-                        # repeat case
-                        if prefix_toks[-1] == symb:
-                            other = next_beam[prefix]
-                            log_pn_update = th.logaddexp(
-                                prev.log_pn + logp, other.log_pn)
-                            next_beam[prefix] = PrefixScore(
-                                other.log_pb, log_pn_update)
-            # keep top-#beam
-            prev_beam = sorted(next_beam.items(),
-                               key=lambda n: n[1].score(),
-                               reverse=True)
-        beam = [{
-            "score": s.score() / (len(p.split(",")) - 1 if len_norm else 1),
-            "trans": list(map(int, p.split(","))) + [eos]
-        } for p, s in prev_beam]
-        # return nbest
-        ctc_nbest = sorted(beam, key=lambda n: n["score"], reverse=True)[:nbest]
-        logger.info(f"--- beam search gets {len(ctc_nbest)}-best from " +
-                    f"{len(prev_beam)} hypothesis (len_norm = {len_norm}) ...")
-        return ctc_nbest
+        return self.beam_search_batch(ctc_prob[None, ...],
+                                      beam_size=beam_size,
+                                      nbest=nbest,
+                                      sos=sos,
+                                      eos=eos,
+                                      len_norm=len_norm,
+                                      blank_thres=blank_thres)[0]
+
+    def beam_search_batch(self,
+                          ctc_prob: th.Tensor,
+                          ctc_len: Optional[th.Tensor] = None,
+                          beam_size: int = 8,
+                          nbest: int = 1,
+                          sos: int = -1,
+                          eos: int = -1,
+                          len_norm: bool = True,
+                          blank_thres: float = 0,
+                          **kwargs) -> List[List[Dict]]:
+        """
+        Do CTC prefix beam search for a batch of utterances
+        Args:
+            ctc_prob: N x T x V
+            ctc_len: N or None
+        """
+        ctc_prob = th.log_softmax(ctc_prob, -1)
+        # N x T x K
+        topk_score, topk_token = th.topk(ctc_prob, beam_size, -1)
+        topk_score = topk_score.cpu().numpy()
+        topk_token = topk_token.cpu().numpy()
+        blank_score = ctc_prob[..., self.blank].cpu().numpy()
+        if blank_thres > 0:
+            blank_frame = blank_score >= np.log(blank_thres)
+        else:
+            blank_frame = np.zeros_like(blank_score, dtype=bool)
+        N, T, _ = ctc_prob.shape
+        ctc_len = [T] * N if ctc_len is None else ctc_len.tolist()
+        batch_nbest = []
+        for n in range(N):
+            T = ctc_len[n]
+            # NOTE: actually do not need sos/eos here, just place it in the sentence
+            prefixes, scores = self._prefix_beam_search(topk_score[n, :T],
+                                                        topk_token[n, :T],
+                                                        blank_score[n, :T],
+                                                        blank_frame[n, :T],
+                                                        beam_size=beam_size,
+                                                        sos=sos)
+            ctc_nbest = self.nbest_hypos(prefixes,
+                                         scores,
+                                         nbest=nbest,
+                                         eos=eos,
+                                         len_norm=len_norm)
+            logger.info(
+                f"--- beam search gets {len(ctc_nbest)}-best from " +
+                f"{len(prefixes)} hypothesis (len_norm = {len_norm}) ...")
+            batch_nbest.append(ctc_nbest)
+        return batch_nbest
 
     def viterbi_align(self, ctc_enc: th.Tensor, dec_seq: th.Tensor) -> Dict:
         """
@@ -120,122 +327,193 @@ class CtcApi(object):
             ctc_enc (th.Tensor): T x V
             dec_seq (th.Tensor): U (remove eos & sos)
         Return:
-            align (th.Tensor): T
+            align (Dict): score, align_seq & align_str
         """
-        ctc_prob = th.log_softmax(ctc_enc, -1)
-        T, V = ctc_prob.shape
+        T, V = ctc_enc.shape
         logger.info(f"--- shape of the encoder output (CTC): {T} x {V}")
-        U = dec_seq.shape[-1]
-        if U * 2 + 1 > T:
-            raise ValueError(f"Invalid target length: {U}")
+        return self.viterbi_align_batch(ctc_enc[None, ...], dec_seq[None,
+                                                                    ...])[0]
 
-        dec_seq = dec_seq.tolist()
-        # T x U*2+1
-        score = MIN_F32 * th.ones(T, U * 2 + 1, device=ctc_prob.device)
-        point = -1 * th.ones(
-            T, U * 2 + 1, dtype=th.int32, device=ctc_prob.device)
-
-        # time step: 0
-        score[0, 0] = ctc_prob[0, self.blank]
-        score[0, 1] = ctc_prob[0, dec_seq[0]]
+    def viterbi_align_batch(self,
+                            ctc_enc: th.Tensor,
+                            dec_seq: th.Tensor,
+                            enc_len: Optional[th.Tensor] = None,
+                            dec_len: Optional[th.Tensor] = None) -> List[Dict]:
+        """
+        Get alignment on CTC prob using viterbi algothrim (batch version).
+        At each time step, all the lattice states are updated at once using
+        the shifted scores of the previous step (stay, s - 1 and s - 2)
+        Args:
+            ctc_enc (th.Tensor): N x T x V
+            dec_seq (th.Tensor): N x U (remove eos & sos, padded)
+            enc_len (th.Tensor): N, length of the encoder output
+            dec_len (th.Tensor): N, length of the decoding sequence
+        Return:
+            align (List[Dict]): score, align_seq & align_str
+        """
+        N, T, _ = ctc_enc.shape
+        device = ctc_enc.device
+        U = dec_seq.shape[-1]
+        enc_len = [T] * N if enc_len is None else enc_len.tolist()
+        dec_len = [U] * N if dec_len is None else dec_len.tolist()
+        for n in range(N):
+            if dec_len[n] * 2 + 1 > enc_len[n]:
+                raise ValueError(f"Invalid target length: {dec_len[n]}")
+        # padding ids (e.g., IGNORE_ID) are replaced with blank
+        dec_seq = dec_seq.to(device)
+        dec_seq = dec_seq.masked_fill(dec_seq < 0, self.blank)
+        # N x T x V
+        ctc_prob = th.log_softmax(ctc_enc.float(), -1)
+        S = U * 2 + 1
+        # N x S: extended label sequence, <b> x <b> y <b> ...
+        ext_seq = th.full((N, S), self.blank, dtype=th.int64, device=device)
+        ext_seq[:, 1::2] = dec_seq
+        # N x T x S
+        emit = th.gather(ctc_prob, -1, ext_seq[:, None].expand(-1, T, -1))
+        # non-blank node can skip the previous blank if the token differs
+        skip = th.zeros(N, S, dtype=th.bool, device=device)
+        skip[:, 3::2] = dec_seq[:, 1:] != dec_seq[:, :-1]
+        # frames used for each utterance
+        time_mask = th.arange(T, device=device)[None, :] < th.tensor(
+            enc_len, device=device)[:, None]
 
-        # time step: 1 -> T - 1
+        neg_inf = -float("inf")
+        score = th.full((N, S), neg_inf, device=device)
+        score[:, :2] = emit[:, 0, :2]
+        # N x T x S, offset of the best predecessor: 0/1/2
+        point = th.zeros(N, T, S, dtype=th.int64, device=device)
         for t in range(1, T):
-            max_u_step = min(t * 2, U * 2 + 1)
-            for u in range(max_u_step):
-                # blank node
-                if u % 2 == 0:
-                    ctc_score = ctc_prob[t, self.blank]
-                    # [u, u - 1]
-                    tok_index = range(u, u - 2, -1)
-                # non-blank node
-                else:
-                    u_nb = (u - 1) // 2
-                    ctc_score = ctc_prob[t, u_nb]
-                    if u_nb != 0 and dec_seq[u_nb] == dec_seq[u_nb - 1]:
-                        # [u, u - 1]
-                        tok_index = range(u, u - 2, -1)
-                    else:
-                        # [u, u - 1, u - 2]
-                        tok_index = range(u, u - 3, -1)
-                prev_score = th.stack([score[t - 1, u] for u in tok_index])
-                best_score, best_index = th.max(prev_score, 0)
-                score[t, u] = best_score + ctc_score
-                # point to time t - 1
-                point[t, u] = u - best_index.item()
-
-        align_score = None
-        align = []
+            # N x 3 x S: stay, from s - 1 and from s - 2
+            prev_score = th.full((N, 3, S), neg_inf, device=device)
+            prev_score[:, 0] = score
+            prev_score[:, 1, 1:] = score[:, :-1]
+            prev_score[:, 2,
+                       2:] = score[:, :-2].masked_fill(~skip[:, 2:], neg_inf)
+            best_score, point[:, t] = th.max(prev_score, 1)
+            # keep the score unchanged for the padding frames
+            score = th.where(time_mask[:, t, None], best_score + emit[:, t],
+                             score)
+
+        score = score.cpu().numpy()
+        point = point.cpu().numpy()
+        dec_seq = dec_seq.cpu().numpy()
+        enc_len = np.array(enc_len)
+        # end at the last blank or the last token
+        last_b = np.array(dec_len) * 2
+        last_s = np.where(
+            score[np.arange(N), last_b] >= score[np.arange(N), last_b - 1],
+            last_b, last_b - 1)
+        # N x T
+        align_state = np.zeros((N, T), dtype=np.int64)
+        state = last_s
         for t in range(T - 1, -1, -1):
-            if t == T - 1:
-                last_score = th.stack([score[-1, u] for u in [-1, -2]])
-                best_score, best_index = th.max(last_score, 0)
-                align.append(U * 2 - best_index.item())
-                align_score = best_score.item()
-            else:
-                align.append(point[t + 1, align[-1]].item())
-        align = align[::-1]
-        for t in range(T):
-            u = self.blank if align[t] % 2 == 0 else dec_seq[(align[t] - 1) //
-                                                             2]
-            # <b> x x x <b> => <b> <b> <b> x <b>
-            if u != self.blank and t and u == align[t - 1]:
-                align[t - 1] = self.blank
-            align[t] = u
-        # remove blank
-        align_check = [a for a in align if a != self.blank]
-        # check alignment
-        assert sum([a != b for a, b in zip(align_check, dec_seq)]) == 0
+            active = t < enc_len
+            align_state[active, t] = state[active]
+            if t:
+                state = np.where(active, state - point[np.arange(N), t, state],
+                                 state)
 
         def ali_map(v):
             return "*" if v == self.blank else str(v)
 
-        return {
-            "score": align_score,
-            "align_seq": align,
-            "align_str": " ".join(map(ali_map, align))
-        }
+        align_list = []
+        for n in range(N):
+            state = align_state[n, :enc_len[n]]
+            align = np.where(state % 2 == 0, self.blank,
+                             dec_seq[n][(state - 1) // 2])
+            # <b> x x x <b> => <b> <b> <b> x <b>
+            repeat = (align[:-1] == align[1:]) & (align[:-1] != self.blank)
+            align[:-1][repeat] = self.blank
+            align = align.tolist()
+            # remove blank
+            align_check = [a for a in align if a != self.blank]
+            # check alignment
+            assert align_check == dec_seq[n][:dec_len[n]].tolist()
+            align_list.append({
+                "score": score[n, last_s[n]].item(),
+                "align_seq": align,
+                "align_str": " ".join(map(ali_map, align))
+            })
+        return align_list
+
+
+def cum_logaddexp(init: th.Tensor, inc: th.Tensor,
+                  prob: th.Tensor) -> th.Tensor:
+    """
+    Solve the recursion x[t] = logaddexp(x[t - 1], inc[t - 1]) + prob[t - 1]
+    (x[0] = init) in one shot: x[t] = P[t] + logcumsumexp(a)[t], where P is
+    the cumulative sum of the prob, a[0] = init, a[t] = inc[t - 1] - P[t - 1]
+    Args:
+        init (Tensor): N
+        inc (Tensor): T x N
+        prob (Tensor): T x N
+    Return:
+        x (Tensor): T+1 x N
+    """
+    # T+1 x N
+    cum_prob = th.cat([th.zeros_like(init[None]), th.cumsum(prob, 0)])
+    cum_inc = th.cat([init[None], inc - cum_prob[:-1]])
+    return cum_prob + th.logcumsumexp(cum_inc, 0)
 
 
 class CtcScorer(nn.Module):
     """
     To compute the CTC score given decoding sequence and
-    helps the beam search in attention based AM
+    helps the beam search in attention based AM. The recursion
+    over the frames is vectorized using cumulative logsumexp
 
     Args:
-        ctc_prob: T x V
+        ctc_prob: T x V or N x T x V (batch version)
+        eos: EOS symbol
+        batch_size: number of the hypothesis (N*beam for batch version)
+        beam_size: CTC beam size
+        ctc_len: N or None, length of the ctc_prob (batch version)
     """
 
     def __init__(self,
                  ctc_prob: th.Tensor,
                  eos: int = 1,
                  batch_size: int = 8,
-                 beam_size: int = 12) -> None:
+                 beam_size: int = 12,
+                 ctc_len: Optional[th.Tensor] = None) -> None:
         super(CtcScorer, self).__init__()
-        # apply softmax
-        self.ctc_prob = th.log_softmax(ctc_prob, dim=-1)
-        T, V = self.ctc_prob.shape
+        if ctc_prob.dim() == 2:
+            ctc_prob = ctc_prob[None, ...]
+        # apply softmax (computed in float64 as cumulative sum is used)
+        ctc_prob = th.log_softmax(ctc_prob.double(), dim=-1)
+        N, T, V = ctc_prob.shape
         logger.info(f"--- shape of the encoder output (CTC): {T} x {V}")
         self.T = T
         self.device = ctc_prob.device
         self.eos = eos
         # blank is last symbol: see aps.conf:load_am_conf(...)
-        self.blank = -1
+        self.blank = V - 1
+        if ctc_len is not None:
+            # padding frames only emit blank (with probability 1)
+            pad_mask = th.arange(
+                T, device=self.device)[None, :] >= ctc_len[:, None]
+            ctc_prob = ctc_prob.masked_fill(pad_mask[..., None], MIN_F32)
+            ctc_prob[..., self.blank] = ctc_prob[..., self.blank].masked_fill(
+                pad_mask, 0)
+        # N x V x T
+        self.ctc_prob = ctc_prob.transpose(1, 2).contiguous()
+        self.num_utts = N
         self.offset = th.arange(batch_size, device=self.device)
         self.beam_size = beam_size
         # eq (51) MIN_F32 ~ log(0), T x N
         self.gamma_n_g = th.full((self.T, batch_size),
                                  MIN_F32,
+                                 dtype=th.float64,
                                  device=self.device)
-        self.gamma_b_g = th.zeros(self.T, batch_size, device=self.device)
-        # eq (52)
-        self.gamma_b_g[0] = self.ctc_prob[0, self.blank]
-        for t in range(1, self.T):
-            self.gamma_b_g[t] = (self.gamma_b_g[t - 1] +
-                                 self.ctc_prob[t, self.blank])
+        # eq (52), T x N
+        self.gamma_b_g = th.repeat_interleave(
+            th.cumsum(self.ctc_prob[:, self.blank], -1).T, batch_size // N, -1)
         # ctc score in previous steps
-        self.ctc_score = th.zeros(1, batch_size, device=self.device)
-        self.neg_inf = th.tensor(MIN_F32).to(self.device)
+        self.ctc_score = th.zeros(1,
+                                  batch_size,
+                                  dtype=th.float64,
+                                  device=self.device)
+        self.neg_inf = th.tensor(MIN_F32, dtype=th.float64).to(self.device)
 
     def update_var(self, point: Union[th.Tensor, int]) -> None:
         """
@@ -262,44 +540,53 @@ class CtcScorer(nn.Module):
         """
         # CTC beam
         ctc_beam = c.shape[0] // g.shape[0]
-        # N*ctc_beam x U
-        repeat_g = th.repeat_interleave(g, ctc_beam, 0)
-
         # 1 x N*ctc_beam
         self.ctc_score = th.repeat_interleave(self.ctc_score, ctc_beam, -1)
         # T x N*ctc_beam
-        self.gamma_n_g = th.repeat_interleave(self.gamma_n_g, ctc_beam, -1)
-        self.gamma_b_g = th.repeat_interleave(self.gamma_b_g, ctc_beam, -1)
+        gamma_n_g = th.repeat_interleave(self.gamma_n_g, ctc_beam, -1)
+        gamma_b_g = th.repeat_interleave(self.gamma_b_g, ctc_beam, -1)
+        # utterance index of each hypothesis
+        utt = th.div(th.arange(c.shape[0], device=self.device),
+                     c.shape[0] // self.num_utts,
+                     rounding_mode="trunc")
         # T x N*ctc_beam
-        gamma_n_h = th.zeros_like(self.gamma_n_g)
-        gamma_b_h = th.zeros_like(self.gamma_n_g)
+        prob_c = self.ctc_prob[utt, c].T
+        prob_b = self.ctc_prob[utt, self.blank].T
         # zero based
         glen = g.shape[-1] - 1
         start = max(glen, 1)
-        gamma_n_h[start - 1] = self.ctc_prob[0, c] if glen == 0 else MIN_F32
-        gamma_b_h[start - 1] = MIN_F32
-
-        # N*ctc_beam
-        score = gamma_n_h[start - 1]
-        repeat = repeat_g[:, -1] != c
-        for t in range(start, self.T):
+        init = prob_c[0] if glen == 0 else th.full_like(prob_c[0], MIN_F32)
+        gamma_n_h = th.full_like(gamma_n_g, MIN_F32)
+        gamma_b_h = th.full_like(gamma_n_g, MIN_F32)
+        if start <= self.T:
+            repeat = th.repeat_interleave(g[:, -1], ctc_beam, 0) != c
+            # T-start x N*ctc_beam
+            phi = th.logaddexp(
+                gamma_b_g[start - 1:-1],
+                th.where(repeat, gamma_n_g[start - 1:-1], self.neg_inf))
+            # gamma_n_h[t] = logaddexp(gamma_n_h[t - 1], phi[t - 1]) + prob_c[t]
+            gamma_n_h[start - 1:] = cum_logaddexp(init, phi, prob_c[start:])
+            # gamma_b_h[t] = logaddexp(gamma_b_h[t - 1], gamma_n_h[t - 1]) + prob_b[t]
+            gamma_b_h[start - 1:] = cum_logaddexp(gamma_b_h[start - 1],
+                                                  gamma_n_h[start - 1:-1],
+                                                  prob_b[start:])
             # N*ctc_beam
-            term = th.where(repeat, self.gamma_n_g[t - 1], self.neg_inf)
-            phi = th.logaddexp(self.gamma_b_g[t - 1], term)
-            gamma_n_h[t] = th.logaddexp(gamma_n_h[t - 1],
-                                        phi) + self.ctc_prob[t, c]
-            gamma_b_h[t] = th.logaddexp(
-                gamma_b_h[t - 1], gamma_n_h[t - 1]) + self.ctc_prob[t,
-                                                                    self.blank]
-            score = th.logaddexp(score, phi + self.ctc_prob[t, c])
+            score = th.logsumexp(th.cat([init[None], phi + prob_c[start:]]), 0)
+        else:
+            score = init
+        # blank is not a valid label
+        is_blank = c == self.blank
+        score = th.where(is_blank, self.neg_inf, score)
+        gamma_n_h = th.where(is_blank, self.neg_inf, gamma_n_h)
+        gamma_b_h = th.where(is_blank, self.neg_inf, gamma_b_h)
         # fix eos
         is_eos = c == self.eos
-        gamma_nb_g = th.logaddexp(self.gamma_b_g[-1], self.gamma_n_g[-1])
-        score[is_eos] = gamma_nb_g[is_eos]
+        gamma_nb_g = th.logaddexp(gamma_b_g[-1], gamma_n_g[-1])
+        score = th.clamp_min(th.where(is_eos, gamma_nb_g, score), MIN_F32)
         delta_score = (score - self.ctc_score).view(-1, ctc_beam)
 
-        self.gamma_n_g = gamma_n_h
-        self.gamma_b_g = gamma_b_h
+        self.gamma_n_g = th.clamp_min(gamma_n_h, MIN_F32)
+        self.gamma_b_g = th.clamp_min(gamma_b_h, MIN_F32)
         self.ctc_score = score[None, ...]
         # N x ctc_beam
-        return delta_score
+        return delta_score.float()
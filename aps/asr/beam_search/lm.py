@@ -34,16 +34,21 @@ def adjust_hidden(back_point: Optional[th.Tensor],
     return state
 
 
-def ngram_score(lm: NgramLM, back_point: Optional[th.Tensor],
-                prev_token: th.Tensor, state):
+def ngram_score(lm: NgramLM,
+                back_point: Optional[th.Tensor],
+                prev_token: th.Tensor,
+                state,
+                am_prob: Optional[th.Tensor] = None):
     """
     Get ngram LM score
     Args:
         back_point (Tensor): N
-        state (list[list(State)]): ngram LM states
+        state (list[NgramContext]): ngram LM states
+        am_prob (Tensor): N x V, acoustic scores, if lm.topk > 0, only the
+                          topk acoustic candidates are scored by LM
     Return:
         score (Tensor): beam x V
-        state (list[list(State)]): new LM state
+        state (list[NgramContext]): new LM state
     """
     if state is None:
         prev_state = None
@@ -54,7 +59,10 @@ def ngram_score(lm: NgramLM, back_point: Optional[th.Tensor],
         else:
             ptr = back_point.tolist()
             prev_state = [state[p] for p in ptr]
-    return lm(prev_token, prev_state)
+    candidate = None
+    if am_prob is not None and 0 < lm.topk < am_prob.shape[-1]:
+        candidate = th.topk(am_prob, lm.topk, dim=-1)[1]
+    return lm(prev_token, prev_state, candidate=candidate)
 
 
 def rnnlm_score(rnnlm: nn.Module, back_point: Optional[th.Tensor],
@@ -80,14 +88,17 @@ def rnnlm_score(rnnlm: nn.Module, back_point: Optional[th.Tensor],
     return (score, state)
 
 
-def lm_score_impl(lm: LmType, back_point: Optional[th.Tensor],
-                  prev_token: th.Tensor, state):
+def lm_score_impl(lm: LmType,
+                  back_point: Optional[th.Tensor],
+                  prev_token: th.Tensor,
+                  state,
+                  am_prob: Optional[th.Tensor] = None):
     """
     Get ngram/rnnlm score (wraps {rnnlm|ngram}_score functions)
     """
     if isinstance(lm, nn.Module):
         return rnnlm_score(lm, back_point, prev_token, state)
     elif isinstance(lm, NgramLM):
-        return ngram_score(lm, back_point, prev_token, state)
+        return ngram_score(lm, back_point, prev_token, state, am_prob=am_prob)
     else:
         raise TypeError(f"Unsupported LM type: {type(lm)}")
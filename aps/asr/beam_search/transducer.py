@@ -6,14 +6,16 @@
 Beam search for transducer based AM
 """
 
+import numpy as np
 import torch as th
 import torch.nn as nn
 import torch.nn.functional as tf
 
-from copy import deepcopy
-from typing import List, Dict, Tuple, Optional
+from typing import List, Dict, Tuple, Optional, Callable
 from aps.utils import get_logger
 from aps.const import MIN_F32
+from aps.asr.lm.ngram import NgramLM
+from aps.asr.transducer.decoder import TorchTransformerDecoder
 from aps.asr.beam_search.lm import lm_score_impl, LmType
 
 logger = get_logger(__name__)
@@ -32,13 +34,87 @@ class Node(object):
         return self.stats[key]
 
     def clone(self):
-        lm_state = self.stats["lm_state"]
-        # trick to avoid ngram state copy
-        self.stats["lm_state"] = None
-        copy = deepcopy(self)
-        copy.stats["lm_state"] = lm_state
-        self.stats["lm_state"] = lm_state
-        return copy
+        # the stats are never modified in place, so shallow copy is enough
+        return Node(self.score.clone(), dict(self.stats))
+
+
+def split_state(state, num: int) -> List:
+    """
+    Split the batched hidden states (nested tensors, batch dim = 1)
+    """
+    if state is None:
+        return [None] * num
+    if isinstance(state, th.Tensor):
+        return [state[:, i:i + 1] for i in range(num)]
+    return [type(state)(s) for s in zip(*[split_state(s, num) for s in state])]
+
+
+def concat_state(states: List):
+    """
+    Concatenate the hidden states (reverse operation of split_state)
+    """
+    if states[0] is None:
+        return None
+    if isinstance(states[0], th.Tensor):
+        return th.cat(states, 1)
+    return type(states[0])(concat_state(list(s)) for s in zip(*states))
+
+
+class PrefixCache(object):
+    """
+    Cache the outputs of the prediction network (or LM) keyed by the token
+    prefix. The entries are shared among the hypotheses (and utterances) and
+    the new prefixes are computed in batch from the states of their parents
+    Args:
+        step: function (token, state) => (output, state), batch first
+        split: function to split the batched states
+        concat: function to concatenate the states
+        group_by_len: only batch the prefixes with same length (e.g., for
+                      transformer decoder whose state grows with the prefix)
+    """
+
+    def __init__(self,
+                 step: Callable,
+                 split: Callable = split_state,
+                 concat: Callable = concat_state,
+                 group_by_len: bool = False) -> None:
+        self.step = step
+        self.split = split
+        self.concat = concat
+        self.group_by_len = group_by_len
+        # prefix => (output, state), () is the empty prefix
+        self.cache = {(): (None, None)}
+
+    def __call__(self, prefixes: List[Tuple[int]]) -> th.Tensor:
+        """
+        Args:
+            prefixes (list[tuple]): token prefixes, length N
+        Return:
+            output (Tensor): N x ...
+        """
+        groups = {}
+        for prefix in prefixes:
+            if prefix in self.cache:
+                continue
+            key = len(prefix) if self.group_by_len else 0
+            groups.setdefault(key, {})[prefix] = None
+        for group in groups.values():
+            group = list(group)
+            state = self.concat([self.cache[p[:-1]][1] for p in group])
+            token = th.tensor([p[-1] for p in group], dtype=th.int64)
+            output, state = self.step(token, state)
+            for prefix, out, hid in zip(group, output,
+                                        self.split(state, len(group))):
+                self.cache[prefix] = (out, hid)
+        return th.stack([self.cache[p][0] for p in prefixes])
+
+    def prune(self, prefixes: List[Tuple[int]]) -> None:
+        """
+        Only keep the entries of the given prefixes (and their parents)
+        """
+        keep = set(prefixes) | set(p[:-1] for p in prefixes)
+        self.cache = {p: self.cache[p] for p in keep if p in self.cache}
+        self.cache[()] = (None, None)
 
 
 def is_valid_decoder(decoder: nn.Module, blank: int):
@@ -85,6 +161,47 @@ class TransducerBeamSearch(nn.Module):
         dec_out, dec_hid = self.decoder.pred(prev_tok, hidden=pred_hid)
         return dec_out, dec_hid
 
+    def _pred_cache(self) -> PrefixCache:
+        """
+        Return the prefix cache of the prediction network
+        """
+
+        def pred_step(prev_tok, pred_hid):
+            # N => N x 1
+            prev_tok = prev_tok[:, None].to(self.device)
+            return self.decoder.pred(prev_tok, hidden=pred_hid)
+
+        # hidden states of transformer decoder are T x N x D
+        return PrefixCache(pred_step,
+                           group_by_len=isinstance(self.decoder,
+                                                   TorchTransformerDecoder))
+
+    def _lm_cache(self) -> PrefixCache:
+        """
+        Return the prefix cache of the LM
+        """
+
+        def lm_step(prev_tok, state):
+            return lm_score_impl(self.lm, None, prev_tok.to(self.device), state)
+
+        if isinstance(self.lm, NgramLM):
+            # ngram LM states: list[NgramContext]
+            return PrefixCache(lm_step,
+                               split=lambda state, num: list(state),
+                               concat=lambda states: None
+                               if states[0] is None else list(states))
+        return PrefixCache(lm_step)
+
+    def init_cache(
+            self,
+            lm_weight: float = 0) -> Tuple[PrefixCache, Optional[PrefixCache]]:
+        """
+        Return the prefix caches of the prediction network and LM (None if
+        LM is not used) for frame_step(...)
+        """
+        with_lm = self.lm is not None and lm_weight > 0
+        return self._pred_cache(), self._lm_cache() if with_lm else None
+
     def _lm_score(self, prev_tok, state):
         """
         Predict LM score
@@ -103,8 +220,8 @@ class TransducerBeamSearch(nn.Module):
         # log prob
         return tf.log_softmax(joint, dim=-1)
 
-    def _merge_by_prefix(self, list_a: List[Node],
-                         enc_frame: th.Tensor) -> List[Node]:
+    def _merge_by_prefix(self, list_a: List[Node], enc_frame: th.Tensor,
+                         pred_cache: PrefixCache) -> List[Node]:
         """
         Line 5-6 in Algorithm 1
         """
@@ -121,7 +238,7 @@ class TransducerBeamSearch(nn.Module):
                 is_prefix = li < lj and si[:li] == sj[:li]
                 if not is_prefix:
                     continue
-                dec_out, dec_hid = self._pred_step(si[-1], ni["dec_hid"])
+                dec_out = pred_cache([tuple(si)])
                 log_prob = self._joint_log_prob(enc_frame, dec_out)
                 score = ni.score + log_prob[sj[li]]
                 for k in range(li, lj - 1):
@@ -181,23 +298,19 @@ class TransducerBeamSearch(nn.Module):
             return self.greedy_search(enc_proj)
 
         with_lm = self.lm is not None and lm_weight > 0
-        init = {
-            "tok_seq": [self.blank],
-            "dec_hid": None,
-            "dec_out": [],
-            "lm_state": None
-        }
+        init = {"tok_seq": [self.blank], "dec_out": [], "lm_state": None}
+        # outputs of the prediction network
+        pred_cache = self._pred_cache()
         # list_a, list_b: A, B in Algorithm 1
         list_b = [Node(th.tensor(0.0).to(self.device), init)]
         for t in range(T):
             # 1 x D:
             enc_frame = enc_proj[:, t]
-            list_a = self._merge_by_prefix(list_b, enc_frame)
+            list_a = self._merge_by_prefix(list_b, enc_frame, pred_cache)
             list_b = []
 
             # cache
             cache_logp = [th.stack([a.score for a in list_a])]
-            cache_dec_hid = []
             cache_dec_out = []
             cache_node = []
             cache_lm = []
@@ -209,8 +322,7 @@ class TransducerBeamSearch(nn.Module):
 
             while True:
                 # predict network: compute Pr(y^*)
-                dec_out, dec_hid = self._pred_step(best_node["tok_seq"][-1],
-                                                   best_node["dec_hid"])
+                dec_out = pred_cache([tuple(best_node["tok_seq"])])
                 # joint network
                 log_prob = self._joint_log_prob(enc_frame, dec_out)
 
@@ -238,7 +350,6 @@ class TransducerBeamSearch(nn.Module):
                     cache_logp.append(log_prob[:-1])
                 # cache stats
                 cache_node.append(best_node)
-                cache_dec_hid.append(dec_hid)
                 cache_dec_out.append(dec_out)
 
                 # set -inf as it already used
@@ -266,8 +377,6 @@ class TransducerBeamSearch(nn.Module):
                     update_stats = {
                         "tok_seq":
                             father_node["tok_seq"] + [best_tok],
-                        "dec_hid":
-                            cache_dec_hid[best_idx],
                         "dec_out":
                             father_node["dec_out"] + [cache_dec_out[best_idx]],
                         "lm_state":
@@ -283,6 +392,8 @@ class TransducerBeamSearch(nn.Module):
                 if list_b[beam_size - 1].score >= best_node.score:
                     list_b = list_b[:beam_size]
                     break
+            # only keep the states of the surviving hypothesis
+            pred_cache.prune([tuple(n["tok_seq"]) for n in list_b])
         nbest = min(beam_size, nbest)
         final_hypos = [{
             "score": n.score.item() / (len(n["tok_seq"]) if len_norm else 1),
@@ -295,3 +406,162 @@ class TransducerBeamSearch(nn.Module):
         logger.info(f"--- beam search gets {len(nbest_hypos)}-best from " +
                     f"{len(list_b)} hypothesis (len_norm = {len_norm}) ...")
         return nbest_hypos
+
+    def frame_step(self,
+                   hypos: List[List[Tuple]],
+                   enc_frame: th.Tensor,
+                   pred_cache: PrefixCache,
+                   lm_cache: Optional[PrefixCache] = None,
+                   beam_size: int = 16,
+                   lm_weight: float = 0,
+                   max_sym_per_frame: int = 1) -> List[List[Tuple]]:
+        """
+        Expand the hypotheses of the utterances with one encoder frame (at
+        most #max_sym_per_frame tokens), used in time synchronous beam search
+        Args:
+            hypos (list[list[tuple]]): hypothesis of each utterance,
+                                       [(prefix, score), ...]
+            enc_frame (Tensor): N x J, projected encoder frame
+            pred_cache (PrefixCache): cache of the prediction network
+            lm_cache (PrefixCache): cache of the LM (None if not used)
+        Return:
+            hypos (list[list[tuple]]): updated hypothesis (sorted)
+        """
+        vocab_size = self.decoder.vocab_size
+        # hypothesis to expand for each utterance
+        expand = hypos
+        # hypothesis that consume the current frame
+        finish = [{} for _ in hypos]
+        for s in range(max_sym_per_frame):
+            # flatten: M
+            index = [(i, j)
+                     for i, hyps in enumerate(expand)
+                     for j in range(len(hyps))]
+            if not index:
+                break
+            prefix = [expand[i][j][0] for i, j in index]
+            # NOTE: merged scores are np.float64
+            score = th.tensor([expand[i][j][1] for i, j in index],
+                              dtype=th.float32,
+                              device=self.device)
+            utt = th.tensor([i for i, _ in index], device=self.device)
+            # M x J
+            dec_out = pred_cache(prefix)
+            # M x V
+            log_prob = self.decoder.joint(enc_frame[utt], dec_out)[:, 0]
+            log_prob = tf.log_softmax(log_prob, dim=-1)
+            if lm_cache is not None:
+                log_prob[:, :-1] += lm_weight * lm_cache(prefix)
+            # pad as #utt x beam x V
+            cand = th.full((len(expand), beam_size, vocab_size),
+                           -float("inf"),
+                           device=self.device)
+            i, j = zip(*index)
+            cand[list(i), list(j)] = score[:, None] + log_prob
+            # #utt x beam
+            topk_score, topk_index = th.topk(cand.view(len(expand), -1),
+                                             beam_size,
+                                             dim=-1)
+            topk_score = topk_score.tolist()
+            topk_index = topk_index.tolist()
+            next_expand = [{} for _ in hypos]
+            for i, hyps in enumerate(expand):
+                for val, idx in zip(topk_score[i], topk_index[i]):
+                    if val == -float("inf"):
+                        break
+                    seq = hyps[idx // vocab_size][0]
+                    tok = idx % vocab_size
+                    if tok == self.blank:
+                        pool = finish[i]
+                    else:
+                        seq = seq + (tok,)
+                        last = s == max_sym_per_frame - 1
+                        pool = finish[i] if last else next_expand[i]
+                    # merge the same prefix
+                    pool[seq] = np.logaddexp(pool[seq],
+                                             val) if seq in pool else val
+            expand = [list(pool.items()) for pool in next_expand]
+        return [
+            sorted(pool.items(), key=lambda h: h[1], reverse=True)[:beam_size]
+            for pool in finish
+        ]
+
+    def nbest_hypos(self,
+                    hypos: List[Tuple],
+                    nbest: int = 8,
+                    len_norm: bool = True) -> List[Dict]:
+        """
+        Return the nbest hypothesis (dict) of one utterance
+        Args:
+            hypos (list[tuple]): [(prefix, score), ...]
+        """
+        final_hypos = [{
+            "score": score / (len(seq) if len_norm else 1),
+            "trans": list(seq) + [self.blank]
+        } for seq, score in hypos]
+        return sorted(final_hypos, key=lambda n: n["score"],
+                      reverse=True)[:nbest]
+
+    def beam_search_batch(self,
+                          enc_out: th.Tensor,
+                          enc_len: Optional[th.Tensor] = None,
+                          beam_size: int = 16,
+                          nbest: int = 8,
+                          lm_weight: float = 0,
+                          len_norm: bool = True,
+                          max_sym_per_frame: int = 1) -> List[List[Dict]]:
+        """
+        Batch version of the time synchronous beam search. For each frame, the
+        hypotheses of all the utterances are expanded together (at most
+        #max_sym_per_frame tokens) and the outputs of the prediction network
+        are cached by the token prefix
+        Args:
+            enc_out (Tensor): N x T x D
+            enc_len (Tensor): N or None
+            beam_size (int): beam size of the beam search
+            nbest (int): return nbest hypos
+            max_sym_per_frame (int): maximum number of tokens emitted per frame
+        Return:
+            nbest_hypos (list[list[dict]]): N x #nbest
+        """
+        N, T, D = enc_out.shape
+        vocab_size = self.decoder.vocab_size
+        if beam_size > vocab_size:
+            raise RuntimeError(
+                f"Beam size ({beam_size}) > vocabulary size ({vocab_size})")
+        if max_sym_per_frame < 1:
+            raise ValueError(
+                f"Invalid max_sym_per_frame value: {max_sym_per_frame}")
+        logger.info(f"--- shape of the encoder output: {N} x {T} x {D}")
+        enc_len = [T] * N if enc_len is None else enc_len.tolist()
+        # N x T x J
+        enc_proj = self.decoder.enc_proj(enc_out)
+
+        pred_cache, lm_cache = self.init_cache(lm_weight=lm_weight)
+        # hypothesis of each utterance: [(prefix, score), ...]
+        hypos = [[((self.blank,), 0.0)] for _ in range(N)]
+        for t in range(max(enc_len)):
+            active = [n for n in range(N) if t < enc_len[n]]
+            active_hypos = self.frame_step([hypos[n] for n in active],
+                                           enc_proj[active, t],
+                                           pred_cache,
+                                           lm_cache=lm_cache,
+                                           beam_size=beam_size,
+                                           lm_weight=lm_weight,
+                                           max_sym_per_frame=max_sym_per_frame)
+            for n, hyps in zip(active, active_hypos):
+                hypos[n] = hyps
+            # only keep the states of the surviving hypothesis
+            alive = [h[0] for hyps in hypos for h in hyps]
+            pred_cache.prune(alive)
+            if lm_cache is not None:
+                lm_cache.prune(alive)
+
+        nbest = min(beam_size, nbest)
+        batch_nbest = [
+            self.nbest_hypos(hyps, nbest=nbest, len_norm=len_norm)
+            for hyps in hypos
+        ]
+        logger.info(f"--- batch beam search gets {nbest}-best for {N} " +
+                    f"utterances (len_norm = {len_norm}) ...")
+        return batch_nbest
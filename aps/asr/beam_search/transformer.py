@@ -33,19 +33,17 @@ def greedy_search(decoder: nn.Module,
     if N != 1:
         raise RuntimeError(
             f"Got batch size {N:d}, now only support one utterance")
-    if not hasattr(decoder, "step"):
-        raise RuntimeError("Function step should defined in decoder network")
+    if not hasattr(decoder, "incremental_step"):
+        raise RuntimeError(
+            "Function incremental_step should defined in decoder network")
     device = enc_out.device
     dec_tok = [sos]
-    pre_emb = None
+    cache = decoder.init_cache(enc_out)
     score = 0
     while True:
         pre_tok = th.tensor([dec_tok[-1]], device=device)
         # make one step
-        dec_out, pre_emb = decoder.step(enc_out,
-                                        pre_tok[:, None],
-                                        out_idx=-1,
-                                        pre_emb=pre_emb)
+        dec_out = decoder.incremental_step(pre_tok, cache)
         prob = tf.log_softmax(dec_out, dim=-1)
         pred_score, pred_token = th.topk(prob, 1, dim=-1)
         dec_tok.append(pred_token.item())
@@ -135,8 +133,9 @@ def beam_search(decoder: nn.Module,
     if N != 1:
         raise RuntimeError(
             f"Got batch size {N:d}, now only support one utterance")
-    if not hasattr(decoder, "step"):
-        raise RuntimeError("Function step should defined in decoder network")
+    if not hasattr(decoder, "incremental_step"):
+        raise RuntimeError(
+            "Function incremental_step should defined in decoder network")
     if beam_size > decoder.vocab_size:
         raise RuntimeError(f"Beam size({beam_size}) > vocabulary size")
 
@@ -165,27 +164,28 @@ def beam_search(decoder: nn.Module,
                                  eos_threshold=eos_threshold,
                                  ctc_beam_size=int(beam_size * 1.5))
     beam_tracker = BeamTracker(beam_param, ctc_prob=ctc_prob)
-    pre_emb = None
     lm_state = None
     # T x 1 x D => T x beam x D
     enc_out = th.repeat_interleave(enc_out, beam_size, 1)
+    # keys & values of the decoder layers are cached
+    cache = decoder.init_cache(enc_out)
     # step by step
     stop = False
     while not stop:
         # beam
         pre_tok, point = beam_tracker[-1]
         # beam x V
-        dec_out, pre_emb = decoder.step(
-            enc_out,
-            pre_tok[:, None],
-            out_idx=-1,
-            pre_emb=None if pre_emb is None else pre_emb[:, point])
+        dec_out = decoder.incremental_step(pre_tok, cache, point=point)
 
         # compute prob: beam x V, nagetive
         am_prob = tf.log_softmax(dec_out / temperature, dim=-1)
         if lm and beam_param.lm_weight > 0:
             # beam x V
-            lm_prob, lm_state = lm_score_impl(lm, point, pre_tok, lm_state)
+            lm_prob, lm_state = lm_score_impl(lm,
+                                              point,
+                                              pre_tok,
+                                              lm_state,
+                                              am_prob=am_prob)
         else:
             lm_prob = 0
         # one beam search step
@@ -198,6 +198,7 @@ def beam_search_batch(decoder: nn.Module,
                       enc_out: th.Tensor,
                       enc_len: th.Tensor,
                       lm: Optional[LmType] = None,
+                      ctc_prob: Optional[th.Tensor] = None,
                       lm_weight: float = 0,
                       beam_size: int = 8,
                       nbest: int = 1,
@@ -222,11 +223,13 @@ def beam_search_batch(decoder: nn.Module,
     Args
         enc_out (Tensor): T x N x F, encoder output
         enc_len (Tensor): N, length of the encoder output
+        ctc_prob (Tensor): N x T x V, CTC output (used if ctc_weight > 0)
     """
     if sos < 0 or eos < 0:
         raise RuntimeError(f"Invalid SOS/EOS ID: {sos:d}/{eos:d}")
-    if not hasattr(decoder, "step"):
-        raise RuntimeError("Function step should defined in decoder network")
+    if not hasattr(decoder, "incremental_step"):
+        raise RuntimeError(
+            "Function incremental_step should defined in decoder network")
     if beam_size > decoder.vocab_size:
         raise RuntimeError(f"Beam size({beam_size}) > vocabulary size")
 
@@ -247,8 +250,8 @@ def beam_search_batch(decoder: nn.Module,
     enc_len = th.repeat_interleave(enc_len, beam_size, 0)
     # T x N x D => T x N*beam x D
     enc_out = th.repeat_interleave(enc_out, beam_size, 1)
-
-    pre_emb = None
+    # keys & values of the decoder layers are cached
+    cache = decoder.init_cache(enc_out, enc_len=enc_len)
     lm_state = None
     # cov_* are diabled
     beam_param = BeamSearchParam(beam_size=beam_size,
@@ -266,24 +269,27 @@ def beam_search_batch(decoder: nn.Module,
                                  allow_partial=allow_partial,
                                  eos_threshold=eos_threshold,
                                  ctc_beam_size=int(beam_size * 1.5))
-    beam_tracker = BatchBeamTracker(N, beam_param)
+    beam_tracker = BatchBeamTracker(N,
+                                    beam_param,
+                                    ctc_prob=ctc_prob,
+                                    ctc_len=enc_len[::beam_size])
     # step by step
     stop = False
     while not stop:
         # N*beam
         pre_tok, point = beam_tracker[-1]
         # beam x V
-        dec_out, pre_emb = decoder.step(
-            enc_out,
-            pre_tok[:, None],
-            out_idx=-1,
-            pre_emb=None if pre_emb is None else pre_emb[:, point])
+        dec_out = decoder.incremental_step(pre_tok, cache, point=point)
         # compute prob: N*beam x V, nagetive
         am_prob = tf.log_softmax(dec_out / temperature, dim=-1)
 
         if lm and beam_param.lm_weight > 0:
             # beam x V
-            lm_prob, lm_state = lm_score_impl(lm, point, pre_tok, lm_state)
+            lm_prob, lm_state = lm_score_impl(lm,
+                                              point,
+                                              pre_tok,
+                                              lm_state,
+                                              am_prob=am_prob)
         else:
             lm_prob = 0
 
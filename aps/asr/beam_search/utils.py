@@ -177,6 +177,35 @@ class BaseBeamTracker(object):
                                          dim=-1)
         return (topk_score, topk_token)
 
+    def beam_select_ctc(self, am_prob: th.Tensor, lm_prob: FloatOrTensor):
+        """
+        Perform beam selection considering CTC score
+        """
+        # beam x ctc_beam
+        att_score, att_topk_token = th.topk(am_prob,
+                                            self.param.ctc_beam_size,
+                                            dim=-1)
+        # beam x ctc_beam
+        ctc_score = self.ctc_scorer(self.trans, att_topk_token.view(-1))
+        # weight sum
+        att_ctc_score = att_score * (
+            1 - self.param.ctc_weight) + ctc_score * self.param.ctc_weight
+        # beam x ctc_beam
+        if isinstance(lm_prob, th.Tensor):
+            lm_prob = th.gather(lm_prob, -1, att_topk_token)
+        # beam x ctc_beam
+        fusion_score = att_ctc_score + self.param.lm_weight * lm_prob
+        if self.param.eos_threshold > 0:
+            fusion_score = self.disable_eos(fusion_score)
+        # beam x ctc_beam => beam x beam
+        topk_score, topk_index = th.topk(fusion_score,
+                                         self.param.beam_size,
+                                         dim=-1)
+        # beam x beam
+        topk_token = th.gather(att_topk_token, -1, topk_index)
+        self.ctc_scorer.update_var(topk_index)
+        return (topk_score, topk_token)
+
     def trace_hypos(self,
                     point: th.Tensor,
                     score: List[float],
@@ -298,35 +327,6 @@ class BeamTracker(BaseBeamTracker):
                                 f"{h['trans']}, score = {h['score']:.2f}")
         return hyp
 
-    def beam_select_ctc(self, am_prob: th.Tensor, lm_prob: FloatOrTensor):
-        """
-        Perform beam selection considering CTC score
-        """
-        # beam x ctc_beam
-        att_score, att_topk_token = th.topk(am_prob,
-                                            self.param.ctc_beam_size,
-                                            dim=-1)
-        # beam x ctc_beam
-        ctc_score = self.ctc_scorer(self.trans, att_topk_token.view(-1))
-        # weight sum
-        att_ctc_score = att_score * (
-            1 - self.param.ctc_weight) + ctc_score * self.param.ctc_weight
-        # beam x ctc_beam
-        if isinstance(lm_prob, th.Tensor):
-            lm_prob = th.gather(lm_prob, -1, att_topk_token)
-        # beam x ctc_beam
-        fusion_score = att_ctc_score + self.param.lm_weight * lm_prob
-        if self.param.eos_threshold > 0:
-            fusion_score = self.disable_eos(fusion_score)
-        # beam x ctc_beam => beam x beam
-        topk_score, topk_index = th.topk(fusion_score,
-                                         self.param.beam_size,
-                                         dim=-1)
-        # beam x beam
-        topk_token = th.gather(att_topk_token, -1, topk_index)
-        self.ctc_scorer.update_var(topk_index)
-        return (topk_score, topk_token)
-
     def _init_search(self,
                      am_prob: th.Tensor,
                      lm_prob: FloatOrTensor,
@@ -477,10 +477,13 @@ class BeamTracker(BaseBeamTracker):
 class BatchBeamTracker(BaseBeamTracker):
     """
     A data structure used in batch version of the beam search
-    NOTE: not support CTC score
     """
 
-    def __init__(self, batch_size: int, param: BeamSearchParam) -> None:
+    def __init__(self,
+                 batch_size: int,
+                 param: BeamSearchParam,
+                 ctc_prob: Optional[th.Tensor] = None,
+                 ctc_len: Optional[th.Tensor] = None) -> None:
         super(BatchBeamTracker, self).__init__(param)
         self.param = param
         self.batch_size = batch_size
@@ -502,6 +505,15 @@ class BatchBeamTracker(BaseBeamTracker):
                                     param.beam_size * batch_size,
                                     param.beam_size,
                                     device=param.device)
+        if param.ctc_weight > 0 and ctc_prob is not None:
+            self.ctc_scorer = CtcScorer(ctc_prob,
+                                        eos=param.eos,
+                                        batch_size=param.beam_size * batch_size,
+                                        beam_size=param.ctc_beam_size,
+                                        ctc_len=ctc_len)
+            logger.info(f"--- use CTC score, weight = {param.ctc_weight:.2f}")
+        else:
+            self.ctc_scorer = None
 
     def __getitem__(self, t: int) -> Tuple[th.Tensor, th.Tensor]:
         """
@@ -553,7 +565,13 @@ class BatchBeamTracker(BaseBeamTracker):
         """
         assert len(self.point) == 1 and self.step_num == 0
         # local pruning: N*beam x V => N*beam x beam
-        topk_score, topk_token = self.beam_select(am_prob, lm_prob)
+        if self.ctc_scorer:
+            topk_score, topk_token = self.beam_select_ctc(am_prob, lm_prob)
+            # N*beam*beam => N*beam (keep the first beam)
+            init_point = self.step_point[:, None] * self.param.beam_size
+            self.ctc_scorer.update_var((init_point + self.point[-1]).view(-1))
+        else:
+            topk_score, topk_token = self.beam_select(am_prob, lm_prob)
         init_score = topk_score[::self.param.beam_size]
         init_token = topk_token[::self.param.beam_size]
         # N x beam
@@ -576,7 +594,10 @@ class BatchBeamTracker(BaseBeamTracker):
             att_ali (Tensor): N x T, alignment score (weight)
         """
         # local pruning: beam x V => beam x beam
-        topk_score, topk_token = self.beam_select(am_prob, lm_prob)
+        if self.ctc_scorer:
+            topk_score, topk_token = self.beam_select_ctc(am_prob, lm_prob)
+        else:
+            topk_score, topk_token = self.beam_select(am_prob, lm_prob)
         # N*beam x beam = N*beam x 1 + N*beam x beam
         acmu_score = self.acmu_score.view(-1, 1) + topk_score
         score = acmu_score + self.coverage(att_ali)
@@ -584,6 +605,11 @@ class BatchBeamTracker(BaseBeamTracker):
         self.score, topk_index = th.topk(score.view(self.batch_size, -1),
                                          self.param.beam_size,
                                          dim=-1)
+        if self.ctc_scorer:
+            # N*beam*beam => N*beam
+            self.ctc_scorer.update_var(
+                (topk_index +
+                 self.step_point[:, None] * self.param.beam_size).view(-1))
         # update accmulated score (AM + LM)
         self.acmu_score = th.gather(acmu_score.view(self.batch_size, -1), -1,
                                     topk_index)
@@ -613,7 +639,8 @@ class BatchBeamTracker(BaseBeamTracker):
         score = self.score[batch, point].tolist()
         self.acmu_score[batch, point] = MIN_F32
         trans = th.chunk(self.trans, self.batch_size, 0)[batch]
-        align = th.chunk(self.align, self.batch_size, 0)[batch]
+        align = None if self.align is None else th.chunk(
+            self.align, self.batch_size, 0)[batch]
         points = [p[batch] for p in self.point]
         tokens = [t[batch] for t in self.token]
         return self.trace_hypos(point,
@@ -197,3 +197,41 @@ class CtcASR(ASREncoderBase):
             if self.ctc is not None:
                 enc_out = self.ctc(enc_out)
             return ctc_api.viterbi_align(enc_out[0], y)
+
+    def ctc_logits_batch(self,
+                         batch: List[th.Tensor]) -> Tuple[th.Tensor, th.Tensor]:
+        """
+        Return the CTC logits of the batch (used for batch/parallel alignment)
+        Args:
+            batch (list[Tensor]): audio samples or acoustic features, S or Ti x F
+        Return:
+            enc_out (Tensor): N x T x V
+            enc_len (Tensor): N
+        """
+        with th.no_grad():
+            if len(batch) == 1:
+                enc_out = self._decoding_prep(batch[0], batch_first=True)
+                enc_len = th.tensor([enc_out.shape[1]], device=enc_out.device)
+            else:
+                enc_out, enc_len = self._batch_decoding_prep(batch,
+                                                             batch_first=True)
+            if self.ctc is not None:
+                enc_out = self.ctc(enc_out)
+        return enc_out, enc_len
+
+    def ctc_align_batch(self, batch: List[th.Tensor],
+                        ys: List[th.Tensor]) -> List[Dict]:
+        """
+        Do CTC viterbi align (batch version) if has CTC branch
+        Args:
+            batch (list[Tensor]): audio samples or acoustic features, S or Ti x F
+            ys (list[Tensor]): reference sequences, U
+        """
+        ctc_api = CtcApi(self.vocab_size - 1)
+        enc_out, enc_len = self.ctc_logits_batch(batch)
+        dec_len = th.tensor([y.shape[-1] for y in ys])
+        dec_seq = pad_sequence(ys, batch_first=True, padding_value=-1)
+        return ctc_api.viterbi_align_batch(enc_out,
+                                           dec_seq,
+                                           enc_len=enc_len,
+                                           dec_len=dec_len)
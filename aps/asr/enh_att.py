@@ -45,7 +45,8 @@ class EnhASRBase(nn.Module):
             asr_transform: Optional[nn.Module] = None,
             # enhancement
             enh_type: str = "google_clp",
-            enh_kwargs: Optional[Dict] = None) -> None:
+            enh_kwargs: Optional[Dict] = None,
+            native_cplx: bool = False) -> None:
         super(EnhASRBase, self).__init__()
         # Front-end feature transform
         self.enh_transform = enh_transform
@@ -61,6 +62,8 @@ class EnhASRBase(nn.Module):
                                    enh_kwargs,
                                    enh_input_size=enh_input_size)
         self.enh_type = enh_type
+        # use PyTorch native complex tensor in ComplexTensor or not
+        self.native_cplx = native_cplx
 
     def forward(self,
                 x_pad: th.Tensor,
@@ -82,7 +85,9 @@ class EnhASRBase(nn.Module):
         """
         # feature for enhancement
         packed, x_len = self.enh_transform.encode(x_pad, x_len)
-        cstft = ComplexTensor(packed[..., 0], packed[..., 1])
+        cstft = ComplexTensor(packed[..., 0],
+                              packed[..., 1],
+                              native=self.native_cplx)
         if self.enh_type[-4:] == "mvdr":
             feats = self.enh_transform(packed)
             x_enh = self.enh_net(feats, cstft, inp_len=x_len)
@@ -138,6 +143,7 @@ class EnhAttASR(EnhASRBase):
             # enhancement
             enh_type: str = "google_clp",
             enh_kwargs: Optional[Dict] = None,
+            native_cplx: bool = False,
             asr_cpt: str = "",
             # attention
             att_type: str = "ctx",
@@ -169,7 +175,8 @@ class EnhAttASR(EnhASRBase):
                                         enh_transform=enh_transform,
                                         asr_transform=asr_transform,
                                         enh_type=enh_type,
-                                        enh_kwargs=enh_kwargs)
+                                        enh_kwargs=enh_kwargs,
+                                        native_cplx=native_cplx)
 
 
 @ApsRegisters.asr.register("asr@enh_xfmr")
@@ -192,6 +199,7 @@ class EnhXfmrASR(EnhASRBase):
             # enhancement
             enh_type: str = "google_clp",
             enh_kwargs: Optional[Dict] = None,
+            native_cplx: bool = False,
             asr_cpt: str = "",
             # encoder & decoder
             enc_type: str = "xfmr_abs",
@@ -217,4 +225,5 @@ class EnhXfmrASR(EnhASRBase):
                                          enh_transform=enh_transform,
                                          asr_transform=asr_transform,
                                          enh_type=enh_type,
-                                         enh_kwargs=enh_kwargs)
+                                         enh_kwargs=enh_kwargs,
+                                         native_cplx=native_cplx)
@@ -88,10 +88,8 @@ class MvdrBeamformer(nn.Module):
         C = Rn.shape[-1]
         I = th.eye(C, device=Rn.device, dtype=Rn.dtype)
         Rn = Rn + I * eps
-        # N x F x C x C
-        Rn_inv = Rn.inverse()
         # N x F x C x C: einsum("...ij,...jk->...ik", Rn_inv, Rs)
-        Rn_inv_Rs = Rn_inv @ Rs
+        Rn_inv_Rs = Rn.solve(Rs)
         # N x F
         tr_Rn_inv_Rs = trace(Rn_inv_Rs) + eps
         # N x F x C: einsum("...fnc,...c->...fn", Rn_inv_Rs, u)
@@ -9,8 +9,68 @@ try:
 except ImportError:
     kenlm_available = False
 
+from collections import OrderedDict
+from typing import List, Optional
 from aps.conf import load_dict
-from aps.const import EOS_TOKEN, SOS_TOKEN
+from aps.const import EOS_TOKEN, SOS_TOKEN, MIN_F32
+
+
+class NgramContext(object):
+    """
+    LM scores & next states of one ngram context (filled on demand)
+
+    Args:
+        ngram_lm: kenlm model
+        state: kenlm state of the context
+        token: vocabulary list (int => str)
+    """
+
+    def __init__(self, ngram_lm, state, token: List[str]) -> None:
+        self.ngram_lm = ngram_lm
+        self.state = state
+        self.token = token
+        # token => score, dropped once the full row is computed
+        self.score = {}
+        self.next_state = {}
+        self.full_score = None
+
+    def expand(self, index: List[int]) -> List[float]:
+        """
+        Return the LM scores of the given tokens
+        """
+        if self.full_score is not None:
+            return self.full_score[index].tolist()
+        # scratch state, next states are created only when needed
+        out_state = kenlm.State()
+        for i in index:
+            if i not in self.score:
+                self.score[i] = self.ngram_lm.BaseScore(self.state,
+                                                        self.token[i],
+                                                        out_state)
+        return [self.score[i] for i in index]
+
+    def scores(self) -> th.Tensor:
+        """
+        Return the LM scores of all the vocabulary: V
+        """
+        if self.full_score is None:
+            self.full_score = th.tensor(self.expand(range(len(self.token))))
+            # keep only one copy (tensor) of the scores in the cache
+            self.score = None
+        return self.full_score
+
+    def __getitem__(self, index: int):
+        """
+        Return the next state when appending the token
+        """
+        if index not in self.next_state:
+            state = kenlm.State()
+            score = self.ngram_lm.BaseScore(self.state, self.token[index],
+                                            state)
+            if self.score is not None:
+                self.score[index] = score
+            self.next_state[index] = state
+        return self.next_state[index]
 
 
 class NgramLM(object):
@@ -20,9 +80,16 @@ class NgramLM(object):
     Args:
         lm: checkpoint of the ngram LM
         vocab_dict: path of the ASR dictionary
+        cache_size: number of the ngram contexts kept in LRU cache
+        topk: if > 0, only score the topk acoustic candidates of each
+              hypothesis (see ngram_score in aps.asr.beam_search.lm)
     """
 
-    def __init__(self, lm: str, vocab_dict: str) -> None:
+    def __init__(self,
+                 lm: str,
+                 vocab_dict: str,
+                 cache_size: int = 4096,
+                 topk: int = 0) -> None:
         if not kenlm_available:
             raise RuntimeError("import kenlm error, please install kenlm first")
         self.ngram_lm = kenlm.LanguageModel(lm)
@@ -35,6 +102,10 @@ class NgramLM(object):
             if tok == SOS_TOKEN:
                 tok = "<s>"
             self.token[i] = tok
+        self.cache_size = cache_size
+        self.topk = topk
+        # LRU cache: kenlm state (ngram context) => NgramContext
+        self.cache = OrderedDict()
 
     def score(self,
               utterance: str,
@@ -45,29 +116,32 @@ class NgramLM(object):
         """
         return self.ngram_lm.score(utterance, bos=sos, eos=eos)
 
-    def _step(self, prev_state):
+    def _context(self, prev_state) -> NgramContext:
         """
         Args:
             prev_state (State): previous state
         Return:
-            score (Tensor): V, LM scores
-            state (list[State]), new states
+            context (NgramContext): cached context
         """
-        next_state = [kenlm.State() for _ in range(len(self.token))]
-        score = th.tensor([
-            self.ngram_lm.BaseScore(prev_state, pred, next_state[i])
-            for i, pred in enumerate(self.token)
-        ])
-        return score, next_state
-
-    def __call__(self, token, state):
+        if prev_state in self.cache:
+            self.cache.move_to_end(prev_state)
+            return self.cache[prev_state]
+        context = NgramContext(self.ngram_lm, prev_state, self.token)
+        self.cache[prev_state] = context
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return context
+
+    def __call__(self, token, state, candidate: Optional[th.Tensor] = None):
         """
         Args:
-            token (th.Tensor): V, previous tokens
-            state (list[list[State]] or None): LM states
+            token (th.Tensor): N, previous tokens
+            state (list[NgramContext] or None): LM states
+            candidate (th.Tensor): N x K, if not None, only score the
+                                   candidate tokens (others are MIN_F32)
         Return:
             score (Tensor): N x V, LM scores
-            state (list[list[State]]), new states
+            state (list[NgramContext]), new states
         """
         device = token.device
         token = token.tolist()
@@ -78,10 +152,13 @@ class NgramLM(object):
         else:
             assert len(token) == len(state)
             prev_state = [s[token[i]] for i, s in enumerate(state)]
-        scores, states = [], []
-        for state in prev_state:
-            score, state = self._step(state)
-            scores.append(score)
-            states.append(state)
-        scores = th.stack(scores).to(device)
-        return scores, states
+        states = [self._context(s) for s in prev_state]
+        if candidate is None:
+            scores = th.stack([s.scores() for s in states])
+        else:
+            candidate = candidate.cpu()
+            scores = th.full((len(token), len(self.token)), MIN_F32)
+            for i, s in enumerate(states):
+                index = candidate[i].tolist()
+                scores[i, index] = th.tensor(s.expand(index))
+        return scores.to(device), states
@@ -69,6 +69,34 @@ class ASRTransducerBase(ASREncoderBase):
                                    lm_weight=lm_weight,
                                    len_norm=len_norm)
 
+    def beam_search_batch(self,
+                          batch: List[th.Tensor],
+                          lm: Optional[nn.Module] = None,
+                          lm_weight: float = 0,
+                          beam_size: int = 16,
+                          nbest: int = 8,
+                          len_norm: bool = True,
+                          max_sym_per_frame: int = 1,
+                          **kwargs) -> List[List[Dict]]:
+        """
+        Batch version of beam search for TransducerASR
+        Args
+            batch (list[Tensor]): audio samples or acoustic features, S or Ti x F
+        """
+        beam_search_api = TransducerBeamSearch(self.decoder,
+                                               lm=lm,
+                                               blank=self.blank)
+        with th.no_grad():
+            enc_out, enc_len = self._batch_decoding_prep(batch)
+            return beam_search_api.beam_search_batch(
+                enc_out,
+                enc_len,
+                beam_size=beam_size,
+                nbest=nbest,
+                lm_weight=lm_weight,
+                len_norm=len_norm,
+                max_sym_per_frame=max_sym_per_frame)
+
 
 @ApsRegisters.asr.register("asr@transducer")
 class TransducerASR(ASRTransducerBase):
@@ -5,13 +5,59 @@
 
 import torch as th
 import torch.nn as nn
+import torch.nn.functional as tf
 
 from torch.nn import MultiheadAttention, TransformerDecoder
-from typing import Tuple, Optional, Dict
+from typing import Tuple, Optional, Dict, List
 from aps.asr.transformer.pose import get_xfmr_pose
 from aps.asr.transformer.utils import get_activation_fn, prep_sub_mask
 from aps.asr.base.attention import padding_mask
 
+KeyValue = Tuple[th.Tensor, th.Tensor]
+
+
+def mha_proj(mha: MultiheadAttention, inp: th.Tensor, index: int) -> th.Tensor:
+    """
+    Projection of the query (index = 0), key (1) or value (2) in MultiheadAttention
+    Args:
+        inp (Tensor): T x N x D
+    Return:
+        out (Tensor): N x H x T x D/H
+    """
+    beg, end = index * mha.embed_dim, (index + 1) * mha.embed_dim
+    weight = mha.in_proj_weight[beg:end]
+    bias = None if mha.in_proj_bias is None else mha.in_proj_bias[beg:end]
+    T, N, _ = inp.shape
+    out = tf.linear(inp, weight, bias)
+    # T x N x H x D/H => N x H x T x D/H
+    return out.view(T, N, mha.num_heads, -1).permute(1, 2, 0, 3)
+
+
+def mha_step(mha: MultiheadAttention,
+             query: th.Tensor,
+             key_value: KeyValue,
+             key_padding_mask: Optional[th.Tensor] = None) -> th.Tensor:
+    """
+    Attention of one query step (in evaluation mode) using the projected keys & values
+    Args:
+        query (Tensor): N x D
+        key_value (Tensor, Tensor): N x H x T x D/H
+        key_padding_mask (Tensor or None): N x T
+    Return:
+        out (Tensor): N x D
+    """
+    key, value = key_value
+    # N x H x 1 x D/H
+    query = mha_proj(mha, query[None], 0) * mha.head_dim**-0.5
+    # N x H x 1 x T
+    score = th.matmul(query, key.transpose(-1, -2))
+    if key_padding_mask is not None:
+        score = score.masked_fill(key_padding_mask[:, None, None],
+                                  float("-inf"))
+    # N x H x 1 x D/H
+    ctx = th.matmul(th.softmax(score, -1), value)
+    return mha.out_proj(ctx.view(query.shape[0], -1))
+
 
 class TransformerDncoderLayer(nn.Module):
     """
@@ -97,6 +143,97 @@ class TransformerDncoderLayer(nn.Module):
             tgt = self.norm3(tgt)
         return tgt
 
+    def memory_kv(self, memory: th.Tensor) -> KeyValue:
+        """
+        Project the memory to the keys & values of the cross attention (used in step)
+        Args:
+            memory (Tensor): S x N x D
+        Return:
+            key, value (Tensor): N x H x S x D/H
+        """
+        return (mha_proj(self.multihead_attn, memory,
+                         1), mha_proj(self.multihead_attn, memory, 2))
+
+    def step(self,
+             tgt: th.Tensor,
+             memory_kv: KeyValue,
+             memory_key_padding_mask: Optional[th.Tensor] = None,
+             cache: Optional[KeyValue] = None) -> Tuple[th.Tensor, KeyValue]:
+        """
+        Incremental decoding (only process the newest target token)
+        Args:
+            tgt (Tensor): N x D
+            memory_kv (Tensor, Tensor): N x H x S x D/H
+            memory_key_padding_mask (Tensor or None): N x S
+            cache (Tensor, Tensor) or None: self-attention keys & values
+                                            of the previous tokens, N x H x T x D/H
+        Return
+            out (Tensor): N x D
+            cache (Tensor, Tensor): N x H x T+1 x D/H
+        """
+        skip_add = tgt
+        if self.pre_norm:
+            tgt = self.norm1(tgt)
+        key = mha_proj(self.self_attn, tgt[None], 1)
+        value = mha_proj(self.self_attn, tgt[None], 2)
+        if cache is not None:
+            key = th.cat([cache[0], key], 2)
+            value = th.cat([cache[1], value], 2)
+        tgt = mha_step(self.self_attn, tgt, (key, value))
+
+        tgt = skip_add + self.dropout1(tgt)
+        if not self.pre_norm:
+            tgt = self.norm1(tgt)
+
+        skip_add = tgt
+        if self.pre_norm:
+            tgt = self.norm2(tgt)
+        tgt = mha_step(self.multihead_attn,
+                       tgt,
+                       memory_kv,
+                       key_padding_mask=memory_key_padding_mask)
+
+        tgt = skip_add + self.dropout2(tgt)
+        if not self.pre_norm:
+            tgt = self.norm2(tgt)
+
+        skip_add = tgt
+        if self.pre_norm:
+            tgt = self.norm3(tgt)
+        tgt = skip_add + self.feedforward(tgt)
+        if not self.pre_norm:
+            tgt = self.norm3(tgt)
+        return tgt, (key, value)
+
+
+class DecoderCache(object):
+    """
+    Cache of the transformer decoder for incremental decoding
+    Args:
+        memory_kv (list): projected keys & values of the memory in each layer
+        memory_mask (Tensor or None): N x S, padding mask of the memory
+    """
+
+    def __init__(self, memory_kv: List[KeyValue],
+                 memory_mask: Optional[th.Tensor]) -> None:
+        self.memory_kv = memory_kv
+        self.memory_mask = memory_mask
+        # self-attention keys & values of the decoded tokens in each layer
+        self.self_kv = [None] * len(memory_kv)
+        self.offset = 0
+
+    def reorder(self, point: th.Tensor) -> None:
+        """
+        Reorder the self-attention cache using the beam back-pointers. NOTE: the
+        memory is not reordered as it's same for the hypothesis of one utterance
+        Args:
+            point (Tensor): N
+        """
+        self.self_kv = [
+            None if kv is None else (kv[0][point], kv[1][point])
+            for kv in self.self_kv
+        ]
+
 
 class TorchTransformerDecoder(nn.Module):
     """
@@ -167,6 +304,54 @@ class TorchTransformerDecoder(nn.Module):
         dec_out = self.output(dec_out)
         return dec_out, tgt_emb
 
+    def init_cache(self,
+                   enc_out: th.Tensor,
+                   enc_len: Optional[th.Tensor] = None) -> DecoderCache:
+        """
+        Create cache for incremental decoding (precompute the memory keys & values)
+        Args:
+            enc_out (Tensor): T x N x D
+            enc_len (Tensor): N or None
+        Return:
+            cache (DecoderCache)
+        """
+        mem_pad_mask = None if enc_len is None else (padding_mask(enc_len) == 1)
+        memory_kv = [layer.memory_kv(enc_out) for layer in self.decoder.layers]
+        return DecoderCache(memory_kv, mem_pad_mask)
+
+    def incremental_step(self,
+                         tgt_tok: th.Tensor,
+                         cache: DecoderCache,
+                         point: Optional[th.Tensor] = None) -> th.Tensor:
+        """
+        Decode one step using the cached keys & values, equal to
+        step(...) with out_idx=-1 in evaluation mode
+        Args:
+            tgt_tok (Tensor): N, the newest token
+            cache (DecoderCache): decoder cache, updated in place
+            point (Tensor or None): N, beam back-pointers
+        Return:
+            dec_out (Tensor): N x V
+        """
+        if point is not None:
+            cache.reorder(point)
+        # 1 x N x E
+        tgt_emb = self.abs_pos_enc(self.vocab_embed(tgt_tok[:, None]),
+                                   t=cache.offset)
+        # N x E
+        dec_out = tgt_emb[0]
+        for i, layer in enumerate(self.decoder.layers):
+            dec_out, cache.self_kv[i] = layer.step(
+                dec_out,
+                cache.memory_kv[i],
+                memory_key_padding_mask=cache.memory_mask,
+                cache=cache.self_kv[i])
+        if self.decoder.norm is not None:
+            dec_out = self.decoder.norm(dec_out)
+        cache.offset += 1
+        # N x V
+        return self.output(dec_out)
+
     def forward(self, enc_out: th.Tensor, enc_len: Optional[th.Tensor],
                 tgt_pad: th.Tensor, tgt_len: Optional[th.Tensor]) -> th.Tensor:
         """
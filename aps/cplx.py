@@ -13,24 +13,40 @@ from numbers import Number
 from typing import Optional, Union
 
 OpObjType = Union[th.Tensor, Number, "ComplexTensor"]
+# real dtype => complex dtype
+CPLX_DTYPE = {
+    th.float16: th.complex32,
+    th.float32: th.complex64,
+    th.float64: th.complex128
+}
 
 
 class ComplexTensor(object):
     """
-    Complex-valued tensor class
+    Complex-valued tensor class. By default, the real & imaginary parts are
+    kept in two real tensors (emulated backend). If native = True (or real is
+    a complex-dtype tensor), it wraps the PyTorch native complex tensor, so
+    the ops go to the complex kernels (e.g., matmul, linalg.solve) instead of
+    4+ real ones. The result of the ops that involve a native one is native
     """
 
     def __init__(self,
                  real: th.Tensor,
                  imag: Optional[th.Tensor] = None,
-                 polar: bool = False) -> None:
+                 polar: bool = False,
+                 native: bool = False) -> None:
+        if real.is_complex():
+            self.cplx = real
+            return
         imag = th.zeros_like(real) if imag is None else imag
         if polar:
-            self.real = th.cos(imag) * real
-            self.imag = th.sin(imag) * real
+            real, imag = th.cos(imag) * real, th.sin(imag) * real
+        if native:
+            self.cplx = th.complex(real, imag)
         else:
-            self.real = real
-            self.imag = imag
+            self.cplx = None
+            self._real = real
+            self._imag = imag
 
     def __add__(self, other: OpObjType) -> "ComplexTensor":
         """
@@ -92,34 +108,72 @@ class ComplexTensor(object):
         """
         return _rmatmul(other, self)
 
+    @property
+    def real(self) -> th.Tensor:
+        return self._real if self.cplx is None else self.cplx.real
+
+    @property
+    def imag(self) -> th.Tensor:
+        return self._imag if self.cplx is None else self.cplx.imag
+
+    @property
+    def is_native(self) -> bool:
+        return self.cplx is not None
+
+    def native(self) -> th.Tensor:
+        """
+        Return the PyTorch native complex tensor
+        """
+        return th.complex(self.real,
+                          self.imag) if self.cplx is None else self.cplx
+
     def abs(self) -> th.Tensor:
         """
         |self|
         """
+        if self.is_native:
+            return self.cplx.abs()
         return (self.real**2 + self.imag**2).sqrt()
 
     def angle(self) -> th.Tensor:
         """
         \\angle{self}
         """
+        if self.is_native:
+            return self.cplx.angle()
         return th.atan2(self.imag, self.real)
 
     def inverse(self) -> "ComplexTensor":
         """
         {self}^{-1}
         """
+        if self.is_native:
+            return ComplexTensor(th.linalg.inv(self.cplx))
         return _inverse(self)
 
+    def solve(self, other: OpObjType) -> "ComplexTensor":
+        """
+        {self}^{-1} @ other
+        """
+        if _use_native(self, other):
+            return ComplexTensor(
+                th.linalg.solve(self.native(), _native(other, as_cplx=True)))
+        return _lmatmul(_inverse(self), other)
+
     def conj(self) -> "ComplexTensor":
         """
         {self}^*
         """
+        if self.is_native:
+            return ComplexTensor(self.cplx.conj())
         return ComplexTensor(self.real, -1.0 * self.imag)
 
     def transpose(self, dim0, dim1) -> "ComplexTensor":
         """
         {self}^T
         """
+        if self.is_native:
+            return ComplexTensor(self.cplx.transpose(dim0, dim1))
         return ComplexTensor(self.real.transpose(dim0, dim1),
                              self.imag.transpose(dim0, dim1))
 
@@ -132,26 +186,38 @@ class ComplexTensor(object):
     def sum(self,
             dim: Optional[int] = None,
             keepdim: bool = False) -> "ComplexTensor":
+        if self.is_native:
+            return ComplexTensor(self.cplx.sum(dim=dim, keepdim=keepdim))
         return ComplexTensor(self.real.sum(dim=dim, keepdim=keepdim),
                              self.imag.sum(dim=dim, keepdim=keepdim))
 
     def view(self, *shape) -> "ComplexTensor":
+        if self.is_native:
+            return ComplexTensor(self.cplx.view(*shape))
         return ComplexTensor(self.real.view(*shape), self.imag.view(*shape))
 
     def to(self, *args, **kwargs) -> "ComplexTensor":
+        if self.is_native:
+            return ComplexTensor(self.cplx.to(*args, **kwargs))
         return ComplexTensor(self.real.to(*args, **kwargs),
                              self.imag.to(*args, **kwargs))
 
     def cpu(self) -> "ComplexTensor":
+        if self.is_native:
+            return ComplexTensor(self.cplx.cpu())
         return ComplexTensor(self.real.cpu(), self.imag.cpu())
 
     def cuda(self) -> "ComplexTensor":
+        if self.is_native:
+            return ComplexTensor(self.cplx.cuda())
         return ComplexTensor(self.real.cuda(), self.imag.cuda())
 
     def dim(self) -> int:
         return self.real.dim()
 
     def as_real(self) -> th.Tensor:
+        if self.is_native:
+            return th.view_as_real(self.cplx.resolve_conj())
         return th.stack([self.real, self.imag], dim=-1)
 
     @property
@@ -170,17 +236,25 @@ class ComplexTensor(object):
         return self.real.size()
 
     def masked_select(self, mask: th.Tensor) -> "ComplexTensor":
+        if self.is_native:
+            return ComplexTensor(self.cplx.masked_select(mask))
         return ComplexTensor(self.real.masked_select(mask),
                              self.imag.masked_select(mask))
 
     def masked_fill(self, mask: th.Tensor, value: Number) -> "ComplexTensor":
+        if self.is_native:
+            return ComplexTensor(self.cplx.masked_fill(mask, value))
         return ComplexTensor(self.real.masked_fill(mask, value),
                              self.imag.masked_fill(mask, value))
 
     def contiguous(self) -> "ComplexTensor":
+        if self.is_native:
+            return ComplexTensor(self.cplx.contiguous())
         return ComplexTensor(self.real.contiguous(), self.imag.contiguous())
 
     def __getitem__(self, item) -> "ComplexTensor":
+        if self.is_native:
+            return ComplexTensor(self.cplx[item])
         return ComplexTensor(self.real[item], self.imag[item])
 
 
@@ -188,7 +262,26 @@ def _is_complex(other: OpObjType) -> bool:
     return isinstance(other, (ComplexTensor, complex))
 
 
+def _use_native(*objs: OpObjType) -> bool:
+    return any(isinstance(obj, ComplexTensor) and obj.is_native for obj in objs)
+
+
+def _native(obj: OpObjType, as_cplx: bool = False) -> Union[th.Tensor, Number]:
+    """
+    Return the native complex tensor of the ComplexTensor. Other objects are
+    returned as they are, or converted to complex dtype if it's a real tensor
+    and as_cplx = True (required by matmul & solve)
+    """
+    if isinstance(obj, ComplexTensor):
+        return obj.native()
+    if as_cplx and isinstance(obj, th.Tensor) and not obj.is_complex():
+        return obj.to(CPLX_DTYPE[obj.dtype])
+    return obj
+
+
 def _add(tensor: ComplexTensor, other: OpObjType) -> ComplexTensor:
+    if _use_native(tensor, other):
+        return ComplexTensor(_native(tensor) + _native(other))
     if _is_complex(other):
         return ComplexTensor(tensor.real + other.real, tensor.imag + other.imag)
     else:
@@ -196,6 +289,8 @@ def _add(tensor: ComplexTensor, other: OpObjType) -> ComplexTensor:
 
 
 def _lsub(tensor: ComplexTensor, other: OpObjType) -> ComplexTensor:
+    if _use_native(tensor, other):
+        return ComplexTensor(_native(tensor) - _native(other))
     if _is_complex(other):
         return ComplexTensor(tensor.real - other.real, tensor.imag - other.imag)
     else:
@@ -203,6 +298,8 @@ def _lsub(tensor: ComplexTensor, other: OpObjType) -> ComplexTensor:
 
 
 def _rsub(other: OpObjType, tensor: ComplexTensor) -> ComplexTensor:
+    if _use_native(tensor, other):
+        return ComplexTensor(_native(other) - _native(tensor))
     if _is_complex(other):
         return ComplexTensor(other.real - tensor.real, other.imag - tensor.imag)
     else:
@@ -210,6 +307,8 @@ def _rsub(other: OpObjType, tensor: ComplexTensor) -> ComplexTensor:
 
 
 def _mul(tensor: ComplexTensor, other: OpObjType) -> ComplexTensor:
+    if _use_native(tensor, other):
+        return ComplexTensor(_native(tensor) * _native(other))
     if _is_complex(other):
         return ComplexTensor(
             tensor.real * other.real - tensor.imag * other.imag,
@@ -219,6 +318,8 @@ def _mul(tensor: ComplexTensor, other: OpObjType) -> ComplexTensor:
 
 
 def _ldiv(tensor: ComplexTensor, other: OpObjType) -> ComplexTensor:
+    if _use_native(tensor, other):
+        return ComplexTensor(_native(tensor) / _native(other))
     if _is_complex(other):
         scale = other.real**2 + other.imag**2
         return ComplexTensor(
@@ -229,6 +330,8 @@ def _ldiv(tensor: ComplexTensor, other: OpObjType) -> ComplexTensor:
 
 
 def _rdiv(other: OpObjType, tensor: ComplexTensor) -> ComplexTensor:
+    if _use_native(tensor, other):
+        return ComplexTensor(_native(other) / _native(tensor))
     scale = tensor.real**2 + tensor.imag**2
     if _is_complex(other):
         return ComplexTensor(
@@ -241,6 +344,9 @@ def _rdiv(other: OpObjType, tensor: ComplexTensor) -> ComplexTensor:
 
 def _lmatmul(tensor: ComplexTensor,
              other: Union[th.Tensor, ComplexTensor]) -> ComplexTensor:
+    if _use_native(tensor, other):
+        return ComplexTensor(
+            th.matmul(_native(tensor), _native(other, as_cplx=True)))
     if _is_complex(other):
         return ComplexTensor(
             th.matmul(tensor.real, other.real) -
@@ -254,6 +360,9 @@ def _lmatmul(tensor: ComplexTensor,
 
 def _rmatmul(other: Union[th.Tensor, ComplexTensor],
              tensor: ComplexTensor) -> ComplexTensor:
+    if _use_native(tensor, other):
+        return ComplexTensor(
+            th.matmul(_native(other, as_cplx=True), _native(tensor)))
     if _is_complex(other):
         return ComplexTensor(
             th.matmul(other.real, tensor.real) -
@@ -281,11 +390,11 @@ def _inverse(tensor: ComplexTensor) -> ComplexTensor:
 # -----------------------------------------------------------------
 
 
-def _random_cplx_mat(shape, cplx=True):
+def _random_cplx_mat(shape, cplx=True, native=False):
     R = th.rand(*shape)
     if cplx:
         I = th.rand(*shape)
-        pt_mat = ComplexTensor(R, I)
+        pt_mat = ComplexTensor(R, I, native=native)
         np_mat = R.numpy() + I.numpy() * 1j
     else:
         pt_mat = R
@@ -298,8 +407,8 @@ def _assert_allclose(pt_mat, np_mat):
     th.testing.assert_allclose(pt_mat.imag, th.from_numpy(np_mat.imag))
 
 
-def test_add_sub_mul_div():
-    pt_mat1, np_mat1 = _random_cplx_mat((8, 10))
+def test_add_sub_mul_div(native=False):
+    pt_mat1, np_mat1 = _random_cplx_mat((8, 10), native=native)
     pt_mat2, np_mat2 = _random_cplx_mat((8, 10))
     pt_mat3, np_mat3 = _random_cplx_mat((8, 10), cplx=False)
     s1, c1 = 3.6, 2.5 + 3.4j
@@ -317,8 +426,8 @@ def test_add_sub_mul_div():
         _assert_allclose(v1 / pt_mat1, v2 / np_mat1)
 
 
-def test_matmul():
-    pt_mat1, np_mat1 = _random_cplx_mat((8, 8))
+def test_matmul(native=False):
+    pt_mat1, np_mat1 = _random_cplx_mat((8, 8), native=native)
     pt_mat2, np_mat2 = _random_cplx_mat((8, 8))
     pt_mat3, np_mat3 = _random_cplx_mat((8, 8), cplx=False)
     _assert_allclose(pt_mat1 @ pt_mat2, np_mat1 @ np_mat2)
@@ -329,25 +438,29 @@ def test_matmul():
     _assert_allclose(pt_mat3 @ pt_mat1, np_mat3 @ np_mat1)
 
 
-def test_for_mvdr_ops():
+def test_for_mvdr_ops(native=False):
     N, M = 10, 8
     # trace
-    pt_mat, np_mat = _random_cplx_mat((N, M, M))
+    pt_mat, np_mat = _random_cplx_mat((N, M, M), native=native)
     diag_index = th.eye(M, dtype=th.bool).expand((N, M, M))
     pt_trace = pt_mat.masked_select(diag_index).view(N, M).sum(-1)
     np_trace = np.trace(np_mat, axis1=1, axis2=2)
     _assert_allclose(pt_trace, np_trace)
 
     # inverse
-    pt_mat, np_mat = _random_cplx_mat((N, M, M))
+    pt_mat, np_mat = _random_cplx_mat((N, M, M), native=native)
     pt_mat += th.eye(M)
     np_mat += np.eye(M)
     pt_mat_inv = pt_mat.inverse()
     np_mat_inv = np.linalg.inv(np_mat)
     _assert_allclose(pt_mat_inv, np_mat_inv)
 
+    # A^{-1}*B
+    pt_rhs, np_rhs = _random_cplx_mat((N, M, 20), native=native)
+    _assert_allclose(pt_mat.solve(pt_rhs), np.linalg.solve(np_mat, np_rhs))
+
     # A*B^H
-    pt_cplx, np_cplx = _random_cplx_mat((N, M, M))
+    pt_cplx, np_cplx = _random_cplx_mat((N, M, M), native=native)
     pt_real, np_real = _random_cplx_mat((N, M, M), cplx=False)
 
     np_mat = np.einsum("...it,...jt->...ij", np_cplx * np_real, np_cplx.conj())
@@ -356,17 +469,60 @@ def test_for_mvdr_ops():
 
     # A^H*B*A
     T = 20
-    pt_mat1, np_mat1 = _random_cplx_mat((N, M, T))
-    pt_mat2, np_mat2 = _random_cplx_mat((N, M, M))
+    pt_mat1, np_mat1 = _random_cplx_mat((N, M, T), native=native)
+    pt_mat2, np_mat2 = _random_cplx_mat((N, M, M), native=native)
     np_mat = np.einsum("...xt,...xy,...yt->...t", np_mat1.conj(), np_mat2,
                        np_mat1)
     pt_mat = (pt_mat1.conj() * (pt_mat2 @ pt_mat1)).sum(-2)
     _assert_allclose(pt_mat, np_mat)
 
 
+def benchmark(native: bool,
+              N: int = 8,
+              F: int = 257,
+              C: int = 6,
+              T: int = 200,
+              num_iters: int = 20,
+              device: str = "cpu") -> float:
+    """
+    Return the time cost (per iteration, in ms) of the MVDR style ops:
+    covariance estimation, A^{-1}*B, trace & beamforming (with backward)
+    """
+    import time
+    real = th.randn(N, F, C, T, device=device, requires_grad=True)
+    imag = th.randn(N, F, C, T, device=device, requires_grad=True)
+    mask = th.rand(N, F, 1, T, device=device)
+    eye = th.eye(C, device=device)
+    cost = 0
+    for i in range(num_iters + 1):
+        if device != "cpu":
+            th.cuda.synchronize()
+        start = time.time()
+        spec = ComplexTensor(real, imag, native=native)
+        # N x F x C x C
+        Rs = (spec * mask) @ spec.conj_transpose(-1, -2) / T
+        Rn = (spec * (1 - mask)) @ spec.conj_transpose(-1, -2) / T + eye
+        # N x F x C x C
+        Rn_inv_Rs = Rn.solve(Rs)
+        weight = Rn_inv_Rs[..., 0] / Rn_inv_Rs.masked_select(eye.bool()).view(
+            N, F, C).sum(-1, keepdim=True)
+        beam = (weight[..., None].conj() * spec).sum(-2)
+        beam.abs().mean().backward()
+        if device != "cpu":
+            th.cuda.synchronize()
+        # skip the first (warmup) iteration
+        if i:
+            cost += time.time() - start
+    return cost * 1000 / num_iters
+
+
 if __name__ == "__main__":
     for r in range(3):
-        test_add_sub_mul_div()
-        test_matmul()
-        test_for_mvdr_ops()
+        for native in [False, True]:
+            test_add_sub_mul_div(native=native)
+            test_matmul(native=native)
+            test_for_mvdr_ops(native=native)
         print(f"Round {r}: Pass")
+    for native in [False, True]:
+        backend = "native" if native else "emulated"
+        print(f"Backend {backend}: {benchmark(native):.2f}ms/iter")
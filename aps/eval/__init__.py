@@ -1,3 +1,5 @@
 from .wrapper import NnetEvaluator
 from .asr import TextPostProcessor, TextPreProcessor
 from .sse import ChunkStitcher
+from .pipeline import DecodingPipeline, dynamic_batches
+from .rescore import NbestRescorer
@@ -0,0 +1,253 @@
+# Copyright 2021 Jian Wu
+# License: Apache 2.0 (http://www.apache.org/licenses/LICENSE-2.0)
+
+import os
+import queue
+import threading
+
+import torch as th
+import torch.multiprocessing as mp
+
+from typing import Callable, Iterable, Iterator, List, Tuple, Dict, Any
+from aps.utils import get_logger
+
+logger = get_logger(__name__)
+
+DecodeFn = Callable[[List[Any]], List[Any]]
+
+
+def decode_worker(decode_fn: DecodeFn, num_threads: int, task_queue: mp.Queue,
+                  result_queue: mp.Queue) -> None:
+    """
+    Decoding worker: get batch from #task_queue and put results to #result_queue
+    """
+    th.set_num_threads(num_threads)
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        index, keys, inps = task
+        try:
+            with th.no_grad():
+                results = decode_fn(inps)
+        except Exception as err:
+            result_queue.put((index, keys, err))
+            break
+        result_queue.put((index, keys, results))
+
+
+def dynamic_batches(utt2len: Dict[str, float],
+                    max_batch_len: float,
+                    max_batch_size: int = -1) -> List[List[Tuple[int, str]]]:
+    """
+    Sort the utterances by length (long -> short) and make batches whose
+    padded length (#batch_size x max length in the batch) is not larger than
+    #max_batch_len (at least one utterance in each batch)
+    Args:
+        utt2len: utterance => length (in original order)
+        max_batch_len: budget of the padded length of one batch
+        max_batch_size: maximum #batch_size (-1 means no limitation)
+    Return:
+        batches: list of [(index, key), ...], index is the original order
+    """
+    utts = sorted(enumerate(utt2len.items()),
+                  key=lambda u: u[1][1],
+                  reverse=True)
+    batches = []
+    batch = []
+    for index, (key, utt_len) in utts:
+        # the 1st one is the longest
+        batch_len = utt2len[batch[0][1]] if batch else utt_len
+        if batch and ((len(batch) + 1) * batch_len > max_batch_len or
+                      len(batch) == max_batch_size):
+            batches.append(batch)
+            batch = []
+        batch.append((index, key))
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class DecodingPipeline(object):
+    """
+    Pipelined decoding driver: prefetching reader (thread) => length bucketed
+    batching => decoding workers => ordered outputs. On CPU, the workers are
+    forked from the main process, thus share one (copy-on-write) copy of the
+    model parameters
+
+    Args:
+        decode_fn: function that decodes a batch (list of the inputs) and
+                   returns the results of each input
+        num_workers: number of the decoding workers (processes), if <= 1,
+                     decoding runs in main process
+        batch_size: number of the inputs in one batch
+        bucket_size: number of the inputs to be sorted by length before
+                     batching (<= batch_size means no sorting)
+        prefetch: maximum number of the inputs (or batches, see run) read
+                  ahead
+        num_threads: number of the torch threads in each worker
+        time_axis: axis of the inputs used to sort them
+    """
+
+    def __init__(self,
+                 decode_fn: DecodeFn,
+                 num_workers: int = 1,
+                 batch_size: int = 1,
+                 bucket_size: int = 0,
+                 prefetch: int = 32,
+                 num_threads: int = 0,
+                 time_axis: int = -1) -> None:
+        self.decode_fn = decode_fn
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+        self.bucket_size = max(bucket_size, batch_size)
+        self.prefetch = max(prefetch, self.bucket_size)
+        if num_threads <= 0:
+            num_threads = max(1, (os.cpu_count() or 1) // max(num_workers, 1))
+        self.num_threads = num_threads
+        self.time_axis = time_axis
+
+    def _reader(self, src_iter: Iterable[Any], src_queue: queue.Queue) -> None:
+        """
+        Prefetch the inputs in background thread
+        """
+        try:
+            for item in src_iter:
+                src_queue.put(item)
+        except Exception as err:
+            # re-raised in the main thread, see _get
+            src_queue.put(err)
+        else:
+            src_queue.put(None)
+
+    def _get(self, src_queue: queue.Queue) -> Any:
+        """
+        Get one prefetched input (None if no more inputs)
+        """
+        item = src_queue.get()
+        if isinstance(item, Exception):
+            raise RuntimeError("Failed to read the inputs") from item
+        return item
+
+    def _batches(self,
+                 src_queue: queue.Queue,
+                 batched: bool = False) -> Iterator[Tuple]:
+        """
+        Make batches from the prefetched inputs (sorted by length in bucket)
+        """
+        while batched:
+            item = self._get(src_queue)
+            if item is None:
+                return
+            yield tuple(zip(*item))
+        bucket = []
+        index = 0
+        while True:
+            item = self._get(src_queue)
+            if item is not None:
+                bucket.append((index, *item))
+                index += 1
+            if len(bucket) == self.bucket_size or (item is None and bucket):
+                bucket = sorted(bucket,
+                                key=lambda b: b[-1].shape[self.time_axis],
+                                reverse=True)
+                for i in range(0, len(bucket), self.batch_size):
+                    yield tuple(zip(*bucket[i:i + self.batch_size]))
+                bucket = []
+            if item is None:
+                break
+
+    def run(self,
+            src_iter: Iterable[Any],
+            batched: bool = False) -> Iterator[Tuple[str, Any]]:
+        """
+        Decode the inputs and yield the results in the input order
+        Args:
+            src_iter: iterator of (key, input), or iterator of the batches,
+                      i.e., [(index, key, input), ...] if batched is true
+                      (index is the output order, see dynamic_batches)
+            batched: src_iter yields the batches or not
+        Return:
+            iterator of (key, result)
+        """
+        workers = []
+        if self.num_workers > 1:
+            # NOTE: fork the workers before starting the reader thread
+            ctx = mp.get_context("fork")
+            task_queue = ctx.Queue(maxsize=self.num_workers * 2)
+            result_queue = ctx.Queue()
+            workers = [
+                ctx.Process(target=decode_worker,
+                            args=(self.decode_fn, self.num_threads, task_queue,
+                                  result_queue),
+                            daemon=True) for _ in range(self.num_workers)
+            ]
+            for worker in workers:
+                worker.start()
+            logger.info(f"Start {self.num_workers} decoding workers, " +
+                        f"{self.num_threads} threads per worker")
+        src_queue = queue.Queue(maxsize=self.prefetch)
+        reader = threading.Thread(target=self._reader,
+                                  args=(src_iter, src_queue),
+                                  daemon=True)
+        reader.start()
+        # index => (key, result)
+        pending = {}
+        num_inps, next_index = 0, 0
+
+        def check() -> None:
+            collect(False)
+            if any(not w.is_alive() for w in workers):
+                raise RuntimeError("Decoding worker exits abnormally")
+
+        def collect(block: bool) -> None:
+            while True:
+                try:
+                    index, keys, results = result_queue.get(
+                        block=block, timeout=1 if block else None)
+                except queue.Empty:
+                    if not block:
+                        break
+                    check()
+                    continue
+                if isinstance(results, Exception):
+                    raise RuntimeError("Decoding worker failed") from results
+                pending.update(zip(index, zip(keys, results)))
+                # only block for one batch
+                block = False
+
+        done = False
+        try:
+            for index, keys, inps in self._batches(src_queue, batched=batched):
+                num_inps += len(index)
+                if workers:
+                    while True:
+                        try:
+                            task_queue.put((index, keys, inps), timeout=1)
+                            break
+                        except queue.Full:
+                            check()
+                    collect(False)
+                else:
+                    with th.no_grad():
+                        results = self.decode_fn(inps)
+                    pending.update(zip(index, zip(keys, results)))
+                while next_index in pending:
+                    yield pending.pop(next_index)
+                    next_index += 1
+            while next_index < num_inps:
+                if next_index not in pending:
+                    collect(True)
+                    continue
+                yield pending.pop(next_index)
+                next_index += 1
+            done = True
+        finally:
+            if done:
+                for _ in workers:
+                    task_queue.put(None)
+            for worker in workers:
+                if not done:
+                    worker.terminate()
+                worker.join()
+        reader.join()
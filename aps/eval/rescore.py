@@ -0,0 +1,106 @@
+# Copyright 2021 Jian Wu
+# License: Apache 2.0 (http://www.apache.org/licenses/LICENSE-2.0)
+
+import torch as th
+import torch.nn as nn
+
+from torch.nn.utils.rnn import pad_sequence
+from typing import List, Tuple
+
+
+class NbestRescorer(object):
+    """
+    Batched n-best rescoring engine for NN LMs (TorchRNNLM & TorchXfmrLM).
+    The hypotheses (from many utterances) are deduplicated and the ones that
+    are prefixes of the others are scored from the output of the longer
+    hypothesis, the rest are sorted by length and packed into padded batches
+
+    Args:
+        lm: NN LM, forward(token, hidden, token_len) => N x T x V
+        sos|eos: sos|eos ID
+        batch_size: number of the sequences in one LM forward
+        device_id: GPU-id to run the LM, -1 means running on CPU
+    """
+
+    def __init__(self,
+                 lm: nn.Module,
+                 sos: int = -1,
+                 eos: int = -1,
+                 batch_size: int = 64,
+                 device_id: int = -1) -> None:
+        if sos < 0 or eos < 0:
+            raise ValueError(f"Invalid sos/eos value: {sos}/{eos}")
+        self.lm = lm
+        self.sos, self.eos = sos, eos
+        self.batch_size = batch_size
+        self.device = th.device("cpu" if device_id < 0 else f"cuda:{device_id}")
+
+    def _dedup(self, hypos: List[List[int]]) -> Tuple[List[Tuple], List[int]]:
+        """
+        Return the sequences we need to run LM on and the index of the
+        sequence that each hypothesis is scored from
+        """
+        uniq = sorted(set(tuple(hyp) for hyp in hypos))
+        # in lexicographical order, if seq[i] is a prefix of any sequence,
+        # it's the prefix of seq[i + 1]
+        cover = list(range(len(uniq)))
+        for i in range(len(uniq) - 2, -1, -1):
+            if uniq[i + 1][:len(uniq[i])] == uniq[i]:
+                cover[i] = cover[i + 1]
+        leaves = sorted(set(cover))
+        leaf_index = {leaf: n for n, leaf in enumerate(leaves)}
+        seq_index = {seq: leaf_index[cover[i]] for i, seq in enumerate(uniq)}
+        return [uniq[i] for i in leaves], [seq_index[tuple(h)] for h in hypos]
+
+    def _score_batch(self, seqs: List[Tuple]) -> Tuple[th.Tensor, th.Tensor]:
+        """
+        Run LM on one batch
+        Return:
+            tok_score (Tensor): N x T+1, accumulated token scores
+            eos_score (Tensor): N x T+1, scores of eos after each prefix
+        """
+        # N x T+1
+        token = pad_sequence([th.as_tensor((self.sos,) + seq) for seq in seqs],
+                             batch_first=True,
+                             padding_value=self.eos).to(self.device)
+        token_len = th.tensor([len(seq) + 1 for seq in seqs],
+                              device=self.device)
+        # N x T+1 x V
+        prob, _ = self.lm(token, None, token_len)
+        prob = th.log_softmax(prob, -1)
+        # N x T
+        tok_score = th.gather(prob[:, :-1], -1, token[:, 1:, None])[..., 0]
+        tok_score = th.cumsum(tok_score, -1)
+        # N x T+1
+        tok_score = th.cat([th.zeros_like(tok_score[:, :1]), tok_score], -1)
+        return tok_score.cpu(), prob[..., self.eos].cpu()
+
+    def score(self, hypos: List[List[int]]) -> List[float]:
+        """
+        Return LM scores (with sos & eos) of the hypotheses
+        Args:
+            hypos: list of the token sequences
+        Return:
+            scores: list of the LM scores
+        """
+        if not hypos:
+            return []
+        seqs, index = self._dedup(hypos)
+        # long -> short
+        order = sorted(range(len(seqs)), key=lambda i: -len(seqs[i]))
+        # seq index => (batch index, row)
+        position = [None] * len(seqs)
+        scores = []
+        with th.no_grad():
+            for b, beg in enumerate(range(0, len(seqs), self.batch_size)):
+                batch = order[beg:beg + self.batch_size]
+                scores.append(self._score_batch([seqs[i] for i in batch]))
+                for n, i in enumerate(batch):
+                    position[i] = (b, n)
+        hyp_scores = []
+        for hyp, i in zip(hypos, index):
+            b, n = position[i]
+            tok_score, eos_score = scores[b]
+            hyp_scores.append(
+                (tok_score[n, len(hyp)] + eos_score[n, len(hyp)]).item())
+        return hyp_scores
@@ -2,10 +2,10 @@
 # License: Apache 2.0 (http://www.apache.org/licenses/LICENSE-2.0)
 
 import torch as th
-import numpy as np
+import torch.nn.functional as tf
 
-from typing import List
-from itertools import permutations
+from typing import List, Union
+from scipy.optimize import linear_sum_assignment
 
 
 class ChunkStitcher(object):
@@ -15,68 +15,100 @@ class ChunkStitcher(object):
         Chen Z, Yoshioka T, Lu L, et al. Continuous speech separation:
         dataset and analysis[C]//ICASSP 2020-2020 IEEE International Conference
         on Acoustics, Speech and Signal Processing (ICASSP). IEEE, 2020: 7284-7288.
+
+    Args:
+        chunk_len: chunk size (hop between the chunks)
+        lctx|rctx: left|right context of each chunk
+        crossfade: cross-fade the overlapped segments of the adjacent chunks
+                   instead of the hard cut-over
     """
 
-    def __init__(self, chunk_len: int, lctx: int, rctx: int) -> None:
+    def __init__(self,
+                 chunk_len: int,
+                 lctx: int,
+                 rctx: int,
+                 crossfade: bool = False) -> None:
         self.chunk_len = chunk_len
         self.lctx, self.rctx = lctx, rctx
+        self.crossfade = crossfade
 
-    def _reorder(self, pred: List[th.Tensor], succ: List[th.Tensor]):
+    def _reorder(self, chunks: th.Tensor) -> th.Tensor:
+        """
+        Fix the permutation of the streams between the adjacent chunks
+        Args:
+            chunks (Tensor): T x N x L (#chunks x #streams x chunk length)
+        Return:
+            chunks (Tensor): T x N x L (reordered)
+        """
+        overlap = self.lctx + self.rctx
         # no overlapped segment, skip
-        if self.lctx == 0:
-            return succ
-        num_streams = len(pred)
-        # overlapped segment, to work out distance
-        pred_ov = [c[-self.lctx - self.rctx:] for c in pred]
-        succ_ov = [c[:self.lctx + self.rctx] for c in succ]
-        permu_list = list(permutations(range(num_streams)))
-        dists = []
-        for permu in permu_list:
-            dists.append(
-                sum([
-                    th.abs(pred_ov[i] - succ_ov[j]).sum().item()
-                    for i, j in enumerate(permu)
-                ]))
-        permu = permu_list[np.argmin(dists)]
-        return [succ[i] for i in permu]
-
-    def _stitch_one_stream(self, chunks: List[th.Tensor],
-                           expected_length: int) -> th.Tensor:
-        stream = th.zeros(expected_length)
-        for i, chunk in enumerate(chunks):
-            beg = i * self.chunk_len + self.lctx
-            if i == 0:
-                stream[:beg + self.chunk_len] = chunk[:beg + self.chunk_len]
-            elif i == len(chunks) - 1:
-                last_len = min(expected_length - beg,
-                               chunk.shape[-1] - self.lctx)
-                stream[beg:beg + last_len] = chunk[self.lctx:self.lctx +
-                                                   last_len]
-            else:
-                stream[beg:beg + self.chunk_len] = chunk[self.lctx:self.lctx +
-                                                         self.chunk_len]
-        return stream
+        if overlap == 0 or chunks.shape[1] == 1:
+            return chunks
+        # distance between the overlapped segments: T-1 x N x N
+        dists = th.cdist(chunks[:-1, :, -overlap:],
+                         chunks[1:, :, :overlap],
+                         p=1).numpy()
+        # streams in chunk t => streams in chunk 0
+        permu = list(range(chunks.shape[1]))
+        index = [permu]
+        for dist in dists:
+            # stream i (chunk t) matches stream succ[i] (chunk t + 1)
+            _, succ = linear_sum_assignment(dist)
+            permu = [succ[i] for i in permu]
+            index.append(permu)
+        index = th.tensor(index, dtype=th.int64)
+        return th.gather(chunks, 1, index[..., None].expand_as(chunks))
 
-    def _stitch_multiple_streams(self, chunks: List[List[th.Tensor]],
-                                 expected_length: int):
-        num_streams = len(chunks[-1])
-        stream_chunks = []
-        # fix possible permutation problems
-        for i, chunk in enumerate(chunks):
-            if i:
-                chunk = self._reorder(stream_chunks[-1], chunk)
-            stream_chunks.append(chunk)
-        return [
-            self._stitch_one_stream([s[i]
-                                     for s in stream_chunks], expected_length)
-            for i in range(num_streams)
-        ]
-
-    def stitch(self, chunks: List, expected_length: int):
-        num_streams = 1
-        if not isinstance(chunks[-1], th.Tensor):
-            num_streams = len(chunks[-1])
-        if num_streams == 1:
-            return self._stitch_one_stream(chunks, expected_length)
+    def _window(self, num_chunks: int, chunk_len: int) -> th.Tensor:
+        """
+        Return weight of each sample in the chunks: T x L
+        """
+        window = th.zeros(num_chunks, chunk_len)
+        if self.crossfade and self.lctx + self.rctx:
+            overlap = self.lctx + self.rctx
+            ramp = (th.arange(overlap) + 0.5) / overlap
+            window[:] = 1
+            window[1:, :overlap] *= ramp
+            window[:-1, -overlap:] *= 1 - ramp
         else:
-            return self._stitch_multiple_streams(chunks, expected_length)
+            # hard cut-over: each sample comes from one chunk
+            window[:, self.lctx:self.lctx + self.chunk_len] = 1
+            window[0, :self.lctx] = 1
+            window[-1, self.lctx + self.chunk_len:] = 1
+        return window
+
+    def stitch(self, chunks: List[Union[th.Tensor, List[th.Tensor]]],
+               expected_length: int) -> Union[th.Tensor, List[th.Tensor]]:
+        """
+        Stitch the chunks (overlap-add in one buffer)
+        Args:
+            chunks (list): list of the chunks (Tensor, L) or list of the
+                           streams in each chunk ([Tensor, ...], N x L)
+            expected_length: length of the stitched stream
+        Return:
+            stream (Tensor or [Tensor, ...]): stitched stream(s)
+        """
+        single = isinstance(chunks[-1], th.Tensor)
+        # T x N x L
+        chunks = th.stack([th.stack([c] if single else c) for c in chunks])
+        num_chunks, num_streams, chunk_len = chunks.shape
+        if chunk_len != self.lctx + self.chunk_len + self.rctx:
+            raise RuntimeError("Expect chunks of size " +
+                               f"{self.lctx + self.chunk_len + self.rctx}, " +
+                               f"got {chunk_len} instead")
+        chunks = self._reorder(chunks)
+        window = self._window(num_chunks, chunk_len)
+        # overlap & add: T x N x L => N x L x T
+        frames = (chunks * window[:, None]).permute(1, 2, 0)
+        num_samples = (num_chunks - 1) * self.chunk_len + chunk_len
+        kwargs = {
+            "output_size": (1, num_samples),
+            "kernel_size": (1, chunk_len),
+            "stride": (1, self.chunk_len)
+        }
+        # N x S
+        streams = tf.fold(frames, **kwargs)[:, 0, 0]
+        weight = tf.fold(window.T[None], **kwargs)[:, 0, 0]
+        streams = streams / th.clamp_min(weight, th.finfo(weight.dtype).eps)
+        streams = streams[:, :expected_length]
+        return streams[0] if single else list(streams)
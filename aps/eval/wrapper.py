@@ -1,10 +1,14 @@
 # Copyright 2019 Jian Wu
 # License: Apache 2.0 (http://www.apache.org/licenses/LICENSE-2.0)
 
+import os
+import json
 import yaml
 import pathlib
 
+import numpy as np
 import torch as th
+import torch.nn as nn
 
 from aps.libs import aps_transform, aps_nnet
 from aps.utils import get_logger
@@ -13,15 +17,93 @@ from typing import Dict
 logger = get_logger(__name__)
 
 
+def dump_weights(state_dict: Dict, weights: str, epoch: int = -1) -> None:
+    """
+    Dump the model weights to a flat binary file (xxx.weights) with a json
+    index (xxx.weights.json), which can be memory mapped by mmap_weights
+    """
+    index = {"epoch": epoch, "tensors": {}}
+    tmp_weights = f"{weights}.{os.getpid()}.tmp"
+    offset = 0
+    with open(tmp_weights, "wb") as bin_f:
+        for name, tensor in state_dict.items():
+            array = tensor.detach().cpu().contiguous().numpy()
+            # 64 bytes aligned
+            pad = (64 - offset % 64) % 64
+            bin_f.write(b"\0" * pad)
+            offset += pad
+            index["tensors"][name] = {
+                "dtype": array.dtype.name,
+                "shape": list(array.shape),
+                "offset": offset
+            }
+            bin_f.write(array.tobytes())
+            offset += array.nbytes
+    with open(f"{tmp_weights}.json", "w") as json_f:
+        json.dump(index, json_f)
+    # NOTE: make it atomic as several jobs may dump at the same time
+    os.replace(f"{tmp_weights}.json", f"{weights}.json")
+    os.replace(tmp_weights, weights)
+
+
+def mmap_weights(nnet: nn.Module, weights: str) -> int:
+    """
+    Let the parameters & buffers of the model point to the memory mapped
+    weight file (copy-on-write), so that processes loading the same weight
+    file share one copy in page cache
+    Return:
+        epoch: epoch of the checkpoint
+    """
+    with open(f"{weights}.json", "r") as json_f:
+        index = json.load(json_f)
+    weight_buf = np.memmap(weights, dtype=np.uint8, mode="c")
+    tensors = index["tensors"]
+    for name, tensor in nnet.state_dict().items():
+        if name not in tensors:
+            raise RuntimeError(f"Missing key {name} in {weights}")
+        stats = tensors[name]
+        dtype = np.dtype(stats["dtype"])
+        nbytes = int(np.prod(stats["shape"])) * dtype.itemsize
+        if nbytes == 0:
+            continue
+        array = weight_buf[stats["offset"]:stats["offset"] + nbytes]
+        mapped = th.from_numpy(array.view(dtype).reshape(stats["shape"]))
+        if mapped.shape != tensor.shape:
+            raise RuntimeError(f"Size mismatch for {name}: {mapped.shape} " +
+                               f"vs {tensor.shape}")
+        module_name, _, attr = name.rpartition(".")
+        module = nnet.get_submodule(module_name) if module_name else nnet
+        if attr in module._parameters:
+            module._parameters[attr].data = mapped
+        else:
+            module._buffers[attr] = mapped
+    return index["epoch"]
+
+
 def load_checkpoint(cpt_dir: str,
                     cpt_tag: str = "best",
-                    nnet_cls: object = None) -> Dict:
+                    nnet_cls: object = None,
+                    mmap: bool = False) -> Dict:
     """
     Load well trained checkpoint
+    Args:
+        cpt_dir: checkpoint directory
+        cpt_tag: tag name of the checkpoint: (tag).pt.tar
+        nnet_cls: class of the model, derived from the configuration if None
+        mmap: if true, dump the model weights to (tag).weights once and
+              memory map it (instead of loading the whole checkpoint)
     """
     cpt_dir = pathlib.Path(cpt_dir)
-    # load checkpoint
-    cpt = th.load(cpt_dir / f"{cpt_tag}.pt.tar", map_location="cpu")
+    cpt_path = cpt_dir / f"{cpt_tag}.pt.tar"
+    weights = cpt_dir / f"{cpt_tag}.weights"
+    if mmap and (not weights.exists() or
+                 weights.stat().st_mtime < cpt_path.stat().st_mtime):
+        cpt = th.load(cpt_path, map_location="cpu")
+        dump_weights(cpt["model_state"], str(weights), epoch=cpt["epoch"])
+        logger.info(f"Dump model weights to {weights}")
+    elif not mmap:
+        # load checkpoint
+        cpt = th.load(cpt_path, map_location="cpu")
     with open(cpt_dir / "train.yaml", "r") as f:
         conf = yaml.full_load(f)
     if nnet_cls is None:
@@ -47,9 +129,13 @@ def load_checkpoint(cpt_dir: str,
     else:
         nnet = nnet_cls(**conf["nnet_conf"])
 
-    nnet.load_state_dict(cpt["model_state"])
+    if mmap:
+        epoch = mmap_weights(nnet, str(weights))
+    else:
+        nnet.load_state_dict(cpt["model_state"])
+        epoch = cpt["epoch"]
     return {
-        "epoch": cpt["epoch"],
+        "epoch": epoch,
         "accept_raw": accept_raw,
         "nnet": nnet,
         "conf": conf
@@ -59,14 +145,28 @@ def load_checkpoint(cpt_dir: str,
 class NnetEvaluator(object):
     """
     A simple wrapper for the model evaluation
+
+    Args:
+        cpt_dir: checkpoint directory
+        cpt_tag: tag name of the checkpoint: (tag).pt.tar
+        device_id: GPU-id to offload model to, -1 means running on CPU
+        mmap: memory map the model weights (CPU only), thus the processes
+              (e.g., parallel decoding jobs) share one copy of the weights
+        num_threads: if > 0, number of the intra-op threads used by torch
     """
 
     def __init__(self,
                  cpt_dir: str,
                  cpt_tag: str = "best",
-                 device_id: int = -1) -> None:
+                 device_id: int = -1,
+                 mmap: bool = False,
+                 num_threads: int = 0) -> None:
+        if num_threads > 0:
+            th.set_num_threads(num_threads)
         # load nnet
-        stats = load_checkpoint(cpt_dir, cpt_tag=cpt_tag)
+        stats = load_checkpoint(cpt_dir,
+                                cpt_tag=cpt_tag,
+                                mmap=mmap and device_id < 0)
         self.conf = stats["conf"]
         self.nnet = stats["nnet"]
         self.accept_raw = stats["accept_raw"]
@@ -5,22 +5,37 @@
 
 import io
 import os
+import re
+import json
+import struct
 import subprocess
 import warnings
+import threading
+import concurrent.futures as futures
 
 import numpy as np
 import soundfile as sf
 import scipy.signal as ss
 
-from collections import defaultdict
+from collections import defaultdict, deque
 from kaldi_python_io import Reader as BaseReader
-from typing import Optional, IO, Union, Any, NoReturn, Dict
+from typing import Optional, IO, Union, Any, NoReturn, Dict, Tuple, List, Iterator
 
 __all__ = [
     "read_audio", "write_audio", "group_segments", "add_room_response",
-    "AudioReader", "SegmentAudioReader"
+    "AudioReader", "SegmentAudioReader", "PackedAudioWriter",
+    "PackedAudioArchive"
 ]
 
+# magic number of the packed audio archive
+PACK_MAGIC = b"APSPACK\x00"
+# magic (8B) + index offset (8B) + index size (8B)
+PACK_HEADER = struct.Struct("<8sQQ")
+# alignment of the audio samples in the packed archive
+PACK_ALIGN = 64
+# scale between the int16 PCM samples and the normalized ones (as soundfile)
+INT16_SCALE = 32768
+
 
 def read_audio(fname: Union[str, IO[Any]],
                beg: int = 0,
@@ -54,6 +69,36 @@ def read_audio(fname: Union[str, IO[Any]],
     return samps
 
 
+def wav_header(fobj: IO[Any]) -> Optional[Tuple[int, int]]:
+    """
+    Parse the RIFF/WAV header from current position of the file object
+    Return:
+        (nsamps, sr) or None if it's not a PCM wave
+    """
+    riff = fobj.read(12)
+    if len(riff) != 12 or riff[:4] != b"RIFF" or riff[8:] != b"WAVE":
+        return None
+    channels, bits, sr = -1, -1, -1
+    while True:
+        chunk = fobj.read(8)
+        if len(chunk) != 8:
+            return None
+        chunk_id, chunk_size = struct.unpack("<4sI", chunk)
+        if chunk_id == b"fmt ":
+            fmt = fobj.read(chunk_size)
+            if len(fmt) < 16:
+                return None
+            _, channels, sr, _, _, bits = struct.unpack("<HHIIHH", fmt[:16])
+            # chunks are word aligned
+            fobj.seek(chunk_size % 2, os.SEEK_CUR)
+        elif chunk_id == b"data":
+            if channels <= 0 or bits <= 0:
+                return None
+            return chunk_size // (channels * bits // 8), sr
+        else:
+            fobj.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+
 def write_audio(fname: Union[str, IO[Any]],
                 samps: np.ndarray,
                 sr: int = 16000,
@@ -139,6 +184,175 @@ def add_room_response(spk: np.ndarray,
         return revb, early_revb, np.mean(revb[0]**2)
 
 
+def _pcm_convert(samps: np.ndarray, norm: bool = True) -> np.ndarray:
+    """
+    Convert the samples stored in the packed archive to the format that
+    read_audio() returns (float32, normalized to (-1, 1) if norm is true)
+    """
+    if samps.dtype == np.int16:
+        samps = samps.astype("float32")
+        return samps / INT16_SCALE if norm else samps
+    if norm:
+        # copy out of the (read-only) memory map
+        return np.array(samps)
+    return samps * INT16_SCALE
+
+
+class PackedAudioWriter(object):
+    """
+    Writer of the packed audio archive, which looks like:
+        [magic, index offset, index size] (header)
+        [samples of utt-1, samples of utt-2, ...] (data, N x C, aligned)
+        {key: [offset, nsamps, channels, dtype], ...} (index, json)
+    The samples are stored as raw PCM values so that they can be memory
+    mapped and sliced without decoding (see PackedAudioArchive)
+
+    Args:
+        pack: path of the archive
+        scp: path of the output audio script (optional)
+        sr: sample rate of the audio
+        dtype: sample type stored in the archive (int16 or float32)
+    """
+
+    def __init__(self,
+                 pack: str,
+                 scp: str = "",
+                 sr: int = 16000,
+                 dtype: str = "int16") -> None:
+        if dtype not in ["int16", "float32"]:
+            raise ValueError(f"Unsupported dtype: {dtype}")
+        self.pack_path = pack
+        self.pack_file = open(pack, "wb")
+        self.scp_file = open(scp, "w") if scp else None
+        self.sr = sr
+        self.dtype = dtype
+        self.index = {}
+        # placeholder of the header
+        self.pack_file.write(PACK_HEADER.pack(PACK_MAGIC, 0, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, key: str, samps: np.ndarray, norm: bool = True) -> int:
+        """
+        Write C x N or N audio samples to the archive and return the offset
+        Args:
+            key: utterance key
+            samps: audio samples, C x N or N
+            norm: samples are normalized between -1 and 1 or not
+        """
+        if key in self.index:
+            raise ValueError(f"Duplicate key \'{key}\' in {self.pack_path}")
+        if samps.ndim not in [1, 2]:
+            raise RuntimeError(f"Expect 1/2D audio samples, got {samps.ndim}D")
+        # C x N => N x C
+        samps = samps[None, ...] if samps.ndim == 1 else samps
+        samps = np.transpose(samps)
+        if self.dtype == "int16":
+            samps = samps * INT16_SCALE if norm else samps
+            samps = np.clip(samps, -INT16_SCALE, INT16_SCALE - 1)
+        else:
+            samps = samps if norm else samps / INT16_SCALE
+        samps = np.ascontiguousarray(samps, dtype=self.dtype)
+        # align the samples
+        offset = self.pack_file.tell()
+        padding = -offset % PACK_ALIGN
+        self.pack_file.write(b"\0" * padding)
+        offset += padding
+        self.pack_file.write(samps.tobytes())
+        self.index[key] = [offset, samps.shape[0], samps.shape[1], self.dtype]
+        if self.scp_file:
+            self.scp_file.write(f"{key}\t{self.pack_path}:{offset}\n")
+        return offset
+
+    def close(self) -> None:
+        if self.pack_file.closed:
+            return
+        index = json.dumps({"sr": self.sr, "utts": self.index}).encode()
+        index_offset = self.pack_file.tell()
+        self.pack_file.write(index)
+        self.pack_file.seek(0)
+        self.pack_file.write(
+            PACK_HEADER.pack(PACK_MAGIC, index_offset, len(index)))
+        self.pack_file.close()
+        if self.scp_file:
+            self.scp_file.close()
+
+
+class PackedAudioArchive(object):
+    """
+    Reader of the packed audio archive (written by PackedAudioWriter). The
+    archive is memory mapped (lazily, in each process) so reading is just
+    array slicing, which is safe to share among the dataloader workers
+
+    Args:
+        pack: path of the archive
+    """
+
+    def __init__(self, pack: str) -> None:
+        self.pack_path = pack
+        with open(pack, "rb") as pack_file:
+            magic, index_offset, index_size = PACK_HEADER.unpack(
+                pack_file.read(PACK_HEADER.size))
+            if magic != PACK_MAGIC:
+                raise RuntimeError(f"{pack} is not a packed audio archive")
+            pack_file.seek(index_offset)
+            index = json.loads(pack_file.read(index_size))
+        self.sr = index["sr"]
+        self.index = index["utts"]
+        self.offset2key = {v[0]: k for k, v in self.index.items()}
+        self.mmap = None
+
+    @staticmethod
+    def is_packed(pack: str) -> bool:
+        """
+        Check whether the file is a packed audio archive
+        """
+        with open(pack, "rb") as pack_file:
+            return pack_file.read(len(PACK_MAGIC)) == PACK_MAGIC
+
+    def __getstate__(self) -> Dict:
+        # do not pickle the memory mapped object
+        state = self.__dict__.copy()
+        state["mmap"] = None
+        return state
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def nsamps(self, key: str) -> int:
+        return self.index[key][1]
+
+    def read(self,
+             key: str,
+             beg: int = 0,
+             end: Optional[int] = None) -> np.ndarray:
+        """
+        Return samples in range [beg, end) of the utterance as a C x N or N
+        ndarray (view of the memory mapped archive, no copy)
+        """
+        if self.mmap is None:
+            self.mmap = np.memmap(self.pack_path, dtype=np.uint8, mode="r")
+        offset, N, C, dtype = self.index[key]
+        end = N if end is None else min(end, N)
+        beg = min(beg, end)
+        dtype = np.dtype(dtype)
+        stride = C * dtype.itemsize
+        buf = self.mmap[offset + beg * stride:offset + end * stride]
+        # N x C => C x N
+        samps = np.transpose(buf.view(dtype).reshape(end - beg, C))
+        return samps[0] if C == 1 else samps
+
+    def __getitem__(self, key: str) -> np.ndarray:
+        return self.read(key)
+
+
 class AudioReader(BaseReader):
     """
     Sequential/Random Reader for single/multiple channel audio using soundfile as the backend
@@ -153,13 +367,25 @@ class AudioReader(BaseReader):
     or
         key1 /path/to/ark1:XXXX
         key2 /path/to/ark1:XXXY
+    (Kaldi's archive or the packed audio archive written by PackedAudioWriter)
     are supported
 
+    The number of samples (nsamps/duration) is derived from the audio headers
+    (or index of the packed audio archive) without decoding if possible, and
+    cached in #meta_cache (keyed by path & mtime) if assigned
+
+    If #num_threads > 1, the sequential iteration decodes the audio (and runs
+    the commands of the pipe entries) in a thread pool, keeping at most
+    #prefetch utterances in flight, while the keys are yielded in order
+
     Args:
         wav_scp: path of the audio script
         sr: sample rate of the audio
         norm: normalize audio samples between (-1, 1) if true
         channel: read audio at #channel if > 0 (-1 means all)
+        meta_cache: path of the (json) cache file of the number of samples
+        num_threads: number of the reader threads for sequential iteration
+        prefetch: maximum number of the utterances read ahead
     """
 
     def __init__(self,
@@ -167,33 +393,93 @@ class AudioReader(BaseReader):
                  sr: int = 16000,
                  norm: bool = True,
                  channel: int = -1,
-                 failed_if_error: bool = True) -> None:
+                 failed_if_error: bool = True,
+                 meta_cache: str = "",
+                 num_threads: int = 1,
+                 prefetch: int = 16) -> None:
         super(AudioReader, self).__init__(wav_scp, num_tokens=2)
         self.sr = sr
         self.ch = channel
         self.norm = norm
+        self.num_threads = num_threads
+        self.prefetch = max(prefetch, num_threads)
         self.mngr = {}
+        self.lock = threading.Lock()
         self.failed_if_error = failed_if_error
+        self.meta_cache = meta_cache
+        # value in wav.scp => [mtime, nsamps]
+        self.meta = {}
+        if meta_cache and os.path.exists(meta_cache):
+            with open(meta_cache, "r") as cache:
+                self.meta = json.load(cache)
 
-    def _load(self, key: str) -> Optional[np.ndarray]:
-        fname = self.index_dict[key]
-        samps = None
-        # return C x N or N
-        if ".ark:" in fname:
-            tokens = fname.split(":")
-            if len(tokens) != 2:
-                raise RuntimeError(f"Value format error: {fname}")
-            fname, offset = tokens[0], int(tokens[1])
-            # get ark object
-            if fname not in self.mngr:
+    def __getstate__(self) -> Dict:
+        # file objects & lock can not be shared among processes
+        state = self.__dict__.copy()
+        state["mngr"] = {}
+        state["lock"] = None
+        return state
+
+    def __setstate__(self, state: Dict) -> None:
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def _archive(self, fname: str) -> Union[IO[Any], PackedAudioArchive]:
+        """
+        Return the archive object (opened once)
+        """
+        if fname not in self.mngr:
+            if PackedAudioArchive.is_packed(fname):
+                pack = PackedAudioArchive(fname)
+                if self.sr > 0 and self.sr != pack.sr:
+                    raise RuntimeError(
+                        f"Expect sr={self.sr} of {fname}, get {pack.sr} instead"
+                    )
+                self.mngr[fname] = pack
+            else:
                 self.mngr[fname] = open(fname, "rb")
-            wav_ark = self.mngr[fname]
-            # seek and read. TODO: need lock here?
-            wav_ark.seek(offset)
+        return self.mngr[fname]
+
+    def _read_archive(self,
+                      key: str,
+                      fname: str,
+                      offset: int,
+                      beg: int = 0,
+                      end: Optional[int] = None) -> Optional[np.ndarray]:
+        """
+        Read audio from the archive: fname:offset
+        """
+        with self.lock:
+            archive = self._archive(fname)
+        if isinstance(archive, PackedAudioArchive):
+            if offset not in archive.offset2key:
+                warnings.warn(f"Read audio {key} {fname}:{offset} failed ...")
+                return None
+            samps = archive.read(archive.offset2key[offset], beg=beg, end=end)
+            return _pcm_convert(samps, norm=self.norm)
+        # the file object is shared, so seek & read under the lock
+        with self.lock:
+            archive.seek(offset)
             try:
-                samps = read_audio(wav_ark, norm=self.norm, sr=self.sr)
+                samps = read_audio(archive, norm=self.norm, sr=self.sr)
             except RuntimeError:
                 warnings.warn(f"Read audio {key} {fname}:{offset} failed ...")
+                return None
+        return samps[..., beg:end]
+
+    def _load(self,
+              key: str,
+              beg: int = 0,
+              end: Optional[int] = None) -> Optional[np.ndarray]:
+        fname = self.index_dict[key]
+        samps = None
+        # return C x N or N
+        archived = re.match(r"^(.+):(\d+)$", fname)
+        if archived:
+            fname, offset = archived.group(1), int(archived.group(2))
+            samps = self._read_archive(key, fname, offset, beg=beg, end=end)
+        elif ".ark:" in fname:
+            raise RuntimeError(f"Value format error: {fname}")
         else:
             if fname[-1] == "|":
                 # run command
@@ -210,7 +496,11 @@ class AudioReader(BaseReader):
                         f"command \"{fname[:-1]}\":\n{stderr_str}\n")
                 fname = io.BytesIO(stdout)
             try:
-                samps = read_audio(fname, norm=self.norm, sr=self.sr)
+                samps = read_audio(fname,
+                                   beg=beg,
+                                   end=end,
+                                   norm=self.norm,
+                                   sr=self.sr)
             except RuntimeError:
                 warnings.warn(f"Load audio {key} {fname} failed ...")
         if samps is None:
@@ -223,13 +513,121 @@ class AudioReader(BaseReader):
             samps = samps[self.ch]
         return samps
 
+    def iter_keys(
+            self,
+            keys: List[str]) -> Iterator[Tuple[str, Optional[np.ndarray]]]:
+        """
+        Yield (key, samples) of the given keys in order (prefetched in the
+        thread pool if #num_threads > 1)
+        """
+        if self.num_threads <= 1:
+            for key in keys:
+                yield key, self._load(key)
+            return
+        pending = deque()
+        pool = futures.ThreadPoolExecutor(max_workers=self.num_threads)
+        try:
+            for key in keys:
+                pending.append((key, pool.submit(self._load, key)))
+                if len(pending) >= self.prefetch:
+                    done_key, job = pending.popleft()
+                    yield done_key, job.result()
+            while pending:
+                done_key, job = pending.popleft()
+                yield done_key, job.result()
+        finally:
+            # stopped early (or failed), drop the pending jobs
+            for _, job in pending:
+                job.cancel()
+            pool.shutdown(wait=True)
+
+    def __iter__(self) -> Iterator[Tuple[str, Optional[np.ndarray]]]:
+        return self.iter_keys(self.index_keys)
+
+    def read(self,
+             key: str,
+             beg: int = 0,
+             end: Optional[int] = None) -> Optional[np.ndarray]:
+        """
+        Read samples in range [beg, end) of the utterance (only the
+        required part is loaded if possible)
+        """
+        if key not in self.index_dict:
+            raise KeyError(f"Missing utterance {key}!")
+        return self._load(key, beg=beg, end=end)
+
+    def _header_nsamps(self, fname: str) -> Optional[int]:
+        """
+        Return number of samples from the audio header (None if failed)
+        """
+        archived = re.match(r"^(.+):(\d+)$", fname)
+        if archived:
+            fname, offset = archived.group(1), int(archived.group(2))
+            with self.lock:
+                archive = self._archive(fname)
+            if isinstance(archive, PackedAudioArchive):
+                if offset not in archive.offset2key:
+                    return None
+                return archive.nsamps(archive.offset2key[offset])
+            # use a new file object (without lock)
+            with open(fname, "rb") as ark:
+                ark.seek(offset)
+                header = wav_header(ark)
+            if header is None:
+                return None
+            nsamps, sr = header
+        else:
+            try:
+                info = sf.info(fname)
+            except RuntimeError:
+                return None
+            nsamps, sr = info.frames, info.samplerate
+        if self.sr > 0 and sr != self.sr:
+            raise RuntimeError(f"Expect sr={self.sr} of {fname}, " +
+                               f"get {sr} instead")
+        return nsamps
+
     def nsamps(self, key: str) -> int:
         """
-        Number of samples
+        Number of samples (from audio header if possible)
         """
+        fname = self.index_dict[key]
+        if fname[-1] != "|":
+            archived = re.match(r"^(.+):(\d+)$", fname)
+            mtime = os.stat(
+                archived.group(1) if archived else fname).st_mtime_ns
+            if fname in self.meta and self.meta[fname][0] == mtime:
+                return self.meta[fname][1]
+            nsamps = self._header_nsamps(fname)
+            if nsamps is not None:
+                self.meta[fname] = [mtime, nsamps]
+                return nsamps
         data = self._load(key)
         return data.shape[-1]
 
+    def utt2nsamps(self, num_threads: int = 8) -> Dict[str, int]:
+        """
+        Return number of samples of all the utterances (reading headers
+        in a thread pool) and update the cache file
+        """
+        with futures.ThreadPoolExecutor(max_workers=num_threads) as pool:
+            nsamps = pool.map(self.nsamps, self.index_keys)
+            utt2nsamps = dict(zip(self.index_keys, nsamps))
+        self.dump_meta()
+        return utt2nsamps
+
+    def dump_meta(self) -> None:
+        """
+        Dump the cached number of samples to #meta_cache
+        """
+        if not self.meta_cache:
+            return
+        tmp_cache = f"{self.meta_cache}.{os.getpid()}.tmp"
+        with open(tmp_cache, "w") as cache:
+            json.dump(self.meta, cache)
+        # atomic, in case of multiple processes working on it
+        os.replace(tmp_cache, self.meta_cache)
+
     def power(self, key: str) -> float:
         """
         Power of utterance
@@ -261,11 +659,15 @@ class SegmentAudioReader(object):
                  segment: str,
                  sr: int = 16000,
                  norm: bool = True,
-                 channel: int = -1):
+                 channel: int = -1,
+                 num_threads: int = 1,
+                 prefetch: int = 16):
         self.audio_reader = AudioReader(wav_scp,
                                         sr=sr,
                                         norm=norm,
-                                        channel=channel)
+                                        channel=channel,
+                                        num_threads=num_threads,
+                                        prefetch=prefetch)
         self.segment = group_segments(segment, sr, wav_scp=wav_scp)
 
     def __len__(self):
@@ -275,8 +677,7 @@ class SegmentAudioReader(object):
         """
         Sequential access
         """
-        for utt_key in self.segment:
-            audio = self.audio_reader[utt_key]
+        for utt_key, audio in self.audio_reader.iter_keys(list(self.segment)):
             # segments on utterance: utt_key
             for info in self.segment[utt_key]:
                 seg_key, beg, end = info
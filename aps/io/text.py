@@ -5,7 +5,7 @@
 
 import codecs
 
-from typing import List
+from typing import List, Tuple, Iterator
 from kaldi_python_io import Reader as BaseReader
 
 
@@ -34,35 +34,34 @@ class TextReader(BaseReader):
 
 class NbestReader(object):
     """
-    N-best hypothesis reader
+    N-best hypothesis reader (parse the n-best file on the fly)
     """
 
     def __init__(self, nbest: str):
-        self.nbest, self.hypos = self._load_nbest(nbest)
+        self.nbest_file = nbest
+        with codecs.open(nbest, "r", encoding="utf-8") as fd:
+            self.nbest = int(fd.readline().strip())
+            num_lines = sum(1 for _ in fd)
+        if num_lines % (self.nbest + 1) != 0:
+            raise RuntimeError("Seems that nbest format is wrong")
+        self.num_utts = num_lines // (self.nbest + 1)
 
     def __len__(self) -> int:
-        return len(self.hypos)
-
-    def __iter__(self):
-        return iter(self.hypos.items())
+        return self.num_utts
 
-    def _load_nbest(self, nbest: str):
-        hypos = {}
-        with codecs.open(nbest, "r", encoding="utf-8") as fd:
-            all_lines = fd.readlines()
-        nbest = int(all_lines[0].strip())
-        if (len(all_lines) - 1) % (nbest + 1) != 0:
-            raise RuntimeError("Seems that nbest format is wrong")
-        n = 1
-        while n < len(all_lines):
-            key = all_lines[n].strip()
-            topk = []
-            for i in range(nbest):
-                items = all_lines[n + 1 + i].strip().split()
-                score = float(items[0])
-                num_tokens = int(items[1])
-                trans = " ".join(items[2:])
-                topk.append((score, num_tokens, trans))
-            n += nbest + 1
-            hypos[key] = topk
-        return nbest, hypos
+    def __iter__(self) -> Iterator[Tuple[str, List[Tuple[float, int, str]]]]:
+        with codecs.open(self.nbest_file, "r", encoding="utf-8") as fd:
+            # skip the first line (#nbest)
+            fd.readline()
+            while True:
+                key = fd.readline()
+                if not key:
+                    break
+                topk = []
+                for _ in range(self.nbest):
+                    items = fd.readline().strip().split()
+                    score = float(items[0])
+                    num_tokens = int(items[1])
+                    trans = " ".join(items[2:])
+                    topk.append((score, num_tokens, trans))
+                yield key.strip(), topk
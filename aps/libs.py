@@ -80,7 +80,7 @@ class ApsModules(object):
     ]
     loader_submodules = [
         "am.kaldi", "am.raw", "am.simu_cmd", "se.chunk", "se.simu_cmd",
-        "se.config", "lm.utt", "lm.bptt"
+        "se.config", "lm.utt", "lm.bptt", "lm.shard"
     ]
     asr = Module("aps.asr", asr_submodules)
     sse = Module("aps.sse", sse_submodules)
@@ -31,6 +31,7 @@ def DataLoader(train: bool = True,
                max_token_num: int = 400,
                adapt_token_num: int = 150,
                skip_utts: str = "",
+               manifest_dir: str = "",
                batch_mode: str = "adaptive",
                num_workers: int = 0,
                max_batch_size: int = 32,
@@ -43,6 +44,7 @@ def DataLoader(train: bool = True,
         text: path of the text/token file
         utt2num_frames: path of the utt2num_frames file
         skip_utts: skips utterances if the key is in this file
+        manifest_dir: directory to cache the preprocessed text/duration manifest
         vocab_dict: vocabulary dictionary
         tokenizer: tokenizer name (for on-the-fly tokenizing)
         tokenizer_kwargs: argument options for tokenizer
@@ -65,6 +67,7 @@ def DataLoader(train: bool = True,
                                min_dur=min_frame_num,
                                dur_axis=0,
                                skip_utts=skip_utts,
+                               manifest_dir=manifest_dir,
                                min_token_num=min_token_num,
                                max_token_num=max_token_num)
     return CommonASRDataLoader(dataset,
@@ -6,11 +6,14 @@
 Dataloader for raw waveforms in asr tasks
 """
 import torch as th
+import torch.nn as nn
 
+from functools import partial
 from torch.nn.utils.rnn import pad_sequence
 from typing import Dict, Iterable, Optional
 from aps.loader.am.utils import CommonASRDataset, CommonASRDataLoader
 from aps.io.audio import AudioReader
+from aps.transform.asr import SpeedPerturbTransform
 from aps.const import IGNORE_ID
 from aps.libs import ApsRegisters
 
@@ -33,7 +36,9 @@ def DataLoader(train: bool = True,
                adapt_dur: float = 8,
                adapt_token_num: int = 150,
                skip_utts: str = "",
+               manifest_dir: str = "",
                batch_mode: str = "adaptive",
+               speed_perturb: str = "",
                num_workers: int = 0,
                max_batch_size: int = 32,
                min_batch_size: int = 4) -> Iterable[Dict]:
@@ -51,10 +56,17 @@ def DataLoader(train: bool = True,
         tokenizer: tokenizer name (for on-the-fly tokenizer)
         tokenizer_kwargs: argument options for tokenizer
         skip_utts: skips utterances that the file shows
+        manifest_dir: directory to cache the preprocessed text/duration manifest
         {min|max}_token_num: filter the utterances if the token number not in [#min_token_num, #max_token_num]
         {min|max}_dur: discard utterance when #num_frames is not in [#min_dur, #max_dur]
         adapt_dur|adapt_token_num: used in adaptive mode
         batch_mode: adaptive or constraint
+        speed_perturb: speed perturb factors, e.g., 0.9,1.0,1.1, if not empty,
+                       we do speed perturb on CPU (in the dataloader workers)
+                       instead of in the asr_transform (remove "perturb" from
+                       the feats of the asr_transform then). It's processed
+                       utterance by utterance here, as the grouped conv1d
+                       only pays off on GPU (see perturb_speed_batch)
         num_workers: number of the workers
         max_batch_size: maximum #batch_size
         min_batch_size: minimum #batch_size
@@ -70,10 +82,17 @@ def DataLoader(train: bool = True,
                                min_dur=min_dur,
                                dur_axis=0,
                                skip_utts=skip_utts,
+                               manifest_dir=manifest_dir,
                                min_token_num=min_token_num,
                                max_token_num=max_token_num)
+    if speed_perturb and train:
+        collate = partial(egs_collate,
+                          speed_perturb=SpeedPerturbTransform(
+                              sr=sr, perturb=speed_perturb))
+    else:
+        collate = egs_collate
     return CommonASRDataLoader(dataset,
-                               egs_collate,
+                               collate,
                                shuffle=train,
                                distributed=distributed,
                                num_workers=num_workers,
@@ -84,9 +103,10 @@ def DataLoader(train: bool = True,
                                min_batch_size=min_batch_size)
 
 
-def egs_collate(egs: Dict) -> Dict:
+def egs_collate(egs: Dict, speed_perturb: Optional[nn.Module] = None) -> Dict:
     """
-    Batch collate function, return dict object with keys:
+    Batch collate function (with optional speed perturb), return dict object
+    with keys:
         #utt: batch size, int
         #tok: token size, int
         src_pad: raw waveforms, N x (C) x S
@@ -108,17 +128,22 @@ def egs_collate(egs: Dict) -> Dict:
             pad_mat = pad_mat.transpose(1, 2)
         return pad_mat
 
+    src_pad = pad_seq([th.from_numpy(eg["inp"]) for eg in egs], value=0)
+    src_len = th.tensor([eg["dur"] for eg in egs], dtype=th.int64)
+    if speed_perturb is not None:
+        src_pad = speed_perturb(src_pad)
+        src_len = speed_perturb.output_length(src_len)
     egs = {
         "#utt":
             len(egs),
         "#tok":  # add 1 as during training we pad sos
             sum([int(eg["len"]) + 1 for eg in egs]),
         "src_pad":
-            pad_seq([th.from_numpy(eg["inp"]) for eg in egs], value=0),
+            src_pad,
         "tgt_pad":
             pad_seq([th.as_tensor(eg["ref"]) for eg in egs], value=IGNORE_ID),
         "src_len":
-            th.tensor([eg["dur"] for eg in egs], dtype=th.int64),
+            src_len,
         "tgt_len":
             th.tensor([eg["len"] for eg in egs], dtype=th.int64)
     }
@@ -51,6 +51,7 @@ def DataLoader(train: bool = True,
                adapt_dur: float = 8,
                adapt_token_num: int = 150,
                skip_utts: str = "",
+               manifest_dir: str = "",
                batch_mode: str = "adaptive",
                num_workers: int = 0,
                max_batch_size: int = 32,
@@ -70,6 +71,7 @@ def DataLoader(train: bool = True,
         {min|max}_dur: discard utterance when audio length is not in [#min_dur, #max_dur]
         adapt_dur|adapt_token_num: used in adaptive mode
         skip_utts: skips utterances that the file shows
+        manifest_dir: directory to cache the preprocessed text/duration manifest
         batch_mode: adaptive or constraint
         num_workers: number of the workers
         max_batch_size: maximum #batch_size
@@ -86,6 +88,7 @@ def DataLoader(train: bool = True,
                                min_dur=min_dur,
                                dur_axis=-1,
                                skip_utts=skip_utts,
+                               manifest_dir=manifest_dir,
                                min_token_num=min_token_num,
                                max_token_num=max_token_num)
     return CommonASRDataLoader(dataset,
@@ -3,12 +3,19 @@
 # Copyright 2019 Jian Wu
 # License: Apache 2.0 (http://www.apache.org/licenses/LICENSE-2.0)
 
+import os
+import json
+import shutil
+import hashlib
 import warnings
+
+import numpy as np
 import torch as th
 
 import torch.utils.data as dat
 import aps.distributed as dist
 
+from itertools import chain
 from aps.tokenizer import Tokenizer
 from typing import Dict, List, Tuple, NoReturn, Optional, Callable
 from kaldi_python_io import Reader as BaseReader
@@ -52,6 +59,7 @@ class CommonASRDataset(dat.Dataset):
         skip_utts: skips utterances that the file shows
         {min|max}_token_num: filter the utterances if the token number not in [#min_token_num, #max_token_num]
         {min|max}_dur: filter the utterances when length is not in [#min_wav_dur, #max_wav_dur]
+        manifest_dir: directory to cache the preprocessed manifest (see TokenManifest)
     """
 
     def __init__(self,
@@ -66,7 +74,8 @@ class CommonASRDataset(dat.Dataset):
                  max_token_num: int = 400,
                  min_token_num: int = 2,
                  max_dur: float = 3000,
-                 min_dur: float = 40) -> None:
+                 min_dur: float = 40,
+                 manifest_dir: str = "") -> None:
         self.input_reader = input_reader
         self.token_reader = TokenReader(text,
                                         utt2dur,
@@ -77,7 +86,8 @@ class CommonASRDataset(dat.Dataset):
                                         max_dur=max_dur,
                                         min_dur=min_dur,
                                         max_token_num=max_token_num,
-                                        min_token_num=min_token_num)
+                                        min_token_num=min_token_num,
+                                        manifest_dir=manifest_dir)
         self.dur_axis = dur_axis
 
     def __getitem__(self, idx: int) -> Dict:
@@ -95,13 +105,100 @@ class CommonASRDataset(dat.Dataset):
         return len(self.token_reader)
 
 
+def file_stamp(fname: str) -> List:
+    """
+    Return [path, size, mtime] of the file (empty if not given)
+    """
+    if not fname:
+        return []
+    stat = os.stat(fname)
+    return [os.path.realpath(fname), stat.st_size, stat.st_mtime_ns]
+
+
+class TokenManifest(object):
+    """
+    Preprocessed (filtered, sorted and tokenized) manifest of the ASR dataset,
+    which is stored as flat numpy arrays:
+        keys: utterance keys, N
+        dur: duration of the utterances, N
+        len: number of the tokens, N
+        tok: token ids of all utterances, sum(len)
+        offset: begin position of the utterance in tok, N
+    and loaded with mmap so that it's shared among the processes
+
+    Args:
+        manifest_dir: directory of the manifest
+    """
+    fields = ["keys", "dur", "len", "tok", "offset"]
+
+    def __init__(self, manifest_dir: str) -> None:
+        for field in self.fields:
+            arr = np.load(os.path.join(manifest_dir, f"{field}.npy"),
+                          mmap_mode="r")
+            setattr(self, field, arr)
+
+    @staticmethod
+    def digest(**kwargs) -> str:
+        """
+        Return the hash string of the manifest settings
+        """
+        settings = json.dumps(kwargs, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha1(settings.encode()).hexdigest()
+
+    @classmethod
+    def dump(cls, manifest_dir: str, token_stats: List[Dict]) -> NoReturn:
+        """
+        Dump the manifest from the token statistics
+        """
+        tmp_dir = f"{manifest_dir}.tmp.{os.getpid()}"
+        os.makedirs(tmp_dir, exist_ok=True)
+        num_toks = np.array([stats["len"] for stats in token_stats],
+                            dtype=np.int32)
+        arrays = {
+            "keys":
+                np.array([stats["key"] for stats in token_stats]),
+            "dur":
+                np.array([stats["dur"] for stats in token_stats]),
+            "len":
+                num_toks,
+            "tok":
+                np.fromiter(chain.from_iterable(
+                    [stats["tok"] for stats in token_stats]),
+                            dtype=np.int32,
+                            count=num_toks.sum()),
+            "offset":
+                np.cumsum(num_toks, dtype=np.int64) - num_toks
+        }
+        for field in cls.fields:
+            np.save(os.path.join(tmp_dir, f"{field}.npy"), arrays[field])
+        try:
+            # atomic, in case of multiple processes working on it
+            os.rename(tmp_dir, manifest_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir)
+
+    def __getitem__(self, index: int) -> Dict:
+        beg = self.offset[index]
+        return {
+            "key": str(self.keys[index]),
+            "dur": self.dur[index].item(),
+            "len": self.len[index].item(),
+            "tok": self.tok[beg:beg + self.len[index]].tolist()
+        }
+
+    def __len__(self) -> int:
+        return self.keys.size
+
+
 class TokenReader(object):
     """
     The token/text reader for ASR task. It will filter utterances that:
         1) length of the token not in [min_token_num, max_token_num]
         2) length of the audio not in [min_dur, max_dur]
         3) utterance's key is in skip_utts
-    and tokenized reference files (from string tokens to int sequences)
+    and tokenized reference files (from string tokens to int sequences).
+    If manifest_dir is given, the results are cached (keyed by the input files
+    and the settings) and reused by the following runs
     """
 
     def __init__(self,
@@ -114,25 +211,68 @@ class TokenReader(object):
                  min_token_num: int = 2,
                  max_dur: float = 3000,
                  min_dur: float = 40,
-                 skip_utts: str = ""):
+                 skip_utts: str = "",
+                 manifest_dir: str = ""):
         if vocab_dict:
             self.tokenizer = Tokenizer(vocab_dict,
                                        tokenizer=tokenizer,
                                        tokenizer_kwargs=tokenizer_kwargs)
         else:
-            self.vocab_dict = None
-        self.token_stats = self._pre_process(text,
-                                             utt2dur,
-                                             max_dur=max_dur,
-                                             min_dur=min_dur,
-                                             skip_utts=skip_utts,
-                                             max_token_num=max_token_num,
-                                             min_token_num=min_token_num)
+            self.tokenizer = None
+        filter_kwargs = {
+            "max_dur": max_dur,
+            "min_dur": min_dur,
+            "skip_utts": skip_utts,
+            "max_token_num": max_token_num,
+            "min_token_num": min_token_num
+        }
+        if manifest_dir:
+            self.token_stats = self._load_manifest(
+                manifest_dir,
+                text,
+                utt2dur,
+                vocab_dict=vocab_dict,
+                tokenizer=tokenizer,
+                tokenizer_kwargs=tokenizer_kwargs,
+                **filter_kwargs)
+        else:
+            self.token_stats = self._pre_process(text, utt2dur, **filter_kwargs)
         if len(self.token_stats) < 10:
             raise RuntimeError(
                 f"Too less utterances: {len(self.token_stats)}, " +
                 "please check data configurations")
 
+    def _load_manifest(self,
+                       manifest_dir: str,
+                       text: str,
+                       utt2dur: str,
+                       vocab_dict: Optional[Dict] = None,
+                       tokenizer: str = "",
+                       tokenizer_kwargs: Dict = {},
+                       **filter_kwargs) -> TokenManifest:
+        """
+        Load the manifest from the cache (create it if not exists)
+        """
+        digest = TokenManifest.digest(text=file_stamp(text),
+                                      utt2dur=file_stamp(utt2dur),
+                                      skip_utts=file_stamp(
+                                          filter_kwargs["skip_utts"]),
+                                      vocab_dict=vocab_dict,
+                                      tokenizer=tokenizer,
+                                      tokenizer_kwargs=tokenizer_kwargs,
+                                      filter_kwargs=filter_kwargs)
+        cache_dir = os.path.join(manifest_dir, digest)
+        if not os.path.exists(cache_dir):
+            os.makedirs(manifest_dir, exist_ok=True)
+            token_stats = self._pre_process(text, utt2dur, **filter_kwargs)
+            if self.tokenizer:
+                for stats in token_stats:
+                    stats["tok"] = self.tokenizer.encode(stats["tok"])
+                    # length may change after tokenization
+                    stats["len"] = len(stats["tok"])
+            TokenManifest.dump(cache_dir, token_stats)
+        return TokenManifest(cache_dir)
+
     def _pre_process(self,
                      text: str,
                      utt2dur: str,
@@ -146,9 +286,9 @@ class TokenReader(object):
         """
         if skip_utts:
             with open(skip_utts, "r") as skip_fd:
-                skip_keys = [k.strip() for k in skip_fd.readlines()]
+                skip_keys = set([k.strip() for k in skip_fd.readlines()])
         else:
-            skip_keys = []
+            skip_keys = set()
         utt2dur = BaseReader(utt2dur, value_processor=float)
         if self.tokenizer:
             text_reader = BaseReader(text, num_tokens=-1, restrict=False)
@@ -192,6 +332,9 @@ class TokenReader(object):
         Return {key, duration, #num_of_tokens, token list}
         """
         stats = self.token_stats[index]
+        # already tokenized in the manifest
+        if isinstance(self.token_stats, TokenManifest):
+            return stats
         # if processed, skip
         if self.tokenizer and "vis" not in stats:
             # map from str sequences to int sequences
@@ -199,6 +342,15 @@ class TokenReader(object):
             stats["vis"] = True
         return stats
 
+    def stats(self, field: str) -> np.ndarray:
+        """
+        Return the given field (dur or len) of all the utterances
+        """
+        # read from the manifest arrays directly
+        if isinstance(self.token_stats, TokenManifest):
+            return np.asarray(getattr(self.token_stats, field))
+        return np.array([stats[field] for stats in self.token_stats])
+
     def __len__(self) -> int:
         """
         Return number of valid utterances
@@ -254,14 +406,13 @@ class BatchSampler(dat.Sampler):
         tot = len(dataset)
         cur_dur = 0
         idx_bz = []
+        utt2dur = dataset.token_reader.stats("dur").tolist()
         # long -> short
-        for idx in range(tot):
-            cur = dataset.token_reader[idx]
+        for idx, utt_dur in enumerate(utt2dur):
             if idx == 0:
-                if cur["dur"] > max_batch_size:
+                if utt_dur > max_batch_size:
                     raise ValueError("batch_size is smaller than maximum "
                                      "length of the utterances")
-            utt_dur = cur["dur"]
             if cur_dur < max_batch_size:
                 cur_dur += utt_dur
             else:
@@ -285,10 +436,11 @@ class BatchSampler(dat.Sampler):
         tot = len(dataset)
         cur_bz = max_batch_size
         idx_boundary = []
+        utt2dur = dataset.token_reader.stats("dur")
+        utt2len = dataset.token_reader.stats("len")
         while beg < tot:
-            cur = dataset.token_reader[beg]
-            cur_ilen = cur["dur"]
-            cur_olen = cur["len"]
+            cur_ilen = utt2dur[beg].item()
+            cur_olen = utt2len[beg].item()
             factor = max(cur_ilen // adapt_dur, (cur_olen - 1) // adapt_num)
             cur_bz = int(max(min_batch_size, max_batch_size // (1 + factor)))
             idx_boundary.append((beg, min(beg + cur_bz, tot)))
@@ -14,7 +14,7 @@ import aps.distributed as dist
 from typing import Optional, Iterable, Iterator, Dict, List, NoReturn
 from aps.loader.lm.utils import filter_utts, concat_data
 from aps.loader.am.utils import derive_indices
-from aps.loader.lm.utt import Dataset
+from aps.loader.lm.utt import make_dataset
 from aps.utils import get_logger
 from aps.libs import ApsRegisters
 
@@ -39,7 +39,7 @@ def DataLoader(text: str = "",
     """
     The BPTT dataloader for LM training
     Args:
-        text: path of the text/token file
+        text: path of the text/token file (or binary corpus, xxx.bin)
         vocab_dict: vocabulary dictionary
         tokenizer: tokenizer name (for on-the-fly tokenizer)
         tokenizer_kwargs: argument options for tokenizer
@@ -52,11 +52,11 @@ def DataLoader(text: str = "",
         min_batch_size: not used here
         num_workers: number workers used in dataloader, not used here
     """
-    dataset = Dataset(text,
-                      vocab_dict,
-                      kaldi_format=kaldi_format,
-                      tokenizer=tokenizer,
-                      tokenizer_kwargs=tokenizer_kwargs)
+    dataset = make_dataset(text,
+                           vocab_dict,
+                           kaldi_format=kaldi_format,
+                           tokenizer=tokenizer,
+                           tokenizer_kwargs=tokenizer_kwargs)
     return BpttDataloader(dataset,
                           max_batch_size,
                           bptt_size=bptt_size,
@@ -146,7 +146,7 @@ class BpttDataloader(object):
 
     def __iter__(self) -> Iterator[Dict]:
         # B x N
-        # TODO: may be slow when dataset is large
+        # NOTE: may be slow when dataset is large, using binary corpus instead
         batch = concat_data(self.batch_size,
                             self.dataset,
                             self.sampler,
@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+
+# Copyright 2021 Jian Wu
+# License: Apache 2.0 (http://www.apache.org/licenses/LICENSE-2.0)
+"""
+for RNNLM (streaming over the sharded corpus, BPTT or utterance-level training)
+"""
+import gzip
+import random
+import warnings
+
+import torch as th
+import aps.distributed as dist
+
+from itertools import chain
+from typing import Optional, Iterable, Iterator, Dict, List, NoReturn
+from aps.loader.lm.utils import adapt_batches
+from aps.loader.lm.utt import BinaryDataset, utt_collate
+from aps.utils import get_logger
+from aps.tokenizer import Tokenizer
+from aps.libs import ApsRegisters
+
+logger = get_logger(__name__)
+
+
+@ApsRegisters.loader.register("lm@shard")
+def DataLoader(text: str = "",
+               vocab_dict: Optional[Dict] = None,
+               tokenizer: str = "",
+               tokenizer_kwargs: Dict = {},
+               train: bool = True,
+               sos: int = -1,
+               eos: int = -1,
+               mode: str = "bptt",
+               bptt_size: int = 100,
+               distributed: bool = False,
+               kaldi_format: bool = True,
+               shuffle_buffer: int = 10000,
+               chunk_size_for_sort: int = 10000,
+               min_token_num: int = 2,
+               max_token_num: int = 2000,
+               adapt_token_num: int = 400,
+               min_batch_size: int = 8,
+               max_batch_size: int = 64,
+               num_workers: int = 0) -> Iterable[Dict]:
+    """
+    The streaming dataloader (over the sharded corpus) for LM training
+    Args:
+        text: path of the shard list, each line is a shard, i.e.,
+              text/token file or binary corpus (xxx.bin)
+        vocab_dict: vocabulary dictionary
+        tokenizer: tokenizer name (for on-the-fly tokenizer)
+        tokenizer_kwargs: argument options for tokenizer
+        sos|eos: sos|eos ID
+        mode: bptt or utt, i.e., lm@bptt or lm@utt style minibatch
+        bptt_size: sequence length for BPTT training
+        distributed: for distributed training or not
+        kaldi_format: whether text/token file is in kaldi format
+        train: in training mode or not
+        shuffle_buffer: size of the in-memory shuffle buffer (utterances)
+        chunk_size_for_sort: #chunk_size for mini-batch sorting (utt mode)
+        {min|max}_token_num: boundary of the token length
+        adapt_token_num: used for #batch_size reduction (utt mode)
+        max_batch_size: maximum value of #batch_size (#batch_size in bptt mode)
+        min_batch_size: minimum value of #batch_size (utt mode)
+        num_workers: not used here
+    """
+    with open(text, "r") as shard_list:
+        shards = [line.strip() for line in shard_list if line.strip()]
+    return ShardDataLoader(shards,
+                           vocab_dict=vocab_dict,
+                           tokenizer=tokenizer,
+                           tokenizer_kwargs=tokenizer_kwargs,
+                           kaldi_format=kaldi_format,
+                           sos=sos,
+                           eos=eos,
+                           mode=mode,
+                           bptt_size=bptt_size,
+                           shuffle=train,
+                           distributed=distributed,
+                           shuffle_buffer=shuffle_buffer,
+                           chunk_size_for_sort=chunk_size_for_sort,
+                           min_token_num=min_token_num,
+                           max_token_num=max_token_num,
+                           adapt_token_num=adapt_token_num,
+                           min_batch_size=min_batch_size,
+                           max_batch_size=max_batch_size)
+
+
+class ShardReader(object):
+    """
+    Read token sequences from one shard (text/token file or binary corpus)
+    Args:
+        shard: path of the text/token file or binary corpus (xxx.bin)
+        tokenizer: instance of the Tokenizer (for text/token file)
+        kaldi_format: whether text/token file is in kaldi format
+    """
+
+    def __init__(self,
+                 shard: str,
+                 tokenizer: Optional[Tokenizer] = None,
+                 kaldi_format: bool = True) -> None:
+        self.shard = shard
+        self.tokenizer = tokenizer
+        self.kaldi_format = kaldi_format
+
+    def _read_text(self) -> Iterator[List[int]]:
+        if self.shard[-3:] == ".gz":
+            text_f = gzip.open(self.shard, "rt")
+        else:
+            text_f = open(self.shard, "r")
+        with text_f:
+            for line in text_f:
+                str_toks = line.split()
+                # remove the first token (utterance key)
+                if self.kaldi_format:
+                    str_toks = str_toks[1:]
+                if self.tokenizer:
+                    yield self.tokenizer.encode(str_toks)
+                else:
+                    yield list(map(int, str_toks))
+
+    def __iter__(self) -> Iterator[List[int]]:
+        if self.shard[-4:] != ".bin":
+            return self._read_text()
+        dataset = BinaryDataset(self.shard)
+        return (dataset[i] for i in range(len(dataset)))
+
+
+class ShardDataLoader(object):
+    """
+    The streaming dataloader for LM training. Each epoch we shuffle the shards
+    (and assign them to the ranks in distributed mode), read the utterances
+    shard by shard through a bounded shuffle buffer and make minibatches
+    lazily, so the memory cost doesn't grow with the corpus size
+    NOTE: in distributed mode, number of the batches on each rank may be
+          different as the shards have different sizes, so all the ranks stop
+          once any of them runs out of the batches (see _sync_batches). Keep
+          the shards balanced to avoid dropping too many batches
+    """
+
+    def __init__(self,
+                 shards: List[str],
+                 vocab_dict: Optional[Dict] = None,
+                 tokenizer: str = "",
+                 tokenizer_kwargs: Dict = {},
+                 kaldi_format: bool = True,
+                 sos: int = -1,
+                 eos: int = -1,
+                 mode: str = "bptt",
+                 bptt_size: int = 100,
+                 shuffle: bool = True,
+                 distributed: bool = False,
+                 shuffle_buffer: int = 10000,
+                 chunk_size_for_sort: int = 10000,
+                 min_token_num: int = 2,
+                 max_token_num: int = 2000,
+                 adapt_token_num: int = 400,
+                 min_batch_size: int = 8,
+                 max_batch_size: int = 64) -> None:
+        if sos < 0 or eos < 0:
+            raise ValueError(f"Invalid sos/eos value: {sos}/{eos}")
+        if mode not in ["bptt", "utt"]:
+            raise ValueError(f"Unsupported mode: {mode}")
+        if not shards:
+            raise ValueError("ShardDataLoader: got empty shard list")
+        if distributed:
+            self.world_size = dist.world_size()
+            self.rank = dist.rank()
+            self.header = f"Rank {self.rank} - ShardDataLoader"
+        else:
+            self.world_size, self.rank = 1, 0
+            self.header = "ShardDataLoader"
+        self.distributed = distributed
+        if len(shards) < self.world_size:
+            raise RuntimeError(f"{self.header}: number of the shards " +
+                               f"({len(shards)}) < world size " +
+                               f"({self.world_size})")
+        if len(shards) % self.world_size:
+            num_shards = len(shards) // self.world_size * self.world_size
+            warnings.warn(f"{self.header}: only use {num_shards}/" +
+                          f"{len(shards)} shards per epoch to make them " +
+                          "even across the ranks")
+        if vocab_dict:
+            self.tokenizer = Tokenizer(vocab_dict,
+                                       tokenizer=tokenizer,
+                                       tokenizer_kwargs=tokenizer_kwargs)
+        else:
+            self.tokenizer = None
+        self.shards = shards
+        self.kaldi_format = kaldi_format
+        self.sos, self.eos = sos, eos
+        self.mode = mode
+        self.bptt_size = bptt_size
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer if shuffle else 0
+        self.chunk_size_for_sort = chunk_size_for_sort
+        self.min_token_num = min_token_num
+        self.max_token_num = max_token_num
+        self.adapt_token_num = adapt_token_num
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.epoch = 0
+        logger.info(f"{self.header}: {len(shards)} shards, mode = {mode}")
+
+    def _shards(self) -> List[str]:
+        """
+        Return the shards used on current rank
+        """
+        shards = self.shards[:len(self.shards) // self.world_size *
+                             self.world_size]
+        if self.shuffle:
+            random.Random(self.epoch).shuffle(shards)
+        return shards[self.rank::self.world_size]
+
+    def _utts(self, rng: random.Random) -> Iterator[List[int]]:
+        """
+        Yield the utterances (filtered & shuffled in the buffer)
+        """
+        buffer = []
+        for shard in self._shards():
+            for utt in ShardReader(shard,
+                                   tokenizer=self.tokenizer,
+                                   kaldi_format=self.kaldi_format):
+                if len(utt) < self.min_token_num or len(
+                        utt) > self.max_token_num:
+                    continue
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append(utt)
+                    continue
+                if buffer:
+                    # swap with the random one in the buffer
+                    index = rng.randrange(len(buffer))
+                    buffer[index], utt = utt, buffer[index]
+                yield utt
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def _bptt_batches(self, rng: random.Random) -> Iterator[Dict]:
+        """
+        Make BPTT minibatches: each utterance goes to the shortest stream
+        """
+        streams = [[] for _ in range(self.max_batch_size)]
+        reset = True
+        for utt in self._utts(rng):
+            stream = min(streams, key=len)
+            stream += [self.sos] + utt + [self.eos]
+            if min(len(s) for s in streams) < self.bptt_size + 1:
+                continue
+            batch = th.tensor([s[:self.bptt_size + 1] for s in streams],
+                              dtype=th.int64)
+            for s in streams:
+                del s[:self.bptt_size]
+            yield {
+                "#utt":
+                    self.max_batch_size,
+                "#tok":
+                    self.max_batch_size * self.bptt_size,
+                "len":
+                    th.tensor([self.bptt_size] * self.max_batch_size,
+                              dtype=th.int64),
+                "src":
+                    batch[:, :-1],
+                "tgt":
+                    batch[:, 1:],
+                "reset":
+                    reset
+            }
+            reset = False
+
+    def _utt_batches(self, rng: random.Random) -> Iterator[Dict]:
+        """
+        Make utterance-level minibatches: sort utterances in each chunk
+        """
+
+        def make_batches(chunk):
+            batches = adapt_batches([len(utt) for utt in chunk],
+                                    self.max_batch_size,
+                                    min_batch_size=self.min_batch_size,
+                                    adapt_token_num=self.adapt_token_num)
+            if self.shuffle:
+                rng.shuffle(batches)
+            for batch in batches:
+                yield utt_collate([chunk[i] for i in batch],
+                                  sos=self.sos,
+                                  eos=self.eos)
+
+        chunk = []
+        for utt in self._utts(rng):
+            chunk.append(utt)
+            if len(chunk) == self.chunk_size_for_sort:
+                yield from make_batches(chunk)
+                chunk = []
+        if chunk:
+            yield from make_batches(chunk)
+
+    def _sync_batches(self, batches: Iterator[Dict]) -> Iterator[Dict]:
+        """
+        Yield the batches until any of the ranks runs out of them, so that
+        each rank runs the same number of the training steps (otherwise the
+        all-reduce of the gradients hangs)
+        """
+        # NCCL only works with the GPU tensors
+        device = "cuda" if dist.get_backend() == "torch" else "cpu"
+        for batch in chain(batches, [None]):
+            has_data = th.tensor([batch is not None],
+                                 dtype=th.float32,
+                                 device=device)
+            # average of the flags
+            if dist.all_reduce(has_data).item() != 1:
+                if batch is not None:
+                    logger.info(f"{self.header}: stop as other ranks run " +
+                                "out of the batches")
+                break
+            yield batch
+
+    def __iter__(self) -> Iterator[Dict]:
+        rng = random.Random(self.epoch * self.world_size + self.rank)
+        if self.mode == "bptt":
+            batches = self._bptt_batches(rng)
+        else:
+            batches = self._utt_batches(rng)
+        return self._sync_batches(batches) if self.distributed else batches
+
+    def __len__(self) -> int:
+        return 0
+
+    def set_epoch(self, epoch: int) -> NoReturn:
+        self.epoch = epoch
@@ -4,10 +4,62 @@
 # License: Apache 2.0 (http://www.apache.org/licenses/LICENSE-2.0)
 
 import warnings
+import numpy as np
 import torch as th
 import torch.utils.data as dat
 
-from typing import List
+from typing import List, Optional
+
+
+def binary_index(corpus: str) -> str:
+    """
+    Return path of the offset index for the binary token corpus
+    """
+    return (corpus[:-4] if corpus[-4:] == ".bin" else corpus) + ".idx"
+
+
+class BinaryCorpusWriter(object):
+    """
+    Writer of the binary (pre-tokenized) LM corpus: a flat int32 token
+    array (xxx.bin) and an int64 offset index (xxx.idx, in npy format),
+    the i-th utterance is tokens[offsets[i]:offsets[i + 1]]
+    Args:
+        corpus: path of the binary corpus (.bin)
+    """
+
+    def __init__(self, corpus: str) -> None:
+        self.corpus = corpus
+        self.bin_f = open(corpus, "wb")
+        self.offsets = [0]
+
+    def write(self, int_toks: List[int]) -> None:
+        """
+        Append one utterance (token sequence)
+        """
+        self.bin_f.write(np.asarray(int_toks, dtype=np.int32).tobytes())
+        self.offsets.append(self.offsets[-1] + len(int_toks))
+
+    def close(self) -> None:
+        """
+        Close the token array and dump the offset index
+        """
+        self.bin_f.close()
+        with open(binary_index(self.corpus), "wb") as idx_f:
+            np.save(idx_f, np.asarray(self.offsets, dtype=np.int64))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def dataset_lengths(dataset: dat.Dataset) -> Optional[np.ndarray]:
+    """
+    Return token length of each utterance if the dataset maintains them
+    (e.g., binary corpus), otherwise None (we need to go through the dataset)
+    """
+    return getattr(dataset, "lengths", None)
 
 
 def filter_utts(dataset: dat.Dataset,
@@ -16,16 +68,23 @@ def filter_utts(dataset: dat.Dataset,
     """
     Return utterance index used for training (pass short/long utterances)
     """
-    kept_index = []
-    filter_sutt, filter_lutt = 0, 0
-    for index, tokseq in enumerate(dataset):
-        tok_len = len(tokseq)
-        if tok_len < min_token_num:
-            filter_sutt += 1
-        elif tok_len > max_token_num:
-            filter_lutt += 1
-        else:
-            kept_index.append(index)
+    toks_len = dataset_lengths(dataset)
+    if toks_len is not None:
+        short = toks_len < min_token_num
+        long = toks_len > max_token_num
+        kept_index = np.nonzero(~(short | long))[0].tolist()
+        filter_sutt, filter_lutt = int(short.sum()), int(long.sum())
+    else:
+        kept_index = []
+        filter_sutt, filter_lutt = 0, 0
+        for index, tokseq in enumerate(dataset):
+            tok_len = len(tokseq)
+            if tok_len < min_token_num:
+                filter_sutt += 1
+            elif tok_len > max_token_num:
+                filter_lutt += 1
+            else:
+                kept_index.append(index)
     if filter_lutt or filter_sutt:
         ratio_lutt = filter_lutt * 100.0 / len(dataset)
         ratio_sutt = filter_sutt * 100.0 / len(dataset)
@@ -35,6 +94,30 @@ def filter_utts(dataset: dat.Dataset,
     return kept_index
 
 
+def adapt_batches(toks_len: List[int],
+                  max_batch_size: int,
+                  min_batch_size: int = 4,
+                  adapt_token_num: int = 400) -> List[List[int]]:
+    """
+    Sort the utterances by the token length (long -> short) and make batches,
+    #batch_size is reduced when the utterances are long, i.e.,
+    max_batch_size // (1 + (#token_num - 1) // adapt_token_num)
+    Return:
+        batches: list of the utterance position in toks_len
+    """
+    # long -> short
+    sort_idx = np.argsort(toks_len)[::-1]
+    batches = []
+    beg, cur_bz = 0, max_batch_size
+    while beg + cur_bz <= len(sort_idx):
+        cur_len = toks_len[sort_idx[beg]]
+        factor = (cur_len - 1) // adapt_token_num
+        cur_bz = int(max(min_batch_size, max_batch_size // (1 + factor)))
+        batches.append(sort_idx[beg:beg + cur_bz].tolist())
+        beg += cur_bz
+    return batches
+
+
 def concat_data(batch_size: int,
                 dataset: dat.Dataset,
                 sampler: dat.Sampler,
@@ -43,6 +126,11 @@ def concat_data(batch_size: int,
     """
     Concatenate data sequence in the dataset
     """
+    if hasattr(dataset, "concat"):
+        data = th.from_numpy(
+            dataset.concat(list(sampler), sos=sos, eos=eos).astype(np.int64))
+        truncated = (data.shape[0] // batch_size) * batch_size
+        return data[:truncated].view(batch_size, -1)
     data = []
     for index in sampler:
         data += ([sos] + dataset[index] + [eos])
@@ -14,7 +14,7 @@ import aps.distributed as dist
 
 from torch.nn.utils.rnn import pad_sequence
 from typing import NoReturn, List, Dict, Optional, Iterator, Iterable
-from aps.loader.lm.utils import filter_utts
+from aps.loader.lm.utils import filter_utts, adapt_batches, binary_index, dataset_lengths
 from aps.loader.am.utils import derive_indices
 from aps.utils import get_logger
 from aps.tokenizer import Tokenizer
@@ -44,7 +44,7 @@ def DataLoader(text: str = "",
     """
     The utterance-level dataloader for LM training
     Args:
-        text: path of the text/token file
+        text: path of the text/token file (or binary corpus, xxx.bin)
         vocab_dict: vocabulary dictionary
         tokenizer: tokenizer name (for on-the-fly tokenizer)
         tokenizer_kwargs: argument options for tokenizer
@@ -60,11 +60,11 @@ def DataLoader(text: str = "",
         chunk_size_for_sort: #chunk_size for mini-batch sorting, we perform sort
                              in each chunk (because LM corpus may very big)
     """
-    dataset = Dataset(text,
-                      vocab_dict,
-                      kaldi_format=kaldi_format,
-                      tokenizer=tokenizer,
-                      tokenizer_kwargs=tokenizer_kwargs)
+    dataset = make_dataset(text,
+                           vocab_dict,
+                           kaldi_format=kaldi_format,
+                           tokenizer=tokenizer,
+                           tokenizer_kwargs=tokenizer_kwargs)
     return UttDataLoader(dataset,
                          sos=sos,
                          eos=eos,
@@ -133,6 +133,85 @@ class Dataset(dat.Dataset):
         return len(self.token)
 
 
+class BinaryDataset(dat.Dataset):
+    """
+    Dataset for the binary (pre-tokenized) text corpus, see
+    aps.loader.lm.utils.BinaryCorpusWriter & cmd/text_binarize.py. The token
+    array is memory mapped so we don't load the whole corpus into memory
+    Args:
+        corpus: path of the binary corpus (.bin)
+    """
+
+    def __init__(self, corpus: str) -> None:
+        self.corpus = corpus
+        self.offsets = np.load(binary_index(corpus), mmap_mode="r")
+        self.lengths = np.diff(self.offsets)
+        self.token = None
+        num_tokens = self.tokens.shape[0]
+        if num_tokens != self.offsets[-1]:
+            raise RuntimeError(f"BinaryDataset: {corpus} has {num_tokens} " +
+                               f"tokens, but index expects {self.offsets[-1]}")
+
+    @property
+    def tokens(self) -> np.ndarray:
+        # open lazily (e.g., in worker processes of the dataloader)
+        if self.token is None:
+            self.token = np.memmap(self.corpus, dtype=np.int32, mode="r")
+        return self.token
+
+    def __getstate__(self) -> Dict:
+        state = self.__dict__.copy()
+        state["token"] = None
+        return state
+
+    def concat(self,
+               indices: List[int],
+               sos: int = -1,
+               eos: int = -1) -> np.ndarray:
+        """
+        Concatenate the utterances (in order of the indices) as
+        [sos, utt_1, eos, sos, utt_2, eos, ...] without python loop
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        toks_len = self.lengths[indices]
+        # offset of each utterance in the concatenated array
+        utt_beg = np.cumsum(toks_len + 2) - toks_len - 2
+        data = np.empty(int((toks_len + 2).sum()), dtype=np.int32)
+        data[utt_beg] = sos
+        data[utt_beg + toks_len + 1] = eos
+        # position of each token in the source & target array
+        tok_idx = np.arange(toks_len.sum()) - np.repeat(
+            np.cumsum(toks_len) - toks_len, toks_len)
+        src_pos = np.repeat(self.offsets[indices], toks_len) + tok_idx
+        dst_pos = np.repeat(utt_beg + 1, toks_len) + tok_idx
+        data[dst_pos] = self.tokens[src_pos]
+        return data
+
+    def __getitem__(self, index: int) -> List[int]:
+        beg, end = self.offsets[index], self.offsets[index + 1]
+        return self.tokens[beg:end].tolist()
+
+    def __len__(self) -> int:
+        return self.lengths.shape[0]
+
+
+def make_dataset(text: str,
+                 vocab_dict: Optional[Dict],
+                 tokenizer: str = "",
+                 tokenizer_kwargs: Dict = {},
+                 kaldi_format: bool = True) -> dat.Dataset:
+    """
+    Return BinaryDataset for the binary corpus (xxx.bin), otherwise Dataset
+    """
+    if text[-4:] == ".bin":
+        return BinaryDataset(text)
+    return Dataset(text,
+                   vocab_dict,
+                   kaldi_format=kaldi_format,
+                   tokenizer=tokenizer,
+                   tokenizer_kwargs=tokenizer_kwargs)
+
+
 class BatchSampler(dat.Sampler):
     """
     A custom batch sampler for LM dataset
@@ -200,17 +279,16 @@ class BatchSampler(dat.Sampler):
         """
         Return utterance index used for training (pass short/long utterances)
         """
-        toks_len = [len(dataset[i]) for i in subset]
-        # long -> short
-        sort_idx = np.argsort(toks_len)[::-1]
-        batches = []
-        beg, cur_bz = 0, max_batch_size
-        while beg + cur_bz <= len(sort_idx):
-            cur_len = toks_len[sort_idx[beg]]
-            factor = (cur_len - 1) // adapt_token_num
-            cur_bz = int(max(min_batch_size, max_batch_size // (1 + factor)))
-            batches.append([subset[i] for i in sort_idx[beg:beg + cur_bz]])
-            beg += cur_bz
+        toks_len = dataset_lengths(dataset)
+        if toks_len is not None:
+            toks_len = toks_len[subset]
+        else:
+            toks_len = [len(dataset[i]) for i in subset]
+        batches = adapt_batches(toks_len,
+                                max_batch_size,
+                                min_batch_size=min_batch_size,
+                                adapt_token_num=adapt_token_num)
+        batches = [[subset[i] for i in batch] for batch in batches]
         return batches
 
     def __iter__(self) -> Iterator[List[int]]:
@@ -228,6 +306,21 @@ class BatchSampler(dat.Sampler):
         return self.num_batches
 
 
+def utt_collate(egs: List[List[int]], sos: int = -1, eos: int = -1) -> Dict:
+    """
+    Make minibatch from the token sequences (with padding)
+    """
+    sos_egs = [th.as_tensor([sos] + eg) for eg in egs]
+    egs_eos = [th.as_tensor(eg + [eos]) for eg in egs]
+    return {
+        "#utt": len(egs),
+        "#tok": sum([len(eg) + 1 for eg in egs]),
+        "src": pad_sequence(sos_egs, batch_first=True, padding_value=eos),
+        "tgt": pad_sequence(egs_eos, batch_first=True, padding_value=IGNORE_ID),
+        "len": th.tensor([len(eg) + 1 for eg in egs], dtype=th.int64)
+    }
+
+
 class UttDataLoader(dat.DataLoader):
     """
     The utterance level dataLoader for LM training
@@ -276,21 +369,7 @@ class UttDataLoader(dat.DataLoader):
                                             collate_fn=self.egs_collate)
 
     def egs_collate(self, egs):
-        sos_egs = [th.as_tensor([self.sos] + eg) for eg in egs]
-        egs_eos = [th.as_tensor(eg + [self.eos]) for eg in egs]
-        return {
-            "#utt":
-                len(egs),
-            "#tok":
-                sum([len(eg) + 1 for eg in egs]),
-            "src":
-                pad_sequence(sos_egs, batch_first=True, padding_value=self.eos),
-            "tgt":
-                pad_sequence(egs_eos, batch_first=True,
-                             padding_value=IGNORE_ID),
-            "len":
-                th.tensor([len(eg) + 1 for eg in egs], dtype=th.int64)
-        }
+        return utt_collate(egs, sos=self.sos, eos=self.eos)
 
     def set_epoch(self, epoch: int) -> NoReturn:
         self.batch_sampler.set_epoch(epoch)
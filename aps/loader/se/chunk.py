@@ -6,13 +6,14 @@
 Dataloader of the raw waveform in enhancement/separation tasks
 """
 import random
+import warnings
 import numpy as np
 import torch.utils.data as dat
 import aps.distributed as dist
 
 from torch.utils.data.dataloader import default_collate
 from kaldi_python_io import Reader as BaseReader
-from typing import List, Dict, Iterator, NoReturn, Union, Iterable
+from typing import List, Dict, Iterator, NoReturn, Union, Iterable, Optional
 from aps.io.audio import AudioReader
 from aps.libs import ApsRegisters
 
@@ -24,6 +25,7 @@ def DataLoader(train: bool = True,
                doa_scp: str = "",
                ref_scp: str = "",
                emb_scp: str = "",
+               utt2nsamps: str = "",
                chunk_size: int = 64000,
                max_batch_size: int = 16,
                distributed: bool = False,
@@ -37,6 +39,9 @@ def DataLoader(train: bool = True,
         emb_scp: speaker embedding script, e.g, "emb.scp" or ""
         doa_scp: DoA scripts, e.g., "spk1.scp" or "spk1.scp,spk2.scp" or ""
         ref_scp: reference audio scripts, e.g., "spk1.scp" or "spk1.scp,spk2.scp"
+        utt2nsamps: number of samples of the mixture, e.g., "utt2nsamps" (generated by
+                    utils/wav_duration.py --output sample) or "". If given, we plan the
+                    chunks in advance and only read the required range of the audio
         chunk_size: #chunk_size (s)
         max_batch_size: #batch_size
         distributed: in distributed mode or not
@@ -62,6 +67,7 @@ def DataLoader(train: bool = True,
                             ref_scp=ref_scp)
     return WaveChunkDataLoader(dataset,
                                train=train,
+                               utt2nsamps=utt2nsamps,
                                chunk_size=chunk_size,
                                batch_size=max_batch_size,
                                num_workers=num_workers,
@@ -126,20 +132,25 @@ class ScriptDataset(dat.Dataset):
 
         self.emb = NumpyReader(emb_scp) if emb_scp else None
 
-    def _make_ref(self, key: str) -> Union[np.ndarray, List[np.ndarray]]:
-        return self.ref[key] if self.num_ref == 1 else [
-            reader[key] for reader in self.ref
-        ]
+    def _make_ref(
+            self,
+            key: str,
+            beg: int = 0,
+            end: Optional[int] = None) -> Union[np.ndarray, List[np.ndarray]]:
+        if self.num_ref == 1:
+            return self.ref.read(key, beg=beg, end=end)
+        else:
+            return [reader.read(key, beg=beg, end=end) for reader in self.ref]
 
     def _make_doa(self, key: str) -> Union[float, List[float]]:
         return self.doa[key] if self.num_doa == 1 else [
             reader[key] for reader in self.doa
         ]
 
-    def _idx(self, key: str) -> Dict:
+    def _idx(self, key: str, beg: int = 0, end: Optional[int] = None) -> Dict:
         eg = {}
         if self.ref is not None:
-            eg["ref"] = self._make_ref(key)
+            eg["ref"] = self._make_ref(key, beg=beg, end=end)
         if self.doa is not None:
             eg["doa"] = self._make_doa(key)
         if self.emb is not None:
@@ -161,6 +172,86 @@ class ScriptDataset(dat.Dataset):
             eg["mix"] = mix
             yield eg
 
+    def read(self, key: str, beg: int = 0, end: Optional[int] = None) -> Dict:
+        """
+        Return egs in range [beg, end) of the utterance
+        """
+        eg = self._idx(key, beg=beg, end=end)
+        eg["mix"] = self.mix.read(key, beg=beg, end=end)
+        return eg
+
+
+class ChunkPlanDataset(dat.Dataset):
+    """
+    Dataset of the audio chunks which are planned in advance using the length
+    of the utterances, so only the required range of the audio are loaded
+    (see ChunkSplitter.split for the chunk splitting policy)
+    Args:
+        dataset: instance of the ScriptDataset
+        utt2nsamps: number of samples of the mixture (.scp format)
+        chunk_size: size of audio chunk
+        train: in training mode or not
+        hop: hop size between the chunks in one utterance
+    """
+
+    def __init__(self,
+                 dataset: ScriptDataset,
+                 utt2nsamps: str,
+                 chunk_size: int,
+                 train: bool = True,
+                 hop: int = 16000) -> None:
+        self.dataset = dataset
+        self.splitter = ChunkSplitter(chunk_size, train=False, hop=hop)
+        utt2nsamps = BaseReader(utt2nsamps, value_processor=int)
+        self.keys = [k for k in dataset.mix.index_keys if k in utt2nsamps]
+        if len(self.keys) != len(dataset):
+            warnings.warn(f"Missing length of {len(dataset) - len(self.keys)} "
+                          "utterances in utt2nsamps, skip them ...")
+        self.nsamps = np.array([utt2nsamps[k] for k in self.keys],
+                               dtype=np.int64)
+        self.chunk_size = chunk_size
+        self.hop = hop
+        self.train = train
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch: int) -> NoReturn:
+        """
+        Plan the chunks: [(utterance index, begin sample), ...], the random
+        start points are seeded with #epoch to make ranks consistent
+        """
+        N = self.nsamps
+        # too short, throw away
+        index = np.nonzero(N >= self.hop)[0]
+        N = N[index]
+        # padding zeros for N < chunk_size, so at least one chunk
+        num_chunks = np.maximum((N - self.chunk_size) // self.hop + 1, 1)
+        if self.train:
+            # keep #num_chunks same in different epochs
+            rng = np.random.default_rng(epoch)
+            s = rng.integers(0,
+                             np.maximum(N - self.chunk_size, 0) % self.hop,
+                             endpoint=True)
+        else:
+            s = np.zeros_like(N)
+        chunk_idx = np.arange(num_chunks.sum()) - np.repeat(
+            np.cumsum(num_chunks) - num_chunks, num_chunks)
+        self.chunk_utt = np.repeat(index, num_chunks)
+        self.chunk_beg = np.repeat(s, num_chunks) + chunk_idx * self.hop
+
+    def __getitem__(self, index: int) -> Dict:
+        utt, beg = self.chunk_utt[index], int(self.chunk_beg[index])
+        end = beg + self.chunk_size
+        key = self.keys[utt]
+        # padding for short utterance
+        chunks = self.splitter.split(self.dataset.read(key, beg=beg, end=end))
+        if not chunks:
+            raise RuntimeError(f"Length of utterance {key} mismatches "
+                               "with the one in utt2nsamps")
+        return chunks[0]
+
+    def __len__(self) -> int:
+        return self.chunk_utt.size
+
 
 class ChunkSplitter(object):
     """
@@ -257,6 +348,9 @@ class WaveChunkDataLoader(object):
         batch_size: #batch_size
         distributed: in distributed mode or not
         train: in training mode or not
+        utt2nsamps: if not empty, plan chunks using the length of the
+                    utterances and read only the required range of the audio
+                    (ScriptDataset only)
     """
 
     def __init__(self,
@@ -265,13 +359,24 @@ class WaveChunkDataLoader(object):
                  chunk_size: int = 64000,
                  batch_size: int = 16,
                  distributed: bool = False,
-                 train: bool = True) -> None:
-        self.dataset = dataset
+                 train: bool = True,
+                 utt2nsamps: str = "") -> None:
         self.train = train
         self.batch_size = batch_size
         self.splitter = ChunkSplitter(chunk_size,
                                       train=train,
                                       hop=chunk_size // 2)
+        if utt2nsamps:
+            if not isinstance(dataset, ScriptDataset):
+                raise RuntimeError("utt2nsamps is only supported by "
+                                   "ScriptDataset")
+            dataset = ChunkPlanDataset(dataset,
+                                       utt2nsamps,
+                                       chunk_size,
+                                       train=train,
+                                       hop=chunk_size // 2)
+        self.dataset = dataset
+        self.planned = isinstance(dataset, ChunkPlanDataset)
         if distributed:
             self.sampler = dat.DistributedSampler(
                 dataset,
@@ -280,6 +385,17 @@ class WaveChunkDataLoader(object):
                 rank=dist.rank())
         else:
             self.sampler = None
+        if self.planned:
+            # return batch of audio chunks directly
+            self.eg_loader = dat.DataLoader(self.dataset,
+                                            batch_size=batch_size,
+                                            num_workers=num_workers,
+                                            sampler=self.sampler,
+                                            shuffle=(train and
+                                                     self.sampler is None),
+                                            drop_last=True,
+                                            collate_fn=self._collate_chunk)
+            return
         # just return batch of egs, support multiple workers
         # NOTE: batch_size is not the batch_size of the audio chunk
         self.eg_loader = dat.DataLoader(self.dataset,
@@ -290,6 +406,11 @@ class WaveChunkDataLoader(object):
                                                  self.sampler is None),
                                         collate_fn=self._collate)
 
+    def _collate_chunk(self, chunk_list: List[Dict]) -> Dict:
+        batch = default_collate(chunk_list)
+        batch["#utt"] = len(chunk_list)
+        return batch
+
     def _collate(self, batch):
         chunk = []
         for eg in batch:
@@ -321,10 +442,16 @@ class WaveChunkDataLoader(object):
         return 0
 
     def set_epoch(self, epoch: int) -> NoReturn:
+        if self.planned:
+            self.dataset.set_epoch(epoch)
         if self.sampler:
             self.sampler.set_epoch(epoch)
 
     def __iter__(self) -> Iterator[Dict]:
+        if self.planned:
+            for obj in self.eg_loader:
+                yield obj
+            return
         chunk_list = []
         for chunks in self.eg_loader:
             chunk_list += chunks
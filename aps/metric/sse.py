@@ -5,9 +5,8 @@
 
 import numpy as np
 
-from itertools import permutations
-
 from typing import Optional, Callable, Union, Tuple
+from scipy.optimize import linear_sum_assignment
 from pypesq import pesq
 from pystoi import stoi
 from museval.metrics import bss_eval_images
@@ -40,6 +39,39 @@ def aps_sisnr(s: np.ndarray,
     return 20 * np.log10(vec_l2norm(t) / (vec_l2norm(n) + eps) + eps)
 
 
+def aps_sisnr_matrix(ref: np.ndarray,
+                     est: np.ndarray,
+                     eps: float = 1e-8,
+                     remove_dc: bool = True,
+                     fs: Optional[int] = None) -> np.ndarray:
+    """
+    Compute pairwise Si-SNR matrix of the reference & estimated signals
+    Args:
+        ref: array, reference signal (N x S, ground truth)
+        est: array, enhanced/separated signal (M x S)
+    Return:
+        sisnr: array, N x M, sisnr[n, m] = Si-SNR(ref[n], est[m])
+    """
+    # NOTE: n_pow below is the difference of the close numbers for the good
+    # separations, use float64 to avoid the catastrophic cancellation
+    ref = ref.astype(np.float64)
+    est = est.astype(np.float64)
+    if remove_dc:
+        ref = ref - np.mean(ref, -1, keepdims=True)
+        est = est - np.mean(est, -1, keepdims=True)
+    # N x M
+    inner = ref @ est.T
+    # N x 1
+    ref_pow = np.sum(ref**2, -1, keepdims=True)
+    # M
+    est_pow = np.sum(est**2, -1)
+    # t = <x, s> s / ||s||^2, n = x - t
+    proj = inner**2 / (ref_pow + eps)
+    t_pow = proj * ref_pow / (ref_pow + eps)
+    n_pow = np.maximum(est_pow[None, :] - 2 * proj + t_pow, 0)
+    return 20 * np.log10(np.sqrt(t_pow) / (np.sqrt(n_pow) + eps) + eps)
+
+
 def aps_pesq(ref: np.ndarray, est: np.ndarray, fs: int = 16000) -> float:
     """
     Wrapper for pypesq.pesq
@@ -54,24 +86,42 @@ def aps_stoi(ref: np.ndarray, est: np.ndarray, fs: int = 16000) -> float:
     return stoi(ref, est, fs_sig=fs)
 
 
-def _permute_eval(eval_func: Callable,
-                  ref: np.ndarray,
-                  est: np.ndarray,
-                  compute_permutation: bool = False,
-                  fs: Optional[int] = None) -> Union[float, Tuple[float, list]]:
+def _pairwise_eval(eval_func: Callable,
+                   ref: np.ndarray,
+                   est: np.ndarray,
+                   fs: Optional[int] = None) -> np.ndarray:
+    """
+    Compute pairwise metric matrix (N x N) using the metric function of
+    the single reference & estimated signal
+    """
+    N = ref.shape[0]
+    metric = np.zeros([N, N])
+    for n in range(N):
+        for m in range(N):
+            metric[n, m] = eval_func(ref[n], est[m], fs=fs)
+    return metric
+
+
+def _permute_eval(
+        eval_func: Callable,
+        ref: np.ndarray,
+        est: np.ndarray,
+        compute_permutation: bool = False,
+        fs: Optional[int] = None,
+        matrix_func: Optional[Callable] = None
+) -> Union[float, Tuple[float, list]]:
     """
-    Wrapper for computation of SiSNR/PESQ/STOI in permutation/non-permutation mode
+    Wrapper for computation of SiSNR/PESQ/STOI in permutation/non-permutation mode.
+    The N x N pairwise metric matrix is computed once and the best permutation
+    is solved using hungarian algorithm (instead of evaluating N! permutations)
     Args:
         eval_func: function to compute metrics
         ref: array, reference signal (N x S or S, ground truth)
         est: array, enhanced/separated signal (N x S or S)
         compute_permutation: return permutation order or not
         fs: sample rate of the audio
+        matrix_func: function to compute the pairwise metric matrix (if exists)
     """
-
-    def eval_sum(ref, est):
-        return sum([eval_func(s, x, fs=fs) for s, x in zip(ref, est)])
-
     if est.ndim == 1:
         return eval_func(ref, est, fs=fs)
 
@@ -79,17 +129,17 @@ def _permute_eval(eval_func: Callable,
     if N != ref.shape[0]:
         raise RuntimeError(
             "Size do not match between estimated and reference signal")
-    metric = []
-    perm = []
-    for order in permutations(range(N)):
-        est_permu = np.stack([est[n] for n in order])
-        metric.append(eval_sum(ref, est_permu) / N)
-        perm.append(order)
+    if matrix_func is not None:
+        metric = matrix_func(ref, est, fs=fs)
+    else:
+        metric = _pairwise_eval(eval_func, ref, est, fs=fs)
+    # permutation of the estimated signal: ref[n] <=> est[perm[n]]
+    index, perm = linear_sum_assignment(metric, maximize=True)
+    max_metric = metric[index, perm].mean()
     if not compute_permutation:
-        return max(metric)
+        return max_metric
     else:
-        max_idx = np.argmax(metric)
-        return max(metric), perm[max_idx]
+        return max_metric, perm.tolist()
 
 
 def permute_sse_metric(
@@ -112,7 +162,8 @@ def permute_sse_metric(
                              ref,
                              est,
                              compute_permutation=compute_permutation,
-                             fs=fs)
+                             fs=fs,
+                             matrix_func=aps_sisnr_matrix)
     elif name == "pesq":
         return _permute_eval(aps_pesq,
                              ref,
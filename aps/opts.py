@@ -162,6 +162,11 @@ def get_aps_decode_parser():
                         type=str,
                         default="best",
                         help="Tag name for RNNLM")
+    parser.add_argument("--ngram-topk",
+                        type=int,
+                        default=0,
+                        help="If > 0, ngram LM only scores the topk "
+                        "acoustic candidates of each hypothesis")
     parser.add_argument("--temperature",
                         type=float,
                         default=1,
@@ -236,6 +241,33 @@ def get_aps_decode_parser():
                         default=False,
                         help="If true, disable <unk> symbol "
                         "in decoding sequence")
+    parser.add_argument("--num-workers",
+                        type=int,
+                        default=1,
+                        help="Number of the decoding worker processes "
+                        "(sharing one copy of the model, CPU only)")
+    parser.add_argument("--prefetch-size",
+                        type=int,
+                        default=32,
+                        help="Number of the utterances read ahead "
+                        "by the background reader")
+    parser.add_argument("--io-threads",
+                        type=int,
+                        default=1,
+                        help="Number of the threads to read (decode) the "
+                        "audio in the background reader, > 1 means reading "
+                        "ahead in parallel")
+    parser.add_argument("--num-threads",
+                        type=int,
+                        default=0,
+                        help="Number of the torch threads used in each "
+                        "decoding process (<= 0 means using the default)")
+    parser.add_argument("--mmap-weights",
+                        action=StrToBoolAction,
+                        default=False,
+                        help="If true, memory map the model weights (CPU "
+                        "only), thus the parallel decoding jobs share one "
+                        "copy of the weights")
     return parser
 
 
@@ -261,6 +293,15 @@ def get_aps_align_parser():
                         type=str,
                         default="",
                         help="Kaldi's segment file for wav.scp")
+    parser.add_argument("--batch-size",
+                        type=int,
+                        default=1,
+                        help="Number of utterances to align in one batch")
+    parser.add_argument("--num-jobs",
+                        type=int,
+                        default=1,
+                        help="Number of the worker processes to run viterbi "
+                        "alignment in parallel")
     return parser
 
 
@@ -19,6 +19,8 @@ common = ["relu", "sigmoid"]
 bounded = ["sigmoid", "softmax"]
 unbounded = ["none", "relu", "tanh", "softplus"]
 
+InferRetType = Union[th.Tensor, List[th.Tensor]]
+
 
 def tf_masking(mix_stft: th.Tensor,
                src_mask: th.Tensor,
@@ -108,6 +110,59 @@ class SSEBase(nn.Module):
         """
         raise NotImplementedError()
 
+    def _infer_batch(self,
+                     mix: th.Tensor,
+                     mode: str = "freq") -> Union[th.Tensor, List[th.Tensor]]:
+        """
+        Batched version of the infer() (without th.no_grad() & unpacking)
+        Args:
+            mix (Tensor): N x S or N x C x S (multi-channel)
+        Return:
+            Tensor: N x S or [N x S, ...]
+        """
+        raise NotImplementedError()
+
+    def infer_batch(self,
+                    mix: Union[th.Tensor, List[th.Tensor]],
+                    mix_len: Optional[th.Tensor] = None,
+                    mode: str = "freq") -> List[InferRetType]:
+        """
+        Batched inference: the inputs are zero padded to the longest one and
+        go through one forward pass. Outputs of the shorter ones are trimmed
+        to the input length in time mode (TF masks keep the padded frames).
+        For non-causal models, outputs of the padded utterances may slightly
+        differ from the ones of infer()
+        Args:
+            mix (Tensor or [Tensor, ...]): padded batch, N x (C) x S or list
+                                           of the variable-length inputs
+            mix_len (Tensor): N, number of the samples in the padded batch
+        Return:
+            [Tensor or [Tensor, ...], ...]: output of infer() for each input
+        """
+        if isinstance(mix, (list, tuple)):
+            mix_len = [m.shape[-1] for m in mix]
+            max_len = max(mix_len)
+            mix = th.stack([tf.pad(m, (0, max_len - m.shape[-1])) for m in mix])
+        elif mix_len is not None:
+            mix_len = mix_len.tolist()
+        else:
+            mix_len = [mix.shape[-1]] * mix.shape[0]
+        # not implemented in the subclass, fall back to infer()
+        if type(self)._infer_batch is SSEBase._infer_batch:
+            return [
+                self.infer(mix[n, ..., :mix_len[n]], mode=mode)
+                for n in range(mix.shape[0])
+            ]
+        with th.no_grad():
+            out = self._infer_batch(mix, mode=mode)
+
+        def unpack(out, n):
+            if isinstance(out, (list, tuple)):
+                return type(out)(unpack(o, n) for o in out)
+            return out[n, ..., :mix_len[n]] if mode == "time" else out[n]
+
+        return [unpack(out, n) for n in range(mix.shape[0])]
+
 
 class MaskNonLinear(nn.Module):
     """
@@ -449,6 +449,16 @@ class DenseUnet(SSEBase):
             else:
                 return [s[0] for s in sep]
 
+    def _infer_batch(self,
+                     mix: th.Tensor,
+                     mode: str = "time") -> DenseUnetRetType:
+        """
+        Args:
+            mix (Tensor): N x S
+        """
+        self.check_args(mix, training=False, valid_dim=[2])
+        return self._forward(mix, mode=mode)
+
     def _forward(self, mix: th.Tensor, mode: str = "freq") -> DenseUnetRetType:
         # NOTE: update real input!
         # N x F x T x 2
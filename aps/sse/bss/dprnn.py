@@ -172,6 +172,16 @@ class TimeDPRNN(SSEBase):
             sep = self.forward(mix)
             return sep[0] if self.num_spks == 1 else [s[0] for s in sep]
 
+    def _infer_batch(self,
+                     mix: th.Tensor,
+                     mode: str = "time") -> Union[th.Tensor, List[th.Tensor]]:
+        """
+        Args:
+            mix (Tensor): N x S
+        """
+        self.check_args(mix, training=False, valid_dim=[2])
+        return self.forward(mix)
+
     def forward(self, mix: th.Tensor) -> Union[th.Tensor, List[th.Tensor]]:
         """
         Args:
@@ -252,6 +262,16 @@ class FreqDPRNN(SSEBase):
             ret = self._forward(mix, mode=mode)
             return ret[0] if self.num_spks == 1 else [r[0] for r in ret]
 
+    def _infer_batch(self,
+                     mix: th.Tensor,
+                     mode: str = "time") -> Union[th.Tensor, List[th.Tensor]]:
+        """
+        Args:
+            mix (Tensor): N x S
+        """
+        self.check_args(mix, training=False, valid_dim=[2])
+        return self._forward(mix, mode=mode)
+
     def forward(self, mix: th.Tensor) -> Union[th.Tensor, List[th.Tensor]]:
         """
         Args:
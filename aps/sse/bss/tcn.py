@@ -305,6 +305,16 @@ class TimeConvTasNet(SSEBase):
             sep = self.forward(mix)
             return sep[0] if self.num_spks == 1 else [s[0] for s in sep]
 
+    def _infer_batch(self,
+                     mix: th.Tensor,
+                     mode: str = "time") -> Union[th.Tensor, List[th.Tensor]]:
+        """
+        Args:
+            mix (Tensor): N x S
+        """
+        self.check_args(mix, training=False, valid_dim=[2])
+        return self.forward(mix)
+
     def mix_consistency(self, out: th.Tensor, mix: th.Tensor,
                         bss: List[th.Tensor]) -> List[th.Tensor]:
         """
@@ -443,6 +453,16 @@ class FreqConvTasNet(SSEBase):
             ret = self._infer(mix, mode=mode)
             return ret[0] if self.num_spks == 1 else [r[0] for r in ret]
 
+    def _infer_batch(self,
+                     mix: th.Tensor,
+                     mode: str = "time") -> Union[th.Tensor, List[th.Tensor]]:
+        """
+        Args:
+            mix (Tensor): N x (C) x S
+        """
+        self.check_args(mix, training=False, valid_dim=[2, 3])
+        return self._infer(mix, mode=mode)
+
     @th.jit.ignore
     def forward(self, mix: th.Tensor) -> Union[th.Tensor, List[th.Tensor]]:
         """
@@ -99,6 +99,16 @@ class FreqXfmr(SSEBase):
             else:
                 return [s[0] for s in sep]
 
+    def _infer_batch(self,
+                     mix: th.Tensor,
+                     mode: str = "time") -> Union[th.Tensor, List[th.Tensor]]:
+        """
+        Args:
+            mix (Tensor): N x S
+        """
+        self.check_args(mix, training=False, valid_dim=[2])
+        return self._infer(mix, mode=mode)
+
     @th.jit.ignore
     def forward(self, s: th.Tensor) -> Union[th.Tensor, List[th.Tensor]]:
         """
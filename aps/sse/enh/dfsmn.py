@@ -106,6 +106,16 @@ class DFSMN(SSEBase):
             ret = self._infer(mix, mode=mode)
             return ret[0] if self.num_branchs == 1 else [r[0] for r in ret]
 
+    def _infer_batch(self,
+                     mix: th.Tensor,
+                     mode: str = "time") -> Union[th.Tensor, List[th.Tensor]]:
+        """
+        Args:
+            mix (Tensor): N x S
+        """
+        self.check_args(mix, training=False, valid_dim=[2])
+        return self._infer(mix, mode=mode)
+
     @th.jit.ignore
     def forward(self, mix: th.Tensor) -> Union[th.Tensor, List[th.Tensor]]:
         """
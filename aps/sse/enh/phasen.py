@@ -326,6 +326,14 @@ class Phasen(SSEBase):
             enh = self._forward(mix, mode=mode)
             return enh[0] if mode == "time" else (enh[0][0], enh[1][0])
 
+    def _infer_batch(self, mix: th.Tensor, mode: str = "time") -> th.Tensor:
+        """
+        Args:
+            mix (Tensor): N x S
+        """
+        self.check_args(mix, training=False, valid_dim=[2])
+        return self._forward(mix, mode=mode)
+
     def forward(self, mix: th.Tensor):
         """
         Args:
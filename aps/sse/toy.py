@@ -114,6 +114,16 @@ class ToyRNN(SSEBase):
             spk = self._infer(mix, mode)
             return spk[0] if self.num_spks == 1 else [s[0] for s in spk]
 
+    def _infer_batch(self,
+                     mix: th.Tensor,
+                     mode: str = "time") -> Union[th.Tensor, List[th.Tensor]]:
+        """
+        Args:
+            mix (Tensor): N x (C) x S
+        """
+        self.check_args(mix, training=False, valid_dim=[2, 3])
+        return self._infer(mix, mode)
+
     @th.jit.ignore
     def forward(self, mix: th.Tensor) -> Union[th.Tensor, List[th.Tensor]]:
         """
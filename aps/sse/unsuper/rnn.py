@@ -99,7 +99,8 @@ class RNNEnhML(SSEBase):
                  num_layers: int = 3,
                  hidden: int = 512,
                  dropout: float = 0.2,
-                 bidirectional: bool = False) -> None:
+                 bidirectional: bool = False,
+                 native_cplx: bool = False) -> None:
         super(RNNEnhML, self).__init__(enh_transform, training_mode="freq")
         assert enh_transform is not None
         self.base_rnn = PyTorchRNNEncoder(input_size,
@@ -111,11 +112,14 @@ class RNNEnhML(SSEBase):
                                           dropout=dropout,
                                           bidirectional=bidirectional,
                                           non_linear="sigmoid")
+        # use PyTorch native complex tensor in ComplexTensor or not
+        self.native_cplx = native_cplx
 
-    def infer(self, noisy: th.Tensor) -> th.Tensor:
+    def infer(self, noisy: th.Tensor, mode: str = "freq") -> th.Tensor:
         """
         Args
             noisy: C x S
+            mode: only freq mode (TF masks) is supported
         Return
             masks (Tensor): T x F
         """
@@ -133,7 +137,10 @@ class RNNEnhML(SSEBase):
         obs = ComplexTensor(obs[..., 0], obs[..., 1])
         mag_norm = th.norm(mag, p=2, dim=1, keepdim=True)
         mag = mag / th.clamp(mag_norm, min=EPSILON)
-        obs = ComplexTensor(mag, obs.angle(), polar=True)
+        obs = ComplexTensor(mag,
+                            obs.angle(),
+                            polar=True,
+                            native=self.native_cplx)
         return obs
 
     def forward(self, noisy: th.Tensor) -> Union[ComplexTensor, th.Tensor]:
@@ -77,8 +77,8 @@ class StreamingASREncoder(nn.Module):
                     f"tensor, but got {x_dim}")
             x = x[None, ...]
         # pad context
-        if self.rctx + self.rctx > 0:
-            x = tf.pad(x, (0, 0, self.rctx, self.rctx), "constant", 0)
+        if self.lctx + self.rctx > 0:
+            x = tf.pad(x, (0, 0, self.lctx, self.rctx), "constant", 0)
         # N x Ti x D
         enc_out, _ = self.encoder(x, None)
         # N x Ti x D or Ti x N x D (for xfmr)
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+
+# Copyright 2021 Jian Wu
+# License: Apache 2.0 (http://www.apache.org/licenses/LICENSE-2.0)
+
+import time
+import torch as th
+import torch.nn as nn
+import torch.nn.functional as tf
+
+from aps.streaming_asr.ctc import CtcASR
+from aps.streaming_asr.transducers import TransducerASR
+from aps.streaming_asr.base.encoder import StreamingFSMNEncoder, StreamingConv1dEncoder, StreamingConv2dEncoder
+from aps.streaming_asr.transformer.encoder import StreamingTransformerEncoder
+from aps.asr.beam_search.ctc import CtcApi, CtcPrefixBeam
+from aps.asr.beam_search.transducer import TransducerBeamSearch
+from aps.utils import get_logger
+
+from typing import Optional, Dict, List
+
+logger = get_logger(__name__)
+
+
+def encoder_stride(encoder: nn.Module) -> int:
+    """
+    Return the stride (on time axis) of the streaming encoder
+    """
+    if isinstance(encoder, StreamingTransformerEncoder):
+        return encoder.chunk
+    stride = 1
+    if isinstance(encoder, (StreamingConv1dEncoder, StreamingConv2dEncoder)):
+        for s in encoder.stride:
+            stride *= s if isinstance(s, int) else s[0]
+    return stride
+
+
+class StreamingDecodingSession(object):
+    """
+    Stateful decoding session for the streaming ASR models (CTC & transducer).
+    Each chunk goes through asr_transform => encoder.step => frame synchronous
+    search (CTC prefix beam search or transducer beam search), so we can get
+    the partial hypothesis after each chunk and the latency statistics
+
+    Args:
+        nnet: streaming ASR model, CtcASR or TransducerASR
+        beam_size: beam size used in the search
+        nbest: number of the final hypothesis
+        chunk: number of the new input frames for each encoder step, derived
+               from the encoder if None
+        lm: LM used in transducer beam search
+        lm_weight: LM score weight
+        len_norm: using length normalized score or not
+        max_sym_per_frame: maximum number of tokens emitted per frame
+                           (transducer)
+        sr: sample rate of the audio
+        frame_shift: frame shift (in seconds) of the input features (if the
+                     model doesn't has asr_transform)
+    NOTE: asr_transform should be computed frame by frame, i.e., without
+          center padding, utterance-level cmvn, splice & delta features
+    """
+
+    def __init__(self,
+                 nnet: nn.Module,
+                 beam_size: int = 8,
+                 nbest: int = 1,
+                 chunk: Optional[int] = None,
+                 lm: Optional[nn.Module] = None,
+                 lm_weight: float = 0,
+                 len_norm: bool = True,
+                 max_sym_per_frame: int = 1,
+                 sr: int = 16000,
+                 frame_shift: float = 0.01) -> None:
+        if not isinstance(nnet, (CtcASR, TransducerASR)):
+            raise ValueError("StreamingDecodingSession: only support " +
+                             f"CtcASR & TransducerASR, but got {type(nnet)}")
+        self.nnet = nnet
+        self.beam_size = beam_size
+        self.nbest = min(nbest, beam_size)
+        self.lm_weight = lm_weight
+        self.len_norm = len_norm
+        self.max_sym_per_frame = max_sym_per_frame
+        self.device = next(nnet.parameters()).device
+        # waveform => feature
+        self.frame_len, self.frame_hop = -1, -1
+        transform = nnet.asr_transform
+        if transform is not None and transform.spectra_index != -1:
+            stft = transform.transform[transform.spectra_index]
+            if stft.center:
+                raise ValueError("StreamingDecodingSession: asr_transform " +
+                                 "with center = True is not supported")
+            self.frame_len, self.frame_hop = stft.win_length, stft.frame_hop
+            self.frame_shift = self.frame_hop / sr
+        else:
+            self.frame_shift = frame_shift
+        self.sr = sr
+        # feature => encoder: each step we feed lctx + chunk + rctx frames
+        self.lctx, self.rctx = max(nnet.lctx, 0), max(nnet.rctx, 0)
+        self.chunk = encoder_stride(nnet.encoder) if chunk is None else chunk
+        if isinstance(nnet.encoder, StreamingFSMNEncoder) and self.chunk != 1:
+            raise ValueError("StreamingDecodingSession: chunk should be 1 " +
+                             f"for FSMN encoder, but got {self.chunk}")
+        if isinstance(nnet, TransducerASR):
+            self.search_api = TransducerBeamSearch(nnet.decoder,
+                                                   lm=lm,
+                                                   blank=nnet.blank)
+        else:
+            self.search_api = CtcApi(nnet.vocab_size - 1)
+        logger.info(f"StreamingDecodingSession: chunk = {self.chunk}, " +
+                    f"lctx = {self.lctx}, rctx = {self.rctx}")
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Reset the session (for a new utterance)
+        """
+        if hasattr(self.nnet.encoder, "reset"):
+            self.nnet.encoder.reset()
+        self.samples = None
+        self.feats = None
+        if isinstance(self.nnet, TransducerASR):
+            self.pred_cache, self.lm_cache = self.search_api.init_cache(
+                lm_weight=self.lm_weight)
+            self.hypos = [((self.nnet.blank,), 0.0)]
+        else:
+            self.search = CtcPrefixBeam(self.search_api.blank,
+                                        beam_size=self.beam_size)
+        self.num_frames = 0
+        self.stats = []
+
+    def _extract(self, chunk: th.Tensor) -> Optional[th.Tensor]:
+        """
+        Compute features of the complete frames in the buffered samples
+        Args:
+            chunk (Tensor): S (audio samples) or T x F (features)
+        Return:
+            feats (Tensor): 1 x T x F or None
+        """
+        transform = self.nnet.asr_transform
+        if transform is None:
+            return chunk[None, ...]
+        if self.frame_hop < 0:
+            return transform(chunk[None, ...], None)[0]
+        self.samples = chunk if self.samples is None else th.cat(
+            [self.samples, chunk], -1)
+        num_samples = self.samples.shape[-1]
+        if num_samples < self.frame_len:
+            return None
+        num_frames = (num_samples - self.frame_len) // self.frame_hop + 1
+        end = (num_frames - 1) * self.frame_hop + self.frame_len
+        feats, _ = transform(self.samples[None, :end], None)
+        self.samples = self.samples[num_frames * self.frame_hop:]
+        return feats
+
+    def _encode(self, flush: bool = False) -> Optional[th.Tensor]:
+        """
+        Run encoder.step on the buffered features
+        Return:
+            enc_out (Tensor): 1 x T x D or None
+        """
+        window = self.lctx + self.chunk + self.rctx
+        enc_out = []
+        while self.feats is not None and self.feats.shape[1] >= window:
+            enc_out.append(self.nnet.encoder.step(self.feats[:, :window]))
+            self.feats = self.feats[:, self.chunk:]
+        # the last (incomplete) chunk
+        if flush and self.feats is not None:
+            if self.feats.shape[1] > self.lctx + self.rctx:
+                enc_out.append(self.nnet.encoder.step(self.feats))
+            self.feats = None
+        if not enc_out:
+            return None
+        enc_out = th.cat(enc_out, 1)
+        if isinstance(self.nnet, CtcASR) and self.nnet.ctc is not None:
+            enc_out = self.nnet.ctc(enc_out)
+        return enc_out
+
+    def _search(self, enc_out: th.Tensor) -> None:
+        """
+        Update the search with the encoder frames
+        Args:
+            enc_out (Tensor): 1 x T x D
+        """
+        if isinstance(self.nnet, TransducerASR):
+            # 1 x T x J
+            enc_proj = self.nnet.decoder.enc_proj(enc_out)
+            for t in range(enc_proj.shape[1]):
+                self.hypos = self.search_api.frame_step(
+                    [self.hypos],
+                    enc_proj[:, t],
+                    self.pred_cache,
+                    lm_cache=self.lm_cache,
+                    beam_size=self.beam_size,
+                    lm_weight=self.lm_weight,
+                    max_sym_per_frame=self.max_sym_per_frame)[0]
+                alive = [h[0] for h in self.hypos]
+                self.pred_cache.prune(alive)
+                if self.lm_cache is not None:
+                    self.lm_cache.prune(alive)
+        else:
+            # T x V
+            ctc_prob = th.log_softmax(enc_out[0], -1)
+            topk_score, topk_token = th.topk(ctc_prob, self.beam_size, -1)
+            topk_score = topk_score.cpu().numpy()
+            topk_token = topk_token.cpu().numpy()
+            blank_score = ctc_prob[:, self.search_api.blank].cpu().numpy()
+            for t in range(ctc_prob.shape[0]):
+                self.search.step(topk_score[t], topk_token[t], blank_score[t])
+
+    def _nbest_hypos(self, nbest: int) -> List[Dict]:
+        """
+        Return the nbest hypothesis of current step
+        """
+        if isinstance(self.nnet, TransducerASR):
+            return self.search_api.nbest_hypos(self.hypos,
+                                               nbest=nbest,
+                                               len_norm=self.len_norm)
+        prefixes, scores = self.search.prefixes()
+        return self.search_api.nbest_hypos(prefixes,
+                                           scores,
+                                           nbest=nbest,
+                                           len_norm=self.len_norm)
+
+    def _process(self, chunk: Optional[th.Tensor], flush: bool) -> None:
+        """
+        Process one chunk and record the latency statistics
+        """
+        start = time.perf_counter()
+        num_frames = 0
+        if chunk is not None:
+            feats = self._extract(chunk.to(self.device))
+            if feats is not None:
+                num_frames = feats.shape[1]
+                if self.feats is None:
+                    # left context of the first chunk
+                    self.feats = tf.pad(feats, (0, 0, self.lctx, 0), "constant",
+                                        0)
+                else:
+                    self.feats = th.cat([self.feats, feats], 1)
+        if flush and self.feats is not None:
+            self.feats = tf.pad(self.feats, (0, 0, 0, self.rctx), "constant", 0)
+        enc_out = self._encode(flush=flush)
+        if enc_out is not None:
+            self._search(enc_out)
+        cost = time.perf_counter() - start
+        if chunk is None:
+            dur = 0
+        elif self.frame_hop > 0:
+            dur = chunk.shape[-1] / self.sr
+        else:
+            dur = num_frames * self.frame_shift
+        self.num_frames += num_frames
+        self.stats.append({
+            "duration": dur,
+            "time": cost,
+            "enc_frames": 0 if enc_out is None else enc_out.shape[1],
+            "flush": flush
+        })
+
+    def step(self, chunk: th.Tensor) -> Dict:
+        """
+        Process one chunk and return the partial (best) hypothesis
+        Args:
+            chunk (Tensor): audio samples (S) or features (T x F)
+        Return:
+            hyp (dict): {"score": ..., "trans": ...}
+        """
+        with th.no_grad():
+            self._process(chunk, False)
+            return self._nbest_hypos(1)[0]
+
+    def flush(self) -> List[Dict]:
+        """
+        Flush the buffered frames (end of the stream) and return the nbest
+        hypothesis
+        """
+        with th.no_grad():
+            self._process(None, True)
+            nbest = self._nbest_hypos(self.nbest)
+        summary = self.latency()
+        logger.info(
+            "--- streaming decoding done: " +
+            f"{summary['num_chunks']} chunks, {summary['duration']:.2f}s, " +
+            f"average/max latency per chunk = {summary['avg'] * 1000:.2f}/" +
+            f"{summary['max'] * 1000:.2f}ms, flush latency = " +
+            f"{summary['flush'] * 1000:.2f}ms, RTF = {summary['rtf']:.4f}")
+        return nbest
+
+    def latency(self) -> Dict:
+        """
+        Return the latency (processing time in seconds) statistics
+        """
+        chunks = [s["time"] for s in self.stats if not s["flush"]]
+        flush = [s["time"] for s in self.stats if s["flush"]]
+        dur = sum(s["duration"] for s in self.stats)
+        cost = sum(s["time"] for s in self.stats)
+        return {
+            "num_chunks": len(chunks),
+            "duration": dur,
+            "avg": sum(chunks) / len(chunks) if chunks else 0,
+            "max": max(chunks) if chunks else 0,
+            "flush": flush[-1] if flush else 0,
+            "rtf": cost / dur if dur > 0 else 0
+        }
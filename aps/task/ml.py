@@ -19,6 +19,10 @@ def hermitian_det(Bk: ComplexTensor, eps: float = EPSILON) -> th.Tensor:
     Return:
         det (Tensor): N x F
     """
+    if Bk.is_native:
+        # N x F, det of the hermitian matrices is real
+        _, logdet = th.linalg.slogdet(Bk.native())
+        return th.clamp(th.exp(logdet), min=eps)
     # N x F x C x 2C
     m = th.cat([Bk.real, -Bk.imag], -1)
     # N x F x C x 2C
@@ -90,10 +94,8 @@ class MlEnhTask(Task):
         Bk = Bk + I * self.eps
         # N x F
         Dk = hermitian_det(Bk, eps=self.eps)
-        # N x F x C x C
-        Bk_inv = Bk.inverse()
         # N x F x T: einsum("...xt,...xy,...yt->...t", obs.conj(), Bk_inv, obs)
-        K = (obs.conj() * (Bk_inv @ obs)).sum(-2)
+        K = (obs.conj() * Bk.solve(obs)).sum(-2)
         K = th.clamp(K.real, min=self.eps)
         # N x F x T
         log_pdf = -C * th.log(K) - th.log(Dk[..., None])
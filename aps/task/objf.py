@@ -1,12 +1,14 @@
 # Copyright 2020 Jian Wu
 # License: Apache 2.0 (http://www.apache.org/licenses/LICENSE-2.0)
 
+import numpy as np
 import torch as th
 import torch.nn as nn
 import torch.nn.functional as tf
 
 from itertools import permutations
 from typing import List, Any, Callable, Optional
+from scipy.optimize import linear_sum_assignment
 from aps.const import IGNORE_ID, EPSILON
 
 
@@ -275,12 +277,61 @@ def multiple_objf(inp: List[Any],
     return loss
 
 
+def pairwise_objf(inp: List[th.Tensor], ref: List[th.Tensor],
+                  objf: Callable) -> th.Tensor:
+    """
+    Compute pairwise loss matrix in one batched call of the objf
+    (objf should compute the loss of each utterance independently)
+    Args:
+        inp (list(Tensor)): estimated list, S x [N x ...]
+        ref (list(Tensor)): reference list, S x [N x ...]
+        objf (function): function to compute single pair loss (per mini-batch)
+    Return:
+        loss (Tensor): N x S x S, loss[n, s, t] = objf(inp[s], ref[t])[n]
+    """
+    num_spks = len(inp)
+    batch_size = inp[0].shape[0]
+    # S^2N x ..., ordered by (s, t, n)
+    inp_pair = th.cat([i for i in inp for _ in range(num_spks)])
+    ref_pair = th.cat(ref * num_spks)
+    loss = objf(inp_pair, ref_pair)
+    return loss.view(num_spks, num_spks, batch_size).permute(2, 0, 1)
+
+
+def permu_assignment(loss_mat: th.Tensor, max_enum_spks: int = 3) -> th.Tensor:
+    """
+    Solve the permutation with minimum loss from the pairwise loss matrix. If
+    #spks <= max_enum_spks, we enumerate all the permutations (on device),
+    otherwise use hungarian algorithm (linear assignment on CPU)
+    Args:
+        loss_mat (Tensor): N x S x S, pairwise loss matrix
+        max_enum_spks (int): maximum number of speakers to enumerate the permutations
+    Return:
+        permu (Tensor): N x S, inp[s] <=> ref[permu[n, s]]
+    """
+    N, S, _ = loss_mat.shape
+    loss_mat = loss_mat.detach()
+    if S <= max_enum_spks:
+        # P x S
+        permu = th.tensor(list(permutations(range(S))), device=loss_mat.device)
+        # N x P
+        permu_loss = th.sum(loss_mat[:, th.arange(S), permu], -1)
+        return permu[th.argmin(permu_loss, -1)]
+    else:
+        permu = [
+            linear_sum_assignment(mat)[1] for mat in loss_mat.cpu().numpy()
+        ]
+        return th.from_numpy(np.stack(permu)).to(loss_mat.device)
+
+
 def permu_invarint_objf(inp: List[Any],
                         ref: List[Any],
                         objf: Callable,
                         transform: Optional[Callable] = None,
                         batchmean: bool = False,
-                        return_permutation: bool = False) -> th.Tensor:
+                        return_permutation: bool = False,
+                        pairwise: bool = True,
+                        max_enum_spks: int = 3) -> th.Tensor:
     """
     Compute permutation-invariant loss
     Args:
@@ -289,6 +340,11 @@ def permu_invarint_objf(inp: List[Any],
         objf (function): function to compute single pair loss (per mini-batch)
         transform (callable): transform function on inp & ref
         batchmean (bool): return mean value of the loss
+        return_permutation (bool): return the permutation (N x S) or not
+        pairwise (bool): compute S x S pairwise loss matrix and solve the permutation
+                         on it, otherwise compute the loss of all S! permutations
+                         (brute force, fallback for the non-tensor inputs)
+        max_enum_spks (int): see permu_assignment(...)
     Return:
         loss (Tensor): N (per mini-batch) if batchmean == False
     """
@@ -312,15 +368,22 @@ def permu_invarint_objf(inp: List[Any],
     if num_spks == 1:
         return objf(inp[0], ref[0])
 
-    loss_mat = th.stack(
-        [permu_objf(p, inp, ref) for p in permutations(range(num_spks))])
-
-    # if we want to maximize the objective, i.e, snr, remember to add negative flag to the objf
-    loss, index = th.min(loss_mat, dim=0)
+    if pairwise and all(isinstance(t, th.Tensor) for t in inp + ref):
+        # N x S x S
+        loss_mat = pairwise_objf(inp, ref, objf)
+        # N x S
+        permu = permu_assignment(loss_mat, max_enum_spks=max_enum_spks)
+        loss = th.gather(loss_mat, 2, permu[..., None])[..., 0].mean(-1)
+    else:
+        permu = th.tensor(list(permutations(range(num_spks))))
+        loss_mat = th.stack([permu_objf(p, inp, ref) for p in permu.tolist()])
+        # if we want to maximize the objective, i.e, snr, remember to add negative flag to the objf
+        loss, index = th.min(loss_mat, dim=0)
+        permu = permu.to(index.device)[index]
     if batchmean:
         loss = th.mean(loss)
     if return_permutation:
-        return loss, index
+        return loss, permu
     else:
         return loss
 
@@ -331,7 +394,8 @@ def hybrid_permu_objf(out: List[Any],
                       transform: Optional[Callable] = None,
                       weight: Optional[List[float]] = None,
                       permute: bool = True,
-                      permu_num_spks: int = 2) -> th.Tensor:
+                      permu_num_spks: int = 2,
+                      pairwise: bool = True) -> th.Tensor:
     """
     Return hybrid loss (pair-wise, permutated or pair-wise + permutated)
     Args:
@@ -341,6 +405,7 @@ def hybrid_permu_objf(out: List[Any],
         weight (list(float)): weight on each loss value
         permute (bool): use permutation invariant or not
         permu_num_spks (int): number of speakers when computing PIT
+        pairwise (bool): solve PIT on the pairwise loss matrix or not
     """
     num_branch = len(out)
     if num_branch != len(ref):
@@ -352,7 +417,8 @@ def hybrid_permu_objf(out: List[Any],
         loss = permu_invarint_objf(out[:permu_num_spks],
                                    ref[:permu_num_spks],
                                    objf,
-                                   transform=transform)
+                                   transform=transform,
+                                   pairwise=pairwise)
         # add residual loss
         if num_branch > permu_num_spks:
             # warnings.warn(f"#Branch: {num_branch} > #Speaker: {permu_num_spks}")
@@ -20,7 +20,7 @@ import torch.nn.functional as tf
 
 from typing import Optional, Union, Tuple
 from aps.transform.utils import STFT, mel_filter, splice_feature, speed_perturb_filter
-from aps.transform.augment import tf_mask, perturb_speed
+from aps.transform.augment import tf_mask, perturb_speed_batch
 from aps.const import EPSILON, MAX_INT16
 from aps.libs import ApsRegisters
 
@@ -173,26 +173,15 @@ class SpeedPerturbTransform(nn.Module):
         self.last_choice = None
         if not self.training:
             return wav
-        if wav.dim() != 2:
-            raise RuntimeError(f"Now only supports 2D tensor, got {wav.dim()}")
-        choice = th.randint(0, len(self.weights) + 1, (wav.shape[0],))
-        self.last_choice = choice
-        wav_sp = []
+        if wav.dim() not in [2, 3]:
+            raise RuntimeError(
+                f"Now only supports 2D/3D tensor, got {wav.dim()}")
         # each utterance is different
         # NOTE: make it same in previous commits
-        for i, c in enumerate(self.last_choice.tolist()):
-            # 1.0, do not apply speed perturb
-            if c == len(self.weights):
-                wav_sp.append(wav[i])
-            else:
-                wav_sp.append(perturb_speed(wav[i:i + 1], self.weights[c])[0])
-        # may produce longer utterance
-        wav_sp_pad = th.zeros(
-            [wav.shape[0], max([w.shape[-1] for w in wav_sp])],
-            device=wav.device)
-        for i, w in enumerate(wav_sp):
-            wav_sp_pad[i, :w.shape[-1]] = w
-        return wav_sp_pad
+        choice = th.randint(0, len(self.weights) + 1, (wav.shape[0],))
+        self.last_choice = choice
+        # one conv1d for the utterances with the same factor
+        return perturb_speed_batch(wav, list(self.weights), choice)
 
 
 class TFTransposeTransform(nn.Module):
@@ -236,6 +225,7 @@ class SpectrogramTransform(STFT):
         normalized: use normalized DFT kernel
         onesided: output onesided STFT
         mode: "kaldi"|"librosa", slight difference on applying window function
+        backend: STFT backend, "conv"|"rfft"|"stft"|"auto"
         power: return power spectrogram or not
     """
 
@@ -248,7 +238,8 @@ class SpectrogramTransform(STFT):
                  normalized: bool = False,
                  pre_emphasis: float = 0.97,
                  onesided: bool = True,
-                 mode: str = "librosa") -> None:
+                 mode: str = "librosa",
+                 backend: str = "conv") -> None:
         super(SpectrogramTransform,
               self).__init__(frame_len,
                              frame_hop,
@@ -258,7 +249,8 @@ class SpectrogramTransform(STFT):
                              pre_emphasis=pre_emphasis,
                              normalized=normalized,
                              onesided=onesided,
-                             mode=mode)
+                             mode=mode,
+                             backend=backend)
 
     def dim(self) -> int:
         return self.num_bins
@@ -810,6 +802,7 @@ class FeatureTransform(nn.Module):
         stft_normalized: use normalized DFT kernel
         audio_norm: use audio samples normalized between [-1, 1] or [-MAX-INT16, MAX-INT16]
         stft_mode: "kaldi"|"librosa", slight difference on windowing
+        stft_backend: STFT backend, "conv"|"rfft"|"stft"|"auto"
         pre_emphasis: factor of preemphasis
         use_power: use power spectrogram or not
         sr: sample rate of the audio
@@ -843,6 +836,7 @@ class FeatureTransform(nn.Module):
                  round_pow_of_two: bool = True,
                  stft_normalized: bool = False,
                  stft_mode: str = "librosa",
+                 stft_backend: str = "conv",
                  audio_norm: bool = True,
                  pre_emphasis: float = 0.97,
                  use_power: bool = False,
@@ -881,6 +875,7 @@ class FeatureTransform(nn.Module):
         feats_dim = 0
         stft_kwargs = {
             "mode": stft_mode,
+            "backend": stft_backend,
             "window": window,
             "center": center,
             "normalized": stft_normalized,
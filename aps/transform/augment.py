@@ -7,7 +7,7 @@ import random
 import torch as th
 import torch.nn.functional as tf
 
-from typing import Tuple, Union
+from typing import Tuple, Union, List, Optional
 
 
 def tf_mask(batch: int,
@@ -107,3 +107,50 @@ def perturb_speed(wav: th.Tensor, weight: th.Tensor):
     wav = wav.transpose(1, 2).contiguous()
     # N x B*dst_sr
     return wav.view(N, -1)
+
+
+def perturb_speed_batch(wav: th.Tensor,
+                        weights: List[th.Tensor],
+                        choice: th.Tensor,
+                        group: Optional[bool] = None) -> th.Tensor:
+    """
+    Do speed perturb on a batch, utterances with the same factor are processed
+    in one conv1d call if group is true
+    Args:
+        wav (Tensor): N x (C) x S
+        weights (list[Tensor]): filters of the factors, dst_sr x src_sr x K
+        choice (Tensor): N, index of the factor for each utterance,
+                         len(weights) means keeping the original speed
+        group (bool): group the utterances or not, default is true on GPU.
+                      On CPU the grouped conv1d is slower than the per
+                      utterance one (the sub-batch falls out of cache)
+    Return
+        wav (Tensor): N x (C) x S', zero padded
+    """
+    if group is None:
+        group = wav.device.type != "cpu"
+    S = wav.shape[-1]
+    groups = th.unique(choice).tolist()
+    # output length of each group
+    out_len = [
+        S if c == len(weights) else S // weights[c].shape[1] *
+        weights[c].shape[0] for c in groups
+    ]
+    wav_sp = th.zeros(wav.shape[:-1] + (max(out_len),),
+                      dtype=wav.dtype,
+                      device=wav.device)
+    choice = choice.to(wav.device)
+    for c, L in zip(groups, out_len):
+        index = th.nonzero(choice == c, as_tuple=True)[0]
+        if c == len(weights):
+            wav_sp[index, ..., :L] = wav[index]
+        elif group:
+            # n x (C) x S => n(C) x L => n x (C) x L
+            sub = perturb_speed(wav[index].reshape(-1, S), weights[c])
+            wav_sp[index, ..., :L] = sub.view(index.shape[0], *wav.shape[1:-1],
+                                              L)
+        else:
+            for n in index.tolist():
+                sub = perturb_speed(wav[n].reshape(-1, S), weights[c])
+                wav_sp[n, ..., :L] = sub.view(*wav.shape[1:-1], L)
+    return wav_sp
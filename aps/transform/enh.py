@@ -399,6 +399,7 @@ class FeatureTransform(nn.Module):
         stft_normalized: use normalized DFT kernel
         audio_norm: use audio samples normalized between [-1, 1] or [-MAX-INT16, MAX-INT16]
         stft_mode: "kaldi"|"librosa", slight difference on windowing
+        stft_backend: STFT backend, "conv"|"rfft"|"stft"|"auto"
         pre_emphasis: factor of preemphasis
         use_power: use power spectrogram or not
         sr: sample rate of the audio
@@ -434,6 +435,7 @@ class FeatureTransform(nn.Module):
                  round_pow_of_two: bool = True,
                  stft_normalized: bool = False,
                  stft_mode: str = "librosa",
+                 stft_backend: str = "conv",
                  center: bool = False,
                  ref_channel: int = 0,
                  use_power: bool = False,
@@ -471,6 +473,7 @@ class FeatureTransform(nn.Module):
         self.frame_hop = frame_hop
         self.stft_kwargs = {
             "mode": stft_mode,
+            "backend": stft_backend,
             "window": window,
             "center": center,
             "normalized": stft_normalized,
@@ -490,6 +493,7 @@ class FeatureTransform(nn.Module):
                                          round_pow_of_two=round_pow_of_two,
                                          stft_normalized=stft_normalized,
                                          stft_mode=stft_mode,
+                                         stft_backend=stft_backend,
                                          center=center,
                                          use_power=use_power,
                                          sr=sr,
@@ -557,7 +561,11 @@ class FeatureTransform(nn.Module):
         ctx = {"forward_stft": STFT, "inverse_stft": iSTFT}
         if name not in ctx:
             raise ValueError(f"Unknown task context: {name}")
-        return ctx[name](self.frame_len, self.frame_hop, **self.stft_kwargs)
+        stft_kwargs = self.stft_kwargs
+        # th.stft backend is not available for iSTFT
+        if name == "inverse_stft" and stft_kwargs["backend"] == "stft":
+            stft_kwargs = {**stft_kwargs, "backend": "conv"}
+        return ctx[name](self.frame_len, self.frame_hop, **stft_kwargs)
 
     def num_frames(self, wav_len: th.Tensor) -> th.Tensor:
         """
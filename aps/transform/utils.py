@@ -2,6 +2,7 @@
 # License: Apache 2.0 (http://www.apache.org/licenses/LICENSE-2.0)
 
 import math
+import time
 
 import numpy as np
 import torch as th
@@ -10,6 +11,7 @@ import torch.nn.functional as tf
 import librosa.filters as filters
 
 from aps.const import EPSILON, TORCH_VERSION
+from aps.utils import get_logger
 from typing import Optional, Tuple
 from distutils.version import LooseVersion
 
@@ -18,6 +20,8 @@ if TORCH_VERSION >= LooseVersion("1.7"):
 else:
     pass
 
+logger = get_logger(__name__)
+
 
 def export_jit(transform: nn.Module) -> nn.Module:
     """
@@ -224,25 +228,103 @@ def splice_feature(feats: th.Tensor,
     return splice
 
 
+def _stft_kernel(kernel: th.Tensor,
+                 window: th.Tensor,
+                 onesided: bool = True,
+                 inverse: bool = False) -> th.Tensor:
+    """
+    Return the windowed (i)STFT kernel used by conv1d/conv_transpose1d
+    Args:
+        kernel (Tensor): STFT transform kernels, from init_kernel(...)
+        window (Tensor): window tensor, from init_kernel(...)
+        onesided: only keep half FFT bins
+        inverse: the kernel is used for iSTFT
+    Return:
+        kernel (Tensor): 2F x 1 x W
+    """
+    fft_size = kernel.shape[0] // 2
+    # B x 1 x W
+    real, imag = th.chunk(kernel * window, 2, dim=0)
+    if onesided:
+        num_bins = fft_size // 2 + 1
+        real, imag = real[:num_bins], imag[:num_bins]
+        if inverse:
+            # fold the conjugate symmetric bins [num_bins, ..., B - 1] in
+            scale = th.ones(num_bins, 1, 1, device=kernel.device)
+            scale[1:fft_size - num_bins + 1] = 2
+            real, imag = real * scale, imag * scale
+    return th.cat([real, imag], 0)
+
+
+def _ola_denorm(window: th.Tensor, num_frames: int,
+                frame_hop: int) -> th.Tensor:
+    """
+    Return the overlap-add of the squared window (normalizer used in iSTFT)
+    Args:
+        window (Tensor): window tensor, W
+        num_frames: number of the frames
+        frame_hop: frame hop size in number samples
+    Return:
+        denorm (Tensor): 1 x 1 x S
+    """
+    win_length = window.shape[-1]
+    num_samples = (num_frames - 1) * frame_hop + win_length
+    # 1 x W x T
+    win = (window**2)[None, :, None].expand(1, win_length, num_frames)
+    denorm = tf.fold(win, (1, num_samples), (1, win_length),
+                     stride=(1, frame_hop))
+    return denorm[:, 0]
+
+
+def _framing(wav: th.Tensor,
+             frame_len: int,
+             frame_hop: int,
+             pre_emphasis: float = 0) -> th.Tensor:
+    """
+    Split the audio into frames (with kaldi style preemphasis)
+    Args:
+        wav (Tensor): N x S
+    Return:
+        frames (Tensor): N x T x W
+    """
+    frames = wav.unfold(-1, frame_len, frame_hop)
+    if pre_emphasis > 0:
+        # follow Kaldi's Preemphasize
+        frames = th.cat([
+            frames[..., :1] * (1 - pre_emphasis),
+            frames[..., 1:] - pre_emphasis * frames[..., :-1]
+        ], -1)
+    return frames
+
+
 def _forward_stft(wav: th.Tensor,
-                  kernel: th.Tensor,
+                  kernel: Optional[th.Tensor],
                   window: th.Tensor,
+                  fft_size: int,
+                  backend: str = "conv",
                   return_polar: bool = False,
                   pre_emphasis: float = 0,
                   frame_hop: int = 256,
                   onesided: bool = False,
                   center: bool = False,
+                  normalized: bool = False,
                   eps: float = EPSILON) -> th.Tensor:
     """
-    STFT function implemented by conv1d (not efficient, but we don't care during training)
+    STFT function implemented by conv1d, rfft or th.stft (only the
+    necessary frequency bins are computed)
     Args:
         wav (Tensor): N x (C) x S
-        kernel (Tensor): STFT transform kernels, from init_kernel(...)
+        kernel (Tensor): windowed STFT kernel, from _stft_kernel(...),
+                         only required by conv backend
+        window (Tensor): window tensor, from init_kernel(...)
+        fft_size: number of the FFT size
+        backend: conv|rfft|stft
         return_polar: return [magnitude; phase] Tensor or [real; imag] Tensor
         pre_emphasis: factor of preemphasis
         frame_hop: frame hop size in number samples
         onesided: return half FFT bins
         center: if true, we assumed to have centered frames
+        normalized: use normalized DFT kernel
     Return:
         transform (Tensor): STFT transform results
     """
@@ -253,35 +335,51 @@ def _forward_stft(wav: th.Tensor,
     # else: reshape NC x 1 x S
     N, S = wav.shape[0], wav.shape[-1]
     wav = wav.view(-1, 1, S)
+    win_length = window.shape[-1]
     # NC x 1 x S+2P
     if center:
-        pad = kernel.shape[-1] // 2
+        pad = win_length // 2
         # NOTE: match with librosa
         wav = tf.pad(wav, (pad, pad), mode="reflect")
-    # STFT
-    kernel = kernel * window
-    if pre_emphasis > 0:
-        # NC x W x T
-        frames = tf.unfold(wav[:, None], (1, kernel.shape[-1]),
-                           stride=frame_hop,
-                           padding=0)
-        # follow Kaldi's Preemphasize
-        frames[:, 1:] = frames[:, 1:] - pre_emphasis * frames[:, :-1]
-        frames[:, 0] *= (1 - pre_emphasis)
-        # 1 x 2B x W, NC x W x T,  NC x 2B x T
-        packed = th.matmul(kernel[:, 0][None, ...], frames)
+    if backend == "conv":
+        if pre_emphasis > 0:
+            # NC x T x W
+            frames = _framing(wav[:, 0], win_length, frame_hop, pre_emphasis)
+            # 2F x W, NC x W x T => NC x 2F x T
+            packed = th.matmul(kernel[:, 0], frames.transpose(1, 2))
+        else:
+            packed = tf.conv1d(wav, kernel, stride=frame_hop, padding=0)
+        # NC x F x T
+        real, imag = th.chunk(packed, 2, dim=-2)
     else:
-        packed = tf.conv1d(wav, kernel, stride=frame_hop, padding=0)
-    # NC x 2B x T => N x C x 2B x T
+        if backend == "rfft":
+            # NC x T x W
+            frames = _framing(wav[:, 0], win_length, frame_hop, pre_emphasis)
+            fft_func = th.fft.rfft if onesided else th.fft.fft
+            # NC x T x F => NC x F x T
+            spec = fft_func(frames * window,
+                            fft_size,
+                            dim=-1,
+                            norm="ortho" if normalized else "backward")
+            spec = spec.transpose(1, 2)
+        elif backend == "stft":
+            # window length equals to the FFT size (librosa mode)
+            spec = th.stft(wav[:, 0],
+                           fft_size,
+                           hop_length=frame_hop,
+                           win_length=win_length,
+                           window=window,
+                           center=False,
+                           normalized=normalized,
+                           onesided=onesided,
+                           return_complex=True)
+        else:
+            raise ValueError(f"Unsupported STFT backend: {backend}")
+        real, imag = spec.real, spec.imag
+    # NC x F x T => N x C x F x T
     if wav_dim == 3:
-        packed = packed.view(N, -1, packed.shape[-2], packed.shape[-1])
-    # N x (C) x B x T
-    real, imag = th.chunk(packed, 2, dim=-2)
-    # N x (C) x B/2+1 x T
-    if onesided:
-        num_bins = kernel.shape[0] // 4 + 1
-        real = real[..., :num_bins, :]
-        imag = imag[..., :num_bins, :]
+        real = real.view(N, -1, real.shape[-2], real.shape[-1])
+        imag = imag.view(N, -1, imag.shape[-2], imag.shape[-1])
     if return_polar:
         mag = (real**2 + imag**2 + eps)**0.5
         pha = th.atan2(imag, real)
@@ -291,22 +389,32 @@ def _forward_stft(wav: th.Tensor,
 
 
 def _inverse_stft(transform: th.Tensor,
-                  kernel: th.Tensor,
+                  kernel: Optional[th.Tensor],
                   window: th.Tensor,
+                  denorm: th.Tensor,
+                  fft_size: int,
+                  backend: str = "conv",
                   return_polar: bool = False,
                   frame_hop: int = 256,
                   onesided: bool = False,
                   center: bool = False,
+                  normalized: bool = False,
                   eps: float = EPSILON) -> th.Tensor:
     """
-    iSTFT function implemented by conv1d
+    iSTFT function implemented by conv_transpose1d or irfft
     Args:
         transform (Tensor): STFT transform results
-        kernel (Tensor): STFT transform kernels, from init_kernel(...)
+        kernel (Tensor): windowed iSTFT kernel, from _stft_kernel(...),
+                         only required by conv backend
+        window (Tensor): window tensor, from init_kernel(...)
+        denorm (Tensor): OLA normalizer, from _ola_denorm(...)
+        fft_size: number of the FFT size
+        backend: conv|rfft
         return_polar (bool): keep same with the one in _forward_stft
         frame_hop: frame hop size in number samples
         onesided: return half FFT bins
         center: used in _forward_stft
+        normalized: use normalized DFT kernel
     Return:
         wav (Tensor), N x S
     """
@@ -315,7 +423,7 @@ def _inverse_stft(transform: th.Tensor,
     # if F x T x 2, reshape 1 x F x T x 2
     if transform_dim == 3:
         transform = th.unsqueeze(transform, 0)
-    if transform_dim != 4:
+    if transform.dim() != 4:
         raise RuntimeError(f"Expect 4D tensor, but got {transform_dim}D")
 
     if return_polar:
@@ -324,37 +432,32 @@ def _inverse_stft(transform: th.Tensor,
     else:
         real, imag = transform[..., 0], transform[..., 1]
 
-    if onesided:
-        # [self.num_bins - 2, ..., 1]
-        reverse = range(kernel.shape[0] // 4 - 1, 0, -1)
-        # extend matrix: N x B x T
-        real = th.cat([real, real[:, reverse]], 1)
-        imag = th.cat([imag, -imag[:, reverse]], 1)
-    # pack: N x 2B x T
-    packed = th.cat([real, imag], dim=1)
-    # N x 1 x T
-    wav = tf.conv_transpose1d(packed,
-                              kernel * window,
-                              stride=frame_hop,
-                              padding=0)
-    # normalized audio samples
-    # refer: https://github.com/pytorch/audio/blob/2ebbbf511fb1e6c47b59fd32ad7e66023fa0dff1/torchaudio/functional.py#L171
-    num_frames = packed.shape[-1]
-    win_length = window.shape[0]
-    # W x T
-    win = th.repeat_interleave(window[..., None]**2, num_frames, dim=-1)
-    # Do OLA on windows
-    # v1)
-    I = th.eye(win_length, device=win.device)[:, None]
-    denorm = tf.conv_transpose1d(win[None, ...], I, stride=frame_hop, padding=0)
-    # v2)
-    # num_samples = (num_frames - 1) * frame_hop + win_length
-    # denorm = tf.fold(win[None, ...], (num_samples, 1), (win_length, 1),
-    #                  stride=frame_hop)[..., 0]
+    win_length = window.shape[-1]
+    if backend == "conv":
+        # pack: N x 2F x T
+        packed = th.cat([real, imag], dim=1)
+        # N x 1 x S
+        wav = tf.conv_transpose1d(packed, kernel, stride=frame_hop, padding=0)
+    elif backend == "rfft":
+        # N x T x F
+        spec = th.complex(real, imag).transpose(1, 2)
+        norm = "ortho" if normalized else "backward"
+        if onesided:
+            frames = th.fft.irfft(spec, fft_size, dim=-1, norm=norm)
+        else:
+            frames = th.fft.ifft(spec, fft_size, dim=-1, norm=norm).real
+        # N x W x T
+        frames = (frames[..., :win_length] * window).transpose(1, 2)
+        # N x 1 x S
+        wav = tf.fold(frames, (1, denorm.shape[-1]), (1, win_length),
+                      stride=(1, frame_hop))[:, 0]
+    else:
+        raise ValueError(f"Unsupported iSTFT backend: {backend}")
     if center:
-        pad = kernel.shape[-1] // 2
+        pad = win_length // 2
         wav = wav[..., pad:-pad]
         denorm = denorm[..., pad:-pad]
+    # normalized audio samples
     wav = wav / (denorm + eps)
     # N x S
     return wav.squeeze(1)
@@ -480,6 +583,7 @@ def forward_stft(wav: th.Tensor,
                  onesided: bool = True,
                  center: bool = False,
                  mode: str = "librosa",
+                 backend: str = "conv",
                  eps: float = EPSILON) -> th.Tensor:
     """
     STFT function implementation, equals to STFT layer
@@ -496,6 +600,7 @@ def forward_stft(wav: th.Tensor,
         onesided: output onesided STFT
         inverse: using iDFT kernel (for iSTFT)
         mode: STFT mode, "kaldi" or "librosa" or "torch"
+        backend: STFT backend, "conv" or "rfft" or "stft" (see STFTBase)
     Return:
         transform: results of STFT
     """
@@ -521,14 +626,19 @@ def forward_stft(wav: th.Tensor,
                                      normalized=normalized,
                                      inverse=False,
                                      mode=mode)
+        if backend == "conv":
+            kernel = _stft_kernel(kernel, window, onesided=onesided)
         return _forward_stft(wav,
                              kernel,
                              window,
+                             kernel.shape[0] // 2,
+                             backend=backend,
                              return_polar=return_polar,
                              frame_hop=frame_hop,
                              pre_emphasis=pre_emphasis,
                              onesided=onesided,
                              center=center,
+                             normalized=normalized,
                              eps=eps)
 
 
@@ -542,6 +652,7 @@ def inverse_stft(transform: th.Tensor,
                  onesided: bool = True,
                  center: bool = False,
                  mode: str = "librosa",
+                 backend: str = "conv",
                  eps: float = EPSILON) -> th.Tensor:
     """
     iSTFT function implementation, equals to iSTFT layer
@@ -556,6 +667,7 @@ def inverse_stft(transform: th.Tensor,
         normalized: use normalized DFT kernel
         onesided: output onesided STFT
         mode: STFT mode, "kaldi" or "librosa" or "torch"
+        backend: iSTFT backend, "conv" or "rfft" (see STFTBase)
     Return:
         wav: synthetic signals
     """
@@ -581,13 +693,23 @@ def inverse_stft(transform: th.Tensor,
                                      normalized=normalized,
                                      inverse=True,
                                      mode=mode)
+        if backend == "conv":
+            kernel = _stft_kernel(kernel,
+                                  window,
+                                  onesided=onesided,
+                                  inverse=True)
         return _inverse_stft(transform,
                              kernel,
                              window,
+                             _ola_denorm(window, transform.shape[-2],
+                                         frame_hop),
+                             kernel.shape[0] // 2,
+                             backend=backend,
                              return_polar=return_polar,
                              frame_hop=frame_hop,
                              onesided=onesided,
                              center=center,
+                             normalized=normalized,
                              eps=eps)
 
 
@@ -595,6 +717,15 @@ class STFTBase(nn.Module):
     """
     Base layer for (i)STFT
 
+    The conv/rfft/stft backends give the same results (within the float
+    precision) for librosa & kaldi mode, with backend = "auto" (opt-in), we
+    time the available ones on the first call on each device and keep the
+    fastest. NOTE: the choice may differ between the runs (or the ranks), so
+    the results are not bit-wise reproducible then, use a fixed backend if
+    it's required.
+    The windowed (onesided) kernels and the OLA normalizers are cached on each
+    device, so they are not re-computed in each forward.
+
     Args:
         frame_len: length of the frame
         frame_hop: hop size between frames
@@ -604,6 +735,9 @@ class STFTBase(nn.Module):
         normalized: use normalized DFT kernel
         pre_emphasis: factor of preemphasis
         mode: STFT mode, "kaldi" or "librosa" or "torch"
+        backend: (i)STFT backend for kaldi & librosa mode, "conv" (conv1d,
+                 default) or "rfft" (framing + rfft) or "stft" (th.stft, only
+                 for STFT in librosa mode without preemphasis) or "auto"
         onesided: output onesided STFT
         inverse: using iDFT kernel (for iSTFT)
     """
@@ -618,7 +752,8 @@ class STFTBase(nn.Module):
                  onesided: bool = True,
                  inverse: bool = False,
                  center: bool = False,
-                 mode: str = "librosa") -> None:
+                 mode: str = "librosa",
+                 backend: str = "conv") -> None:
         super(STFTBase, self).__init__()
         if mode != "torch":
             K, w = init_kernel(frame_len,
@@ -633,6 +768,14 @@ class STFTBase(nn.Module):
             self.num_bins = self.K.shape[0] // 4 + 1
             self.pre_emphasis = pre_emphasis
             self.win_length = self.K.shape[2]
+            self.fft_size = self.K.shape[0] // 2
+            # available backends
+            self.backends = ["conv", "rfft"]
+            if not inverse and mode == "librosa" and pre_emphasis == 0:
+                self.backends.append("stft")
+            if backend != "auto" and backend not in self.backends:
+                raise ValueError(f"Unsupported backend: {backend}, " +
+                                 f"expect one of {self.backends}")
         else:
             self.K = None
             w = init_window(window, frame_len)
@@ -642,13 +785,26 @@ class STFTBase(nn.Module):
             self.num_bins = fft_size // 2 + 1
             self.pre_emphasis = 0
             self.win_length = fft_size
+            self.fft_size = fft_size
+            self.backends = ["torch"]
+            backend = "torch"
         self.frame_len = frame_len
         self.frame_hop = frame_hop
         self.window = window
         self.normalized = normalized
         self.onesided = onesided
+        self.inverse = inverse
         self.center = center
         self.mode = mode
+        self.backend = backend
+        # NOTE: K & w are constant, so the tensors derived from them are cached
+        # (device, dtype) => backend
+        self.backend_cache = {}
+        # (device, dtype) => windowed kernel
+        self.kernel_cache = {}
+        # (#frames, device, dtype) => OLA normalizer (iSTFT)
+        self.denorm_cache = {}
+        self.denorm_cache_size = 32
 
     def num_frames(self, wav_len: th.Tensor) -> th.Tensor:
         """
@@ -661,6 +817,68 @@ class STFTBase(nn.Module):
                       self.frame_hop,
                       rounding_mode="trunc") + 1
 
+    def _kernel(self) -> th.Tensor:
+        """
+        Return the cached (windowed) kernel used by conv backend
+        """
+        key = (self.K.device, self.K.dtype)
+        if key not in self.kernel_cache:
+            with th.no_grad():
+                self.kernel_cache[key] = _stft_kernel(self.K,
+                                                      self.w,
+                                                      onesided=self.onesided,
+                                                      inverse=self.inverse)
+        return self.kernel_cache[key]
+
+    def _denorm(self, num_frames: int) -> th.Tensor:
+        """
+        Return the cached OLA normalizer for iSTFT
+        """
+        key = (num_frames, self.w.device, self.w.dtype)
+        if key not in self.denorm_cache:
+            if len(self.denorm_cache) == self.denorm_cache_size:
+                # drop the earliest one
+                self.denorm_cache.pop(next(iter(self.denorm_cache)))
+            with th.no_grad():
+                self.denorm_cache[key] = _ola_denorm(self.w, num_frames,
+                                                     self.frame_hop)
+        return self.denorm_cache[key]
+
+    def _run(self, inp: th.Tensor, backend: str, return_polar: bool,
+             eps: float) -> th.Tensor:
+        raise NotImplementedError
+
+    def _select_backend(self,
+                        inp: th.Tensor,
+                        eps: float = EPSILON,
+                        num_repeats: int = 3) -> str:
+        """
+        Return the backend to use. For backend = "auto", time the available
+        ones (on the first input of each device) and choose the fastest one
+        """
+        if self.backend != "auto":
+            return self.backend
+        key = (inp.device, inp.dtype)
+        if key not in self.backend_cache:
+            cost = {}
+            sync = th.cuda.synchronize if inp.is_cuda else (lambda: None)
+            with th.no_grad():
+                for backend in self.backends:
+                    # warm up
+                    self._run(inp, backend, False, eps)
+                    sync()
+                    beg = time.perf_counter()
+                    for _ in range(num_repeats):
+                        self._run(inp, backend, False, eps)
+                    sync()
+                    cost[backend] = time.perf_counter() - beg
+            self.backend_cache[key] = min(cost, key=cost.get)
+            logger.info(f"{self.__class__.__name__}: choose backend " +
+                        f"{self.backend_cache[key]} on {inp.device} (" +
+                        ", ".join(f"{b} = {c * 1000 / num_repeats:.2f}ms"
+                                  for b, c in cost.items()) + ")")
+        return self.backend_cache[key]
+
     def extra_repr(self) -> str:
         str_repr = (
             f"num_bins={self.num_bins}, win_length={self.win_length}, " +
@@ -672,6 +890,8 @@ class STFTBase(nn.Module):
             str_repr += f", pre_emphasis={self.pre_emphasis}"
         if self.normalized:
             str_repr += f", normalized={self.normalized}"
+        if self.mode != "torch":
+            str_repr += f", backend={self.backend}"
         return str_repr
 
 
@@ -683,6 +903,21 @@ class STFT(STFTBase):
     def __init__(self, *args, **kwargs):
         super(STFT, self).__init__(*args, inverse=False, **kwargs)
 
+    def _run(self, wav: th.Tensor, backend: str, return_polar: bool,
+             eps: float) -> th.Tensor:
+        return _forward_stft(wav,
+                             self._kernel() if backend == "conv" else None,
+                             self.w,
+                             self.fft_size,
+                             backend=backend,
+                             return_polar=return_polar,
+                             frame_hop=self.frame_hop,
+                             pre_emphasis=self.pre_emphasis,
+                             onesided=self.onesided,
+                             center=self.center,
+                             normalized=self.normalized,
+                             eps=eps)
+
     def forward(self,
                 wav: th.Tensor,
                 return_polar: bool = False,
@@ -706,15 +941,8 @@ class STFT(STFTBase):
                                  center=self.center,
                                  eps=eps)
         else:
-            return _forward_stft(wav,
-                                 self.K,
-                                 self.w,
-                                 return_polar=return_polar,
-                                 frame_hop=self.frame_hop,
-                                 pre_emphasis=self.pre_emphasis,
-                                 onesided=self.onesided,
-                                 center=self.center,
-                                 eps=eps)
+            backend = self._select_backend(wav, eps=eps)
+            return self._run(wav, backend, return_polar, eps)
 
 
 class iSTFT(STFTBase):
@@ -725,6 +953,21 @@ class iSTFT(STFTBase):
     def __init__(self, *args, **kwargs):
         super(iSTFT, self).__init__(*args, inverse=True, **kwargs)
 
+    def _run(self, transform: th.Tensor, backend: str, return_polar: bool,
+             eps: float) -> th.Tensor:
+        return _inverse_stft(transform,
+                             self._kernel() if backend == "conv" else None,
+                             self.w,
+                             self._denorm(transform.shape[-2]),
+                             self.fft_size,
+                             backend=backend,
+                             return_polar=return_polar,
+                             frame_hop=self.frame_hop,
+                             onesided=self.onesided,
+                             center=self.center,
+                             normalized=self.normalized,
+                             eps=eps)
+
     def forward(self,
                 transform: th.Tensor,
                 return_polar: bool = False,
@@ -748,11 +991,5 @@ class iSTFT(STFTBase):
                                   center=self.center,
                                   eps=eps)
         else:
-            return _inverse_stft(transform,
-                                 self.K,
-                                 self.w,
-                                 return_polar=return_polar,
-                                 frame_hop=self.frame_hop,
-                                 onesided=self.onesided,
-                                 center=self.center,
-                                 eps=eps)
+            backend = self._select_backend(transform, eps=eps)
+            return self._run(transform, backend, return_polar, eps)
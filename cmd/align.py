@@ -6,6 +6,8 @@
 import pprint
 import argparse
 
+import multiprocessing as mp
+
 import torch as th
 import numpy as np
 
@@ -14,9 +16,11 @@ from aps.eval import NnetEvaluator, TextPreProcessor
 from aps.conf import load_dict
 from aps.utils import get_logger, SimpleTimer
 from aps.io import AudioReader, SegmentAudioReader, io_wrapper
+from aps.asr.beam_search.ctc import CtcApi
 
+from collections import deque
 from kaldi_python_io import ScriptReader, Reader
-from typing import Dict, Optional
+from typing import Dict, List, Optional
 
 logger = get_logger(__name__)
 """
@@ -48,6 +52,29 @@ class CtcAligner(NnetEvaluator):
         seq = th.tensor(seq, dtype=th.int64).to(self.device)
         return self.nnet.ctc_align(inp, seq)
 
+    def run_batch(self, inps: List[np.ndarray],
+                  seqs: List[np.ndarray]) -> List[Dict]:
+        inps = [th.from_numpy(inp).to(self.device) for inp in inps]
+        seqs = [th.tensor(seq, dtype=th.int64).to(self.device) for seq in seqs]
+        return self.nnet.ctc_align_batch(inps, seqs)
+
+    def ctc_logits(self, inps: List[np.ndarray]) -> List[np.ndarray]:
+        inps = [th.from_numpy(inp).to(self.device) for inp in inps]
+        enc_out, enc_len = self.nnet.ctc_logits_batch(inps)
+        enc_out = enc_out.cpu().numpy()
+        return [out[:n] for out, n in zip(enc_out, enc_len.tolist())]
+
+
+def viterbi_init() -> None:
+    # avoid over-subscription when running in parallel
+    th.set_num_threads(1)
+
+
+def viterbi_worker(blank: int, ctc_enc: np.ndarray, seq: List[int]) -> Dict:
+    ctc_api = CtcApi(blank)
+    return ctc_api.viterbi_align(th.from_numpy(ctc_enc),
+                                 th.tensor(seq, dtype=th.int64))
+
 
 def gen_word_boundary(key: str,
                       dur: float,
@@ -105,23 +132,68 @@ def run(args):
     done = 0
     tot_utts = len(src_reader)
     timer = SimpleTimer()
-    for key, str_seq in txt_reader:
-        done += 1
-        logger.info(
-            f"Generate alignment for utterance {key} ({done}/{tot_utts}) ...")
-        int_seq = processor.run(str_seq)
-        wav_or_feats = src_reader[key]
-        ali = aligner.run(wav_or_feats, int_seq)
+
+    def dump_ali(key: str, ali: Dict, num_samples: int):
         header = f"{ali['score']:.3f}, {len(ali['align_seq'])}"
         ali_fd.write(f"{key} {ali['align_str']}\n")
         logger.info(f"{key} ({header}) {ali['align_str']}")
         if wdb_fd:
-            dur = wav_or_feats.shape[-1] * 1.0 / args.sr
+            dur = num_samples * 1.0 / args.sr
             wdb = gen_word_boundary(key,
                                     dur,
                                     ali["align_str"],
                                     vocab=vocab_dict)
             wdb_fd.write("\n".join(wdb) + "\n")
+
+    pool = None
+    if args.num_jobs > 1:
+        pool = mp.Pool(args.num_jobs, initializer=viterbi_init)
+        logger.info(f"Run viterbi alignment using {args.num_jobs} processes")
+    blank = aligner.nnet.vocab_size - 1
+    # viterbi jobs that are running in the worker processes
+    pending = deque()
+
+    def wait_jobs(max_pending: int):
+        # keep the output in order
+        while len(pending) > max_pending:
+            keys, num_samples, jobs = pending.popleft()
+            for key, ali, n in zip(keys, jobs.get(), num_samples):
+                dump_ali(key, ali, n)
+
+    def run_batch(batch: List):
+        keys, inps, seqs = zip(*batch)
+        num_samples = [inp.shape[-1] for inp in inps]
+        if pool is None:
+            for key, ali, n in zip(keys, aligner.run_batch(inps, seqs),
+                                   num_samples):
+                dump_ali(key, ali, n)
+        else:
+            # CTC posteriors are computed in main process and viterbi
+            # alignment is done in the worker processes
+            logits = aligner.ctc_logits(inps)
+            jobs = pool.starmap_async(
+                viterbi_worker,
+                [(blank, enc, seq) for enc, seq in zip(logits, seqs)])
+            pending.append((keys, num_samples, jobs))
+            wait_jobs(args.num_jobs)
+
+    batch = []
+    for key, str_seq in txt_reader:
+        done += 1
+        logger.info(
+            f"Generate alignment for utterance {key} ({done}/{tot_utts}) ...")
+        int_seq = processor.run(str_seq)
+        batch.append((key, src_reader[key], int_seq))
+        if len(batch) == args.batch_size:
+            run_batch(batch)
+            batch = []
+    if len(batch):
+        run_batch(batch)
+    # wait for the remaining viterbi jobs
+    wait_jobs(0)
+    if pool is not None:
+        pool.close()
+        pool.join()
     if not ali_stdout:
         ali_fd.close()
     if wdb_fd and not wdb_stdout:
@@ -9,7 +9,7 @@ import argparse
 import subprocess
 import multiprocessing as mp
 
-from aps.io import read_audio, write_audio, group_segments
+from aps.io import read_audio, write_audio, group_segments, PackedAudioWriter
 from aps.utils import get_logger
 from kaldi_python_io.inst import Writer as BaseWriter
 from kaldi_python_io.inst import Reader as BaseReader
@@ -32,9 +32,29 @@ class WaveArkWriter(BaseWriter):
         self.scp_file.write(f"{key}\t{self.ark_path}:{offset}\n")
         self.ark_file.write(value)
 
+    def close(self):
+        self.__exit__(None, None, None)
+
+
+class WavePackWriter(PackedAudioWriter):
+    """
+    Write audio stream to the packed audio archive (decoded)
+    """
+
+    def __init__(self, scp, pack, sr=16000):
+        super(WavePackWriter, self).__init__(pack, scp, sr=sr, dtype="int16")
+
+    def write(self, key, value):
+        if isinstance(value, bytes):
+            value = read_audio(io.BytesIO(value), norm=False, sr=self.sr)
+        super(WavePackWriter, self).write(key, value, norm=False)
+
 
 def worker(jobid, num_jobs, wav_scp, scp_out, ark_out, args):
-    writer = WaveArkWriter(scp_out, ark_out)
+    if args.format == "pack":
+        writer = WavePackWriter(scp_out, ark_out, sr=args.sr)
+    else:
+        writer = WaveArkWriter(scp_out, ark_out)
     reader = BaseReader(wav_scp, num_tokens=2, restrict=True)
     if args.segment:
         segment = group_segments(args.segment, args.sr)
@@ -70,6 +90,9 @@ def worker(jobid, num_jobs, wav_scp, scp_out, ark_out, args):
                         group = segment[key]
                         for info in group:
                             seg_key, beg, end = info
+                            if args.format == "pack":
+                                writer.write(seg_key, audio[..., beg:end])
+                                continue
                             io_fd = io.BytesIO()
                             write_audio(io_fd,
                                         audio[..., beg:end],
@@ -94,6 +117,7 @@ def worker(jobid, num_jobs, wav_scp, scp_out, ark_out, args):
             logger.info(
                 f"Worker {jobid}: processed {utt_done}/{len(reader)} utterances..."
             )
+    writer.close()
     logger.info(f"Worker {jobid}: archive {utt_done}/{len(reader)} " +
                 f"utterances, {num_segs} segments to {ark_out}")
 
@@ -135,7 +159,8 @@ def run(args):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description=
-        "Command to do convert audio to Kaldi's .ark format (Linux only)",
+        "Command to do convert audio to Kaldi's .ark format or the packed "
+        "audio archive (Linux only)",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("wav_scp", type=str, help="Input audio script")
     parser.add_argument("out_scp",
@@ -159,5 +184,12 @@ if __name__ == "__main__":
                         type=int,
                         default=16000,
                         help="Sample rate of the audio")
+    parser.add_argument("--format",
+                        type=str,
+                        default="ark",
+                        choices=["ark", "pack"],
+                        help="Format of the archive, \"pack\" means the "
+                        "packed audio archive (decoded samples with an "
+                        "index) which can be memory mapped by AudioReader")
     args = parser.parse_args()
     run(args)
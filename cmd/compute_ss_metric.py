@@ -6,17 +6,60 @@
 import tqdm
 import argparse
 import numpy as np
+import multiprocessing as mp
 
+from functools import partial
+from typing import List, Tuple, Optional
 from aps.io import AudioReader
 from aps.metric import AverageReporter, permute_sse_metric
 
+# audio readers in each worker: (estimated, reference)
+readers = None
+
+
+def metric_init(est_scps: List[str], ref_scps: List[str], sr: int) -> None:
+    """
+    Initialize the audio readers in worker process
+    """
+    global readers
+    readers = ([AudioReader(scp, sr=sr) for scp in est_scps],
+               [AudioReader(scp, sr=sr) for scp in ref_scps])
+
+
+def metric_worker(key: str, metric: str,
+                  sr: int) -> Tuple[str, float, Optional[List[int]]]:
+    """
+    Compute the metric of one utterance
+    """
+    est_reader, ref_reader = readers
+    if len(est_reader) == 1:
+        est, ref = est_reader[0][key], ref_reader[0][key]
+        assert est.ndim == ref.ndim
+    else:
+        est = np.stack([reader[key] for reader in est_reader])
+        ref = np.stack([reader[key] for reader in ref_reader])
+    end = min(est.shape[-1], ref.shape[-1])
+    ali = None
+    if est.ndim == 2:
+        val, ali = permute_sse_metric(metric,
+                                      ref[:, :end],
+                                      est[:, :end],
+                                      fs=sr,
+                                      compute_permutation=True)
+    else:
+        val = permute_sse_metric(metric,
+                                 ref[:end],
+                                 est[:end],
+                                 fs=sr,
+                                 compute_permutation=False)
+    return key, val, ali
+
 
 def run(args):
     splited_est_scps = args.est_scp.split(",")
     splited_ref_scps = args.ref_scp.split(",")
     if len(splited_ref_scps) != len(splited_est_scps):
         raise RuntimeError("Number of the speakers doesn't matched")
-    single_speaker = len(splited_est_scps) == 1
 
     reporter = AverageReporter(args.spk2class,
                                name=args.metric.upper(),
@@ -24,52 +67,31 @@ def run(args):
     utt_val = open(args.per_utt, "w") if args.per_utt else None
     utt_ali = open(args.utt_ali, "w") if args.utt_ali else None
 
-    if single_speaker:
-        est_reader = AudioReader(args.est_scp, sr=args.sr)
-        ref_reader = AudioReader(args.ref_scp, sr=args.sr)
-        for key, est in tqdm.tqdm(est_reader):
-            ref = ref_reader[key]
-            end = min(est.shape[-1], ref.shape[-1])
-            assert est.ndim == ref.ndim
-            ali = None
-            if est.ndim == 2:
-                metric, ali = permute_sse_metric(args.metric,
-                                                 ref[:, :end],
-                                                 est[:, :end],
-                                                 fs=args.sr,
-                                                 compute_permutation=True)
-            else:
-                metric = permute_sse_metric(args.metric,
-                                            ref[:end],
-                                            est[:end],
-                                            fs=args.sr,
-                                            compute_permutation=False)
-            reporter.add(key, metric)
-            if utt_val:
-                utt_val.write(f"{key}\t{metric:.2f}\n")
-            if utt_ali and ali:
-                ali_str = " ".join(map(str, ali))
-                utt_ali.write(f"{key}\t{ali_str}\n")
+    init_args = (splited_est_scps, splited_ref_scps, args.sr)
+    metric_init(*init_args)
+    keys = readers[0][0].index_keys
+    worker = partial(metric_worker, metric=args.metric, sr=args.sr)
+    if args.num_jobs > 1:
+        # workers read the audio themselves, results are kept in order
+        pool = mp.Pool(args.num_jobs,
+                       initializer=metric_init,
+                       initargs=init_args)
+        chunk_size = max(1, min(16, len(keys) // (args.num_jobs * 4)))
+        results = pool.imap(worker, keys, chunksize=chunk_size)
     else:
-        est_reader = [AudioReader(scp, sr=args.sr) for scp in splited_est_scps]
-        ref_reader = [AudioReader(scp, sr=args.sr) for scp in splited_ref_scps]
-        main_reader = est_reader[0]
+        pool = None
+        results = map(worker, keys)
 
-        for key in tqdm.tqdm(main_reader.index_keys):
-            est = np.stack([reader[key] for reader in est_reader])
-            ref = np.stack([reader[key] for reader in ref_reader])
-            end = min(est.shape[-1], ref.shape[-1])
-            metric, ali = permute_sse_metric(args.metric,
-                                             ref[:, :end],
-                                             est[:, :end],
-                                             fs=args.sr,
-                                             compute_permutation=True)
-            reporter.add(key, metric)
-            if utt_val:
-                utt_val.write(f"{key}\t{metric:.2f}\n")
-            if utt_ali:
-                ali_str = " ".join(map(str, ali))
-                utt_ali.write(f"{key}\t{ali_str}\n")
+    for key, metric, ali in tqdm.tqdm(results, total=len(keys)):
+        reporter.add(key, metric)
+        if utt_val:
+            utt_val.write(f"{key}\t{metric:.2f}\n")
+        if utt_ali and ali:
+            ali_str = " ".join(map(str, ali))
+            utt_ali.write(f"{key}\t{ali_str}\n")
+    if pool:
+        pool.close()
+        pool.join()
     reporter.report()
     if utt_val:
         utt_val.close()
@@ -113,5 +135,10 @@ if __name__ == "__main__":
                         type=int,
                         default=16000,
                         help="Sample rate of the audio")
+    parser.add_argument("--num-jobs",
+                        type=int,
+                        default=1,
+                        help="Number of the worker processes to compute "
+                        "the metrics in parallel")
     args = parser.parse_args()
     run(args)
@@ -12,7 +12,7 @@ import torch as th
 from pathlib import Path
 
 from aps.io import AudioReader, SegmentAudioReader, io_wrapper
-from aps.eval import NnetEvaluator, TextPostProcessor
+from aps.eval import NnetEvaluator, TextPostProcessor, DecodingPipeline
 from aps.opts import DecodingParser
 from aps.conf import load_dict
 from aps.const import UNK_TOKEN
@@ -54,10 +54,14 @@ class FasterDecoder(NnetEvaluator):
                  cpt_dir: str,
                  cpt_tag: str = "best",
                  function: str = "beam_search",
-                 device_id: int = -1) -> None:
+                 device_id: int = -1,
+                 mmap: bool = False,
+                 num_threads: int = 0) -> None:
         super(FasterDecoder, self).__init__(cpt_dir,
                                             cpt_tag=cpt_tag,
-                                            device_id=device_id)
+                                            device_id=device_id,
+                                            mmap=mmap,
+                                            num_threads=num_threads)
         if not hasattr(self.nnet, function):
             raise RuntimeError(
                 f"AM doesn't have the decoding function: {function}")
@@ -75,30 +79,37 @@ def run(args):
     decoder = FasterDecoder(args.am,
                             cpt_tag=args.am_tag,
                             function=args.function,
-                            device_id=args.device_id)
+                            device_id=args.device_id,
+                            mmap=args.mmap_weights,
+                            num_threads=args.num_threads)
     if decoder.accept_raw:
         if args.segment:
             src_reader = SegmentAudioReader(args.feats_or_wav_scp,
                                             args.segment,
                                             sr=args.sr,
-                                            channel=args.channel)
+                                            channel=args.channel,
+                                            num_threads=args.io_threads,
+                                            prefetch=args.prefetch_size)
         else:
             src_reader = AudioReader(args.feats_or_wav_scp,
                                      sr=args.sr,
-                                     channel=args.channel)
+                                     channel=args.channel,
+                                     num_threads=args.io_threads,
+                                     prefetch=args.prefetch_size)
     else:
         src_reader = ScriptReader(args.feats_or_wav_scp)
 
     if args.lm:
         if Path(args.lm).is_file():
             from aps.asr.lm.ngram import NgramLM
-            lm = NgramLM(args.lm, args.dict)
+            lm = NgramLM(args.lm, args.dict, topk=args.ngram_topk)
             logger.info(
                 f"Load ngram LM from {args.lm}, weight = {args.lm_weight}")
         else:
             lm = NnetEvaluator(args.lm,
                                device_id=args.device_id,
-                               cpt_tag=args.lm_tag)
+                               cpt_tag=args.lm_tag,
+                               mmap=args.mmap_weights)
             logger.info(f"Use NN LM weight: {args.lm_weight}")
             lm = lm.nnet
     else:
@@ -134,12 +145,32 @@ def run(args):
             unk_idx = vocab_dict[UNK_TOKEN]
             logger.info(f"Use unknown token {UNK_TOKEN} index: {unk_idx}")
     dec_args["unk"] = unk_idx
+    num_workers = args.num_workers
+    if num_workers > 1 and args.device_id >= 0:
+        logger.warning("Only support multiple decoding workers on CPU, " +
+                       "use num_workers = 1 instead")
+        num_workers = 1
+    pipeline = DecodingPipeline(lambda inps: [decoder.run(inps[0], **dec_args)],
+                                num_workers=num_workers,
+                                batch_size=1,
+                                prefetch=args.prefetch_size,
+                                num_threads=args.num_threads,
+                                time_axis=-1 if decoder.accept_raw else 0)
     done = 0
     tot_utts = len(src_reader)
-    for key, src in src_reader:
+    # duration of the decoded audio (in seconds)
+    tot_dur = 0
+
+    def src_iter():
+        nonlocal tot_dur
+        for key, src in src_reader:
+            if decoder.accept_raw:
+                tot_dur += src.shape[-1] / args.sr
+            yield key, src
+
+    for key, nbest_hypos in pipeline.run(src_iter()):
         done += 1
         logger.info(f"Decoding utterance {key} ({done}/{tot_utts}) ...")
-        nbest_hypos = decoder.run(src, **dec_args)
         nbest = [f"{key}\n"]
         for idx, hyp in enumerate(nbest_hypos):
             # remove SOS/EOS
@@ -168,6 +199,9 @@ def run(args):
         topn.close()
     cost = timer.elapsed()
     logger.info(f"Decode {tot_utts} utterance done, time cost = {cost:.2f}m")
+    if tot_dur > 0:
+        logger.info(f"Decode {tot_dur / 3600:.2f}h audio with " +
+                    f"{num_workers} workers, RTF = {cost * 60 / tot_dur:.4f}")
 
 
 if __name__ == "__main__":
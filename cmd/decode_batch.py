@@ -14,12 +14,12 @@ from pathlib import Path
 
 from aps.io import AudioReader, SegmentAudioReader, io_wrapper
 from aps.opts import DecodingParser
-from aps.eval import NnetEvaluator, TextPostProcessor
+from aps.eval import NnetEvaluator, TextPostProcessor, DecodingPipeline, dynamic_batches
 from aps.conf import load_dict
 from aps.const import UNK_TOKEN
 from aps.utils import get_logger, SimpleTimer
 
-from kaldi_python_io import ScriptReader
+from kaldi_python_io import ScriptReader, Reader as BaseReader
 
 logger = get_logger(__name__)
 
@@ -39,10 +39,14 @@ class BatchDecoder(NnetEvaluator):
     def __init__(self,
                  cpt_dir: str,
                  device_id: int = -1,
-                 cpt_tag: str = "best") -> None:
+                 cpt_tag: str = "best",
+                 mmap: bool = False,
+                 num_threads: int = 0) -> None:
         super(BatchDecoder, self).__init__(cpt_dir,
                                            device_id=device_id,
-                                           cpt_tag=cpt_tag)
+                                           cpt_tag=cpt_tag,
+                                           mmap=mmap,
+                                           num_threads=num_threads)
 
     def run(self, inps, **kwargs):
         return self.nnet.beam_search_batch(
@@ -55,30 +59,37 @@ def run(args):
         warnings.warn("can use decode.py instead as batch_size == 1")
     decoder = BatchDecoder(args.am,
                            device_id=args.device_id,
-                           cpt_tag=args.am_tag)
+                           cpt_tag=args.am_tag,
+                           mmap=args.mmap_weights,
+                           num_threads=args.num_threads)
     if decoder.accept_raw:
         if args.segment:
             src_reader = SegmentAudioReader(args.feats_or_wav_scp,
                                             args.segment,
                                             sr=args.sr,
-                                            channel=args.channel)
+                                            channel=args.channel,
+                                            num_threads=args.io_threads,
+                                            prefetch=args.prefetch_size)
         else:
             src_reader = AudioReader(args.feats_or_wav_scp,
                                      sr=args.sr,
-                                     channel=args.channel)
+                                     channel=args.channel,
+                                     num_threads=args.io_threads,
+                                     prefetch=args.prefetch_size)
     else:
         src_reader = ScriptReader(args.feats_or_wav_scp)
 
     if args.lm:
         if Path(args.lm).is_file():
             from aps.asr.lm.ngram import NgramLM
-            lm = NgramLM(args.lm, args.dict)
+            lm = NgramLM(args.lm, args.dict, topk=args.ngram_topk)
             logger.info(
                 f"Load ngram LM from {args.lm}, weight = {args.lm_weight}")
         else:
             lm = NnetEvaluator(args.lm,
                                device_id=args.device_id,
-                               cpt_tag=args.lm_tag)
+                               cpt_tag=args.lm_tag,
+                               mmap=args.mmap_weights)
             logger.info(f"Use NN LM weight: {args.lm_weight}")
             lm = lm.nnet
     else:
@@ -100,7 +111,6 @@ def run(args):
         logger.info(f"Dump alignments to dir: {ali_dir}")
     done = 0
     timer = SimpleTimer()
-    batches = []
     dec_args = dict(
         filter(lambda x: x[0] in beam_search_params,
                vars(args).items()))
@@ -112,45 +122,96 @@ def run(args):
             unk_idx = vocab_dict[UNK_TOKEN]
             logger.info(f"Use unknown token {UNK_TOKEN} index: {unk_idx}")
     dec_args["unk"] = unk_idx
+    num_workers = args.num_workers
+    if num_workers > 1 and args.device_id >= 0:
+        logger.warning("Only support multiple decoding workers on CPU, " +
+                       "use num_workers = 1 instead")
+        num_workers = 1
+    # utterances are sorted by length in the bucket before batching
+    pipeline = DecodingPipeline(lambda inps: decoder.run(inps, **dec_args),
+                                num_workers=num_workers,
+                                batch_size=args.batch_size,
+                                bucket_size=args.bucket_size,
+                                prefetch=args.prefetch_size,
+                                num_threads=args.num_threads,
+                                time_axis=-1 if decoder.accept_raw else 0)
     tot_utts = len(src_reader)
-    for key, src in src_reader:
+    # duration of the decoded audio (in seconds)
+    tot_dur = 0
+    batches = None
+    if args.max_batch_dur > 0:
+        if args.segment:
+            logger.warning("Dynamic batching doesn't support --segment, " +
+                           "use --bucket-size instead")
+        elif args.utt2dur:
+            utt2dur = BaseReader(args.utt2dur, value_processor=float)
+            batches = dynamic_batches(
+                {key: utt2dur[key] for key in src_reader.index_keys},
+                args.max_batch_dur,
+                max_batch_size=args.batch_size)
+        elif decoder.accept_raw:
+            # read the audio headers only
+            utt2nsamps = src_reader.utt2nsamps()
+            batches = dynamic_batches(
+                {key: utt2nsamps[key] / args.sr for key in utt2nsamps},
+                args.max_batch_dur,
+                max_batch_size=args.batch_size)
+        else:
+            logger.warning("Dynamic batching needs --utt2dur for the " +
+                           "features, use --bucket-size instead")
+    if batches is not None:
+        logger.info(f"Make {len(batches)} batches (max duration: " +
+                    f"{args.max_batch_dur:.1f}s) for {tot_utts} utterances")
+
+    def src_iter():
+        nonlocal tot_dur
+        for key, src in src_reader:
+            if decoder.accept_raw:
+                tot_dur += src.shape[-1] / args.sr
+            yield key, src
+
+    def batch_iter():
+        nonlocal tot_dur
+        keys = [key for batch in batches for _, key in batch]
+        if decoder.accept_raw:
+            # read ahead (in the order of the batches) by the reader threads
+            src_gen = src_reader.iter_keys(keys)
+        else:
+            src_gen = ((key, src_reader[key]) for key in keys)
+        for batch in batches:
+            srcs = [(index, key, next(src_gen)[1]) for index, key in batch]
+            if decoder.accept_raw:
+                tot_dur += sum(src.shape[-1] for _, _, src in srcs) / args.sr
+            yield srcs
+
+    if batches is None:
+        decoded = pipeline.run(src_iter())
+    else:
+        decoded = pipeline.run(batch_iter(), batched=True)
+    for key, nbest in decoded:
         done += 1
-        batches.append({
-            "key": key,
-            "inp": src,
-            "len": src.shape[-1] if decoder.accept_raw else src.shape[0]
-        })
-        end = (done == len(src_reader) and len(batches))
-        if len(batches) != args.batch_size and not end:
-            continue
-        # decode
-        batches = sorted(batches, key=lambda b: b["len"], reverse=True)
-        batch_nbest = decoder.run([bz["inp"] for bz in batches], **dec_args)
-        keys = [bz["key"] for bz in batches]
-        for key, nbest in zip(keys, batch_nbest):
-            logger.info(f"Decoding utterance {key} ({done}/{tot_utts}) ...")
-            nbest_hypos = [f"{key}\n"]
-            for idx, hyp in enumerate(nbest):
-                # remove SOS/EOS
-                token = hyp["trans"][1:-1]
-                trans = processor.run(token)
-                score = hyp["score"]
-                nbest_hypos.append(f"{score:.3f}\t{len(token):d}\t{trans}\n")
-                if idx == 0:
-                    logger.info(f"{key} ({score:.3f}, {len(token):d}) {trans}")
-                    top1.write(f"{key}\t{trans}\n")
-                if ali_dir:
-                    if hyp["align"] is None:
-                        raise RuntimeError(
-                            "Can not dump alignment out as it's None")
-                    np.save(f"{ali_dir}/{key}-nbest{idx+1}",
-                            hyp["align"].numpy())
-            if topn:
-                topn.write("".join(nbest_hypos))
-        top1.flush()
+        logger.info(f"Decoding utterance {key} ({done}/{tot_utts}) ...")
+        nbest_hypos = [f"{key}\n"]
+        for idx, hyp in enumerate(nbest):
+            # remove SOS/EOS
+            token = hyp["trans"][1:-1]
+            trans = processor.run(token)
+            score = hyp["score"]
+            nbest_hypos.append(f"{score:.3f}\t{len(token):d}\t{trans}\n")
+            if idx == 0:
+                logger.info(f"{key} ({score:.3f}, {len(token):d}) {trans}")
+                top1.write(f"{key}\t{trans}\n")
+            if ali_dir:
+                if hyp["align"] is None:
+                    raise RuntimeError(
+                        "Can not dump alignment out as it's None")
+                np.save(f"{ali_dir}/{key}-nbest{idx+1}", hyp["align"].numpy())
         if topn:
-            topn.flush()
-        batches.clear()
+            topn.write("".join(nbest_hypos))
+        if not done % args.batch_size:
+            top1.flush()
+            if topn:
+                topn.flush()
 
     if not stdout_top1:
         top1.close()
@@ -158,6 +219,9 @@ def run(args):
         topn.close()
     cost = timer.elapsed()
     logger.info(f"Decode {tot_utts} utterance done, time cost = {cost:.2f}m")
+    if tot_dur > 0:
+        logger.info(f"Decode {tot_dur / 3600:.2f}h audio with " +
+                    f"{num_workers} workers, RTF = {cost * 60 / tot_dur:.4f}")
 
 
 if __name__ == "__main__":
@@ -170,5 +234,23 @@ if __name__ == "__main__":
                         type=int,
                         default=4,
                         help="Number of utterances to process in one batch")
+    parser.add_argument("--bucket-size",
+                        type=int,
+                        default=0,
+                        help="Number of utterances sorted by length before "
+                        "batching (<= batch_size means sorting in batch)")
+    parser.add_argument("--max-batch-dur",
+                        type=float,
+                        default=0,
+                        help="If > 0, sort all the utterances by duration "
+                        "and make batches whose padded duration (in seconds) "
+                        "is not larger than it (--batch-size is the maximum "
+                        "#batch_size then)")
+    parser.add_argument("--utt2dur",
+                        type=str,
+                        default="",
+                        help="Duration (in seconds) of the utterances used "
+                        "for --max-batch-dur, required for the features, "
+                        "read from the audio if not assigned")
     args = parser.parse_args()
     run(args)
@@ -6,22 +6,30 @@
 import argparse
 
 from pathlib import Path
+from typing import List, Tuple
 from aps.asr.lm.ngram import NgramLM
 from aps.utils import get_logger
 from aps.const import EOS_TOKEN, SOS_TOKEN
-from aps.eval import NnetEvaluator, TextPreProcessor
+from aps.eval import NnetEvaluator, NbestRescorer, TextPreProcessor
 from aps.opts import StrToBoolAction
 from aps.io import io_wrapper, NbestReader
 
 logger = get_logger(__name__)
 
 
+def rescore_nbest(rescore: List[Tuple[float, str]]) -> str:
+    """
+    Return the best hypothesis after rescoring
+    """
+    rescore = sorted(rescore, key=lambda n: n[0], reverse=True)
+    return rescore[0][1]
+
+
 def run(args):
     nbest_reader = NbestReader(args.nbest)
 
     kenlm = Path(args.lm).is_file()
     tokenizer = None
-    sos, eos = -1, -1
     if kenlm:
         lm = NgramLM(args.lm, args.dict)
         logger.info(f"Load ngram LM from {args.lm}, weight = {args.lm_weight}")
@@ -30,41 +38,61 @@ def run(args):
                            device_id=args.device_id,
                            cpt_tag=args.lm_tag)
         logger.info(f"Use NN LM weight: {args.lm_weight}")
-        lm = lm.nnet
         tokenizer = TextPreProcessor(args.dict, space=args.space,
                                      spm=args.spm).tokenizer
-        sos = tokenizer.symbol2int(SOS_TOKEN)
-        eos = tokenizer.symbol2int(EOS_TOKEN)
+        lm = NbestRescorer(lm.nnet,
+                           sos=tokenizer.symbol2int(SOS_TOKEN),
+                           eos=tokenizer.symbol2int(EOS_TOKEN),
+                           batch_size=args.batch_size,
+                           device_id=args.device_id)
 
     stdout, top1 = io_wrapper(args.top1, "w")
     done = 0
+    # pending utterances for NN LM
+    pending = []
+
+    def rescore_pending():
+        hypos = []
+        for _, nbest in pending:
+            for _, _, trans in nbest:
+                hypos.append(tokenizer.encode(trans.split(" ")))
+        lm_scores = lm.score(hypos)
+        n = 0
+        for key, nbest in pending:
+            rescore = []
+            for am_score, num_tokens, trans in nbest:
+                score = (am_score + lm_scores[n]) / num_tokens
+                rescore.append((score, trans))
+                n += 1
+            top1.write(f"{key}\t{rescore_nbest(rescore)}\n")
+
     for key, nbest in nbest_reader:
-        rescore = []
-        for hyp in nbest:
-            # NOTE: am_score: without length normalization
-            am_score, num_tokens, hypos = hyp
-            if kenlm:
+        if kenlm:
+            rescore = []
+            for hyp in nbest:
+                # NOTE: am_score: without length normalization
+                am_score, num_tokens, hypos = hyp
                 lm_score = lm.score(hypos, eos=True, sos=True)
                 if args.len_norm:
                     am_score /= num_tokens
                 score = am_score + args.lm_weight * lm_score
-            else:
-                hypos_str_seq = hypos.split(" ")
-                hypos_int_seq = tokenizer.encode(hypos_str_seq)
-                lm_score = lm.score(hypos_int_seq,
-                                    eos=eos,
-                                    sos=sos,
-                                    device=args.device_id)
-                score = (am_score + lm_score) / num_tokens
-            rescore.append((score, hypos))
-        rescore = sorted(rescore, key=lambda n: n[0], reverse=True)
-        top1.write(f"{key}\t{rescore[0][1]}\n")
+                rescore.append((score, hypos))
+            top1.write(f"{key}\t{rescore_nbest(rescore)}\n")
+        else:
+            # pack hypothesis of #chunk_size utterances
+            pending.append((key, nbest))
+            if len(pending) == args.chunk_size:
+                rescore_pending()
+                pending = []
         done += 1
         if done % 1000 == 0:
             logger.info(f"Rescore {done} utterances done ...")
+    if pending:
+        rescore_pending()
     if not stdout:
         top1.close()
-    logger.info(f"Rescore {done} utterances on {nbest} hypothesis")
+    logger.info(f"Rescore {done} utterances on {nbest_reader.nbest} " +
+                "hypothesis")
 
 
 if __name__ == "__main__":
@@ -95,6 +123,16 @@ if __name__ == "__main__":
                         default=-1,
                         help="GPU-id to offload model to, "
                         "-1 means running on CPU")
+    parser.add_argument("--batch-size",
+                        type=int,
+                        default=64,
+                        help="Number of the hypothesis in one batch "
+                        "(for NN based LM)")
+    parser.add_argument("--chunk-size",
+                        type=int,
+                        default=100,
+                        help="Number of the utterances whose hypothesis "
+                        "are packed together (for NN based LM)")
     parser.add_argument("--dict",
                         type=str,
                         required=True,
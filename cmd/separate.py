@@ -8,8 +8,10 @@ import argparse
 
 import torch as th
 import numpy as np
+import torch.nn.functional as tf
 
 from aps.io import AudioReader, write_audio
+from aps.opts import StrToBoolAction
 from aps.utils import get_logger, SimpleTimer
 from aps.eval import NnetEvaluator, ChunkStitcher
 
@@ -27,7 +29,9 @@ class Separator(NnetEvaluator):
                  cpt_tag: str = "best",
                  sr: int = 16000,
                  device_id: int = -1,
-                 chunk_cfg: str = "0,-1,0") -> None:
+                 chunk_cfg: str = "0,-1,0",
+                 batch_size: int = 1,
+                 crossfade: bool = False) -> None:
         super(Separator, self).__init__(cpt_dir,
                                         cpt_tag=cpt_tag,
                                         device_id=device_id)
@@ -38,12 +42,25 @@ class Separator(NnetEvaluator):
             logger.info(
                 f"Perform chunk-wise evaluation: length = {chunk_len}, " +
                 f"lctx = {lctx}, rctx = {rctx}")
-            self.stitcher = ChunkStitcher(chunk_len, lctx, rctx)
+            self.stitcher = ChunkStitcher(chunk_len,
+                                          lctx,
+                                          rctx,
+                                          crossfade=crossfade)
         else:
             self.stitcher = None
         self.chunk_hop = chunk_len
         self.chunk_len = chunk_len + rctx
         self.lctx = lctx
+        self.batch_size = batch_size
+
+    def _chunk(self, src: th.Tensor, beg: int) -> th.Tensor:
+        """
+        Return the chunk (with left & right context) begins at #beg
+        """
+        chunk = src[..., beg - self.lctx:beg + self.chunk_len]
+        pad = self.lctx + self.chunk_len - chunk.shape[-1]
+        # last chunk, need padding
+        return tf.pad(chunk, (0, pad)) if pad > 0 else chunk
 
     def run(self, src: np.ndarray, mode: str = "time") -> th.Tensor:
         """
@@ -57,33 +74,26 @@ class Separator(NnetEvaluator):
         else:
             if mode != "time":
                 raise RuntimeError("Now only supports time inference mode")
+            # beginning of each chunk (excluding the left context)
+            begs = [self.lctx]
+            while expected_length - begs[-1] - self.chunk_len >= 0:
+                begs.append(begs[-1] + self.chunk_hop)
             chunks = []
-            beg = self.lctx
-            # for beg in range(0, expected_length, self.chunk_hop):
-            while True:
-                if (beg - self.lctx) % (logger_interval * self.chunk_hop) == 0:
-                    progress = beg * 100 / expected_length
+            # stack #batch_size chunks (with context) in one forward pass
+            for i in range(0, len(begs), self.batch_size):
+                if i % logger_interval < self.batch_size:
+                    progress = begs[i] * 100 / expected_length
                     logger.info(
                         f"--- Processing chunks, done {progress:.2f}% ...")
-                pad = expected_length - beg - self.chunk_len
-                if pad < 0:
-                    # last chunk, need padding
-                    if src.dim() == 1:
-                        zero = th.zeros(-pad, device=self.device)
+                mix_chunks = th.stack([
+                    self._chunk(src, beg) for beg in begs[i:i + self.batch_size]
+                ])
+                for sep_chunk in self.nnet.infer_batch(mix_chunks, mode=mode):
+                    if isinstance(sep_chunk, th.Tensor):
+                        sep_chunk = sep_chunk.cpu()
                     else:
-                        zero = th.zeros(src.shape[0], -pad, device=self.device)
-                    mix_chunk = th.cat([src[..., beg - self.lctx:], zero], 0)
-                else:
-                    mix_chunk = src[..., beg - self.lctx:beg + self.chunk_len]
-                sep_chunk = self.nnet.infer(mix_chunk, mode=mode)
-                if isinstance(sep_chunk, th.Tensor):
-                    sep_chunk = sep_chunk.cpu()
-                else:
-                    sep_chunk = [s.cpu() for s in sep_chunk]
-                chunks.append(sep_chunk)
-                beg += self.chunk_hop
-                if pad < 0:
-                    break
+                        sep_chunk = [s.cpu() for s in sep_chunk]
+                    chunks.append(sep_chunk)
             logger.info("--- Stitch & Reorder ...")
             return self.stitcher.stitch(chunks, expected_length)
 
@@ -94,8 +104,14 @@ def run(args):
     separator = Separator(args.checkpoint,
                           cpt_tag=args.tag,
                           device_id=args.device_id,
-                          chunk_cfg=args.chunk_cfg)
-    mix_reader = AudioReader(args.wav_scp, sr=args.sr, channel=args.channel)
+                          chunk_cfg=args.chunk_cfg,
+                          batch_size=args.batch_size,
+                          crossfade=args.crossfade)
+    mix_reader = AudioReader(args.wav_scp,
+                             sr=args.sr,
+                             channel=args.channel,
+                             num_threads=args.io_threads,
+                             prefetch=args.prefetch_size)
 
     done = 0
     for key, mix in mix_reader:
@@ -156,6 +172,17 @@ if __name__ == "__main__":
                         help="Configurations for chunk-wise processing "
                         "(left context & chunk size & right context in "
                         "seconds)")
+    parser.add_argument("--batch-size",
+                        type=int,
+                        default=8,
+                        help="Number of the chunks processed in one forward "
+                        "pass (chunk-wise evaluation)")
+    parser.add_argument("--crossfade",
+                        action=StrToBoolAction,
+                        default=False,
+                        help="If true, cross-fade the overlapped segments "
+                        "of the adjacent chunks instead of the hard cut-over "
+                        "(chunk-wise evaluation)")
     parser.add_argument("--sr",
                         type=int,
                         default=16000,
@@ -164,5 +191,15 @@ if __name__ == "__main__":
                         type=int,
                         default=-1,
                         help="Channel index for source audio")
+    parser.add_argument("--io-threads",
+                        type=int,
+                        default=1,
+                        help="Number of the threads to read (decode) the "
+                        "audio, > 1 means reading ahead in parallel")
+    parser.add_argument("--prefetch-size",
+                        type=int,
+                        default=16,
+                        help="Number of the utterances read ahead "
+                        "if --io-threads > 1")
     args = parser.parse_args()
     run(args)
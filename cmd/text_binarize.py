@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+# Copyright 2021 Jian Wu
+# License: Apache 2.0 (http://www.apache.org/licenses/LICENSE-2.0)
+"""
+Convert the text/token file to the binary corpus (used by lm@utt & lm@bptt)
+"""
+import argparse
+
+from aps.conf import load_dict
+from aps.tokenizer import Tokenizer
+from aps.loader.lm.utils import BinaryCorpusWriter
+from aps.utils import get_logger
+from aps.io import io_wrapper
+
+logger = get_logger(__name__)
+
+
+def run(args):
+    if args.dict:
+        vocab = load_dict(args.dict)
+        tokenizer = Tokenizer(
+            vocab,
+            tokenizer=args.tokenizer,
+            tokenizer_kwargs={"spm": args.spm} if args.spm else {})
+    else:
+        if args.tokenizer:
+            raise ValueError("--dict is required when using --tokenizer")
+        # integer token file
+        tokenizer = None
+    src_std, src = io_wrapper(args.src_txt, "r")
+    num_utts, num_toks = 0, 0
+    with BinaryCorpusWriter(args.dst_bin) as writer:
+        for raw_line in src:
+            str_toks = raw_line.split()
+            # remove the first token (utterance key)
+            if args.text_format == "kaldi":
+                str_toks = str_toks[1:]
+            if tokenizer:
+                int_toks = tokenizer.encode(str_toks)
+            else:
+                int_toks = list(map(int, str_toks))
+            writer.write(int_toks)
+            num_utts += 1
+            num_toks += len(int_toks)
+            if num_utts % args.log_interval == 0:
+                logger.info(f"Processed {num_utts} utterances ...")
+    if not src_std:
+        src.close()
+    logger.info(f"Write {num_utts} utterances ({num_toks} tokens) " +
+                f"to {args.dst_bin}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert the text/token file to the binary corpus, "
+        "i.e., a flat int32 token array (xxx.bin) and the offset index "
+        "(xxx.idx), which are memory mapped by the LM dataloader")
+    parser.add_argument("src_txt",
+                        type=str,
+                        help="Source text/token file (Kaldi format or not)")
+    parser.add_argument("dst_bin",
+                        type=str,
+                        help="Output binary corpus (should end with .bin)")
+    parser.add_argument("--dict",
+                        type=str,
+                        default="",
+                        help="Vocabulary dictionary, if not given, "
+                        "the source file should be the integer tokens")
+    parser.add_argument("--text-format",
+                        type=str,
+                        default="kaldi",
+                        choices=["kaldi", "raw"],
+                        help="Format of the text file. "
+                        "The kaldi format begins with the utterance ID")
+    parser.add_argument("--tokenizer",
+                        type=str,
+                        default="",
+                        help="Tokenizer name (for raw text, "
+                        "e.g., subword, char, word)")
+    parser.add_argument("--spm",
+                        type=str,
+                        default="",
+                        help="Path of the sentencepiece's model "
+                        "if we choose subword tokenizer")
+    parser.add_argument("--log-interval",
+                        type=int,
+                        default=100000,
+                        help="Report the progress per #log_interval "
+                        "utterances")
+    args = parser.parse_args()
+    if args.dst_bin[-4:] != ".bin":
+        raise ValueError(f"Output corpus should end with .bin: {args.dst_bin}")
+    run(args)
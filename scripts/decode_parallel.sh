@@ -33,6 +33,8 @@ segment=""
 dump_align=""
 text=""
 score=false
+mmap=true
+num_threads=1
 
 echo "$0 $*"
 
@@ -93,6 +95,8 @@ for i in $(seq $nj); do
     --cov-penalty $cov_penalty \
     --cov-threshold $cov_threshold \
     --eos-threshold $eos_threshold \
+    --mmap-weights $mmap \
+    --num-threads $num_threads \
     > $log_dir/decode.${dec_prefix}.${i}.log 2>&1 &
 done
 wait
@@ -26,6 +26,15 @@ for cmd in utils/tokenizer.py cmd/text_tokenize.py; do
     --text-format kaldi $egs_dir/ref.en.text -
 done
 
+egs_dir=tests/data/dataloader/lm
+cmd/text_binarize.py --dict $egs_dir/dict $egs_dir/egs.token $egs_dir/egs.bin
+# integer tokens (without dictionary)
+awk 'NR == FNR {v[$1] = $2; next} {printf "%s", $1; for (i = 2; i <= NF; i++) printf " %s", ($i in v ? v[$i] : v["<unk>"]); print ""}' \
+  $egs_dir/dict $egs_dir/egs.token > $egs_dir/egs.int.token
+cmd/text_binarize.py $egs_dir/egs.int.token $egs_dir/egs.int.bin
+cmp $egs_dir/egs.bin $egs_dir/egs.int.bin
+rm $egs_dir/egs.{bin,idx} $egs_dir/egs.int.{token,bin,idx}
+
 egs_dir=tests/data/metric/sse
 for metric in sdr pesq stoi sisnr; do
   cmd/compute_ss_metric.py --metric $metric \
@@ -42,5 +51,8 @@ cmd/check_audio.py $egs_dir/wav.1.scp -
 cmd/archive_wav.py $egs_dir/wav.1.scp $egs_dir/egs.1.scp $egs_dir/egs.1.ark
 cmd/extract_wav.py $egs_dir/egs.1.scp $egs_dir/egs
 rm $egs_dir/egs.1.{scp,ark} && rm -rf $egs_dir/egs
+cmd/archive_wav.py --format pack $egs_dir/wav.1.scp $egs_dir/egs.1.scp $egs_dir/egs.1.pack
+cmd/extract_wav.py $egs_dir/egs.1.scp $egs_dir/egs
+rm $egs_dir/egs.1.{scp,pack} && rm -rf $egs_dir/egs
 
 utils/wav_duration.py --output time $egs_dir/wav.1.scp -
@@ -4,10 +4,20 @@
 # License: Apache 2.0 (http://www.apache.org/licenses/LICENSE-2.0)
 
 import pytest
+import threading
 import torch as th
+import aps.distributed as dist
 
 from aps.libs import aps_dataloader
 from aps.conf import load_dict
+from aps.io import AudioReader
+from aps.loader.lm.utils import BinaryCorpusWriter, concat_data, filter_utts
+from aps.loader.lm.utt import Dataset, BinaryDataset
+from aps.loader.lm.shard import ShardDataLoader
+from aps.loader.am.raw import egs_collate
+from aps.loader.am.utils import TokenReader
+from aps.transform.asr import SpeedPerturbTransform
+from aps.transform.augment import perturb_speed
 
 
 @pytest.mark.parametrize("batch_size", [1, 2, 4])
@@ -54,6 +64,83 @@ def test_am_raw_loader_const(batch_size, num_workers):
         assert egs["tgt_pad"].shape[-1] == egs["tgt_len"].max().item()
 
 
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_am_raw_loader_speed_perturb(num_workers):
+    egs_dir = "tests/data/dataloader/am"
+    loader = aps_dataloader(fmt="am@raw",
+                            wav_scp=f"{egs_dir}/egs.wav.scp",
+                            text=f"{egs_dir}/egs.fake.text",
+                            utt2dur=f"{egs_dir}/egs.utt2dur",
+                            vocab_dict=load_dict(f"{egs_dir}/dict"),
+                            train=True,
+                            sr=16000,
+                            speed_perturb="0.9,1.0,1.1",
+                            num_workers=num_workers,
+                            max_batch_size=4,
+                            min_batch_size=1)
+    for egs in loader:
+        assert egs["src_pad"].shape[-1] >= egs["src_len"].max().item()
+        assert egs["src_pad"].shape[0] == egs["src_len"].shape[0]
+    # src_len is the length of each utterance after speed perturb
+    speed_perturb = SpeedPerturbTransform(sr=16000, perturb="0.9,1.0,1.1")
+    batch = [loader.dataset[i] for i in range(8)]
+    egs = egs_collate(batch, speed_perturb=speed_perturb)
+    for i, c in enumerate(speed_perturb.last_choice.tolist()):
+        wav = th.from_numpy(batch[i]["inp"])[None, ...]
+        if c != len(speed_perturb.weights):
+            wav = perturb_speed(wav, speed_perturb.weights[c])
+        assert egs["src_len"][i].item() == wav.shape[-1]
+
+
+@pytest.mark.parametrize("batch_mode", ["adaptive", "constraint"])
+def test_am_raw_loader_manifest(tmp_path, batch_mode):
+    egs_dir = "tests/data/dataloader/am"
+    loader_kwargs = {
+        "fmt": "am@raw",
+        "wav_scp": f"{egs_dir}/egs.wav.scp",
+        "text": f"{egs_dir}/egs.fake.text",
+        "utt2dur": f"{egs_dir}/egs.utt2dur",
+        "vocab_dict": load_dict(f"{egs_dir}/dict"),
+        "train": False,
+        "sr": 16000,
+        "batch_mode": batch_mode,
+        "max_batch_size": 10 if batch_mode == "constraint" else 4,
+        "min_batch_size": 1
+    }
+    ref_loader = aps_dataloader(**loader_kwargs)
+    # 1st: create manifest, 2nd: load from cache
+    for _ in range(2):
+        loader = aps_dataloader(manifest_dir=str(tmp_path), **loader_kwargs)
+        assert len(list(tmp_path.iterdir())) == 1
+        assert loader.batch_sampler.batches == ref_loader.batch_sampler.batches
+        for ref, egs in zip(ref_loader, loader):
+            for key in ["src_pad", "tgt_pad", "tgt_len", "src_len"]:
+                th.testing.assert_close(ref[key], egs[key])
+
+
+@pytest.mark.parametrize("tokenizer", ["", "char"])
+def test_am_token_manifest(tmp_path, tokenizer):
+    egs_dir = "tests/data/dataloader/am"
+    reader_kwargs = {
+        "text": f"{egs_dir}/egs.fake.text",
+        "utt2dur": f"{egs_dir}/egs.utt2dur",
+        "vocab_dict": load_dict(f"{egs_dir}/dict"),
+        "tokenizer": tokenizer,
+        "max_dur": 100,
+        "min_dur": 0
+    }
+    ref_reader = TokenReader(**reader_kwargs)
+    # 1st: create manifest, 2nd: load from cache
+    for _ in range(2):
+        reader = TokenReader(manifest_dir=str(tmp_path), **reader_kwargs)
+        assert len(reader) == len(ref_reader)
+        for i in range(len(reader)):
+            ref, egs = ref_reader[i], reader[i]
+            for key in ["key", "dur", "tok"]:
+                assert ref[key] == egs[key]
+            assert egs["len"] == len(egs["tok"])
+
+
 @pytest.mark.parametrize("batch_size", [1, 2, 4])
 @pytest.mark.parametrize("num_workers", [0, 2, 4])
 def test_am_kaldi_loader(batch_size, num_workers):
@@ -155,3 +242,216 @@ def test_lm_bptt_loader(batch_size, obj):
     for egs in loader:
         assert egs["src"].shape == egs["tgt"].shape
         assert egs["src"].shape == th.Size([batch_size, 10])
+
+
+@pytest.mark.parametrize("fmt", ["lm@utt", "lm@bptt"])
+def test_lm_binary_loader(tmp_path, fmt):
+    egs_dir = "tests/data/dataloader/lm"
+    vocab = load_dict(f"{egs_dir}/dict")
+    dataset = Dataset(f"{egs_dir}/egs.token", vocab)
+    corpus = str(tmp_path / "egs.bin")
+    with BinaryCorpusWriter(corpus) as writer:
+        for i in range(len(dataset)):
+            writer.write(dataset[i])
+    binary = BinaryDataset(corpus)
+    assert len(binary) == len(dataset)
+    for i in range(len(dataset)):
+        assert binary[i] == dataset[i]
+    kept_index = filter_utts(dataset, min_token_num=10, max_token_num=40)
+    assert filter_utts(binary, min_token_num=10, max_token_num=40) == kept_index
+    th.testing.assert_close(concat_data(4, binary, kept_index, sos=1, eos=2),
+                            concat_data(4, dataset, kept_index, sos=1, eos=2))
+    kwargs = {"bptt_size": 10} if fmt == "lm@bptt" else {}
+    loaders = [
+        aps_dataloader(fmt=fmt,
+                       sos=1,
+                       eos=2,
+                       text=text,
+                       vocab_dict=vocab,
+                       train=False,
+                       max_batch_size=4,
+                       **kwargs) for text in [f"{egs_dir}/egs.token", corpus]
+    ]
+    for egs_txt, egs_bin in zip(*loaders):
+        th.testing.assert_close(egs_txt["src"], egs_bin["src"])
+        th.testing.assert_close(egs_txt["tgt"], egs_bin["tgt"])
+
+
+@pytest.mark.parametrize("mode", ["utt", "bptt"])
+@pytest.mark.parametrize("binary", [True, False])
+def test_lm_shard_loader(tmp_path, mode, binary):
+    egs_dir = "tests/data/dataloader/lm"
+    vocab = load_dict(f"{egs_dir}/dict")
+    dataset = Dataset(f"{egs_dir}/egs.token", vocab)
+    shards = []
+    for n in range(3):
+        if binary:
+            shards.append(str(tmp_path / f"egs.{n}.bin"))
+            with BinaryCorpusWriter(shards[-1]) as writer:
+                for i in range(n, len(dataset), 3):
+                    writer.write(dataset[i])
+        else:
+            shards.append(str(tmp_path / f"egs.{n}.token"))
+            with open(shards[-1], "w") as token:
+                for i in range(n, len(dataset), 3):
+                    token.write(dataset.token[i])
+    shard_list = tmp_path / "shards"
+    shard_list.write_text("\n".join(shards))
+    kwargs = {"bptt_size": 10} if mode == "bptt" else {}
+    loader = aps_dataloader(fmt="lm@shard",
+                            sos=1,
+                            eos=2,
+                            text=str(shard_list),
+                            vocab_dict=vocab,
+                            mode=mode,
+                            shuffle_buffer=16,
+                            chunk_size_for_sort=32,
+                            max_batch_size=4,
+                            min_batch_size=1,
+                            **kwargs)
+    for epoch in range(2):
+        loader.set_epoch(epoch)
+        num_utts = 0
+        for egs in loader:
+            assert egs["src"].shape == egs["tgt"].shape
+            if mode == "bptt":
+                assert egs["src"].shape == th.Size([4, 10])
+                assert egs["reset"] == (num_utts == 0)
+                th.testing.assert_close(egs["src"][:, 1:], egs["tgt"][:, :-1])
+            num_utts += egs["#utt"]
+        assert num_utts > 0
+
+
+def make_lm_shards(tmp_path, dataset, shard_size):
+    shards = []
+    beg = 0
+    for n, size in enumerate(shard_size):
+        shards.append(str(tmp_path / f"egs.{n}.token"))
+        with open(shards[-1], "w") as token:
+            for i in range(beg, beg + size):
+                token.write(dataset.token[i])
+        beg += size
+    return shards
+
+
+@pytest.mark.parametrize("world_size", [1, 2, 4])
+def test_lm_shard_loader_partition(tmp_path, world_size):
+    egs_dir = "tests/data/dataloader/lm"
+    vocab = load_dict(f"{egs_dir}/dict")
+    dataset = Dataset(f"{egs_dir}/egs.token", vocab)
+    shards = make_lm_shards(tmp_path, dataset, [150, 90, 40, 20])
+    kept_utts = sorted(
+        tuple(dataset[i]) for i in range(len(dataset)) if len(dataset[i]) >= 2)
+    loaders = [
+        ShardDataLoader(shards,
+                        vocab_dict=vocab,
+                        sos=1,
+                        eos=2,
+                        mode="utt",
+                        shuffle_buffer=16,
+                        max_batch_size=1,
+                        min_batch_size=1) for _ in range(world_size)
+    ]
+    # simulate the ranks
+    for rank, loader in enumerate(loaders):
+        loader.world_size, loader.rank = world_size, rank
+    for epoch in range(2):
+        rank_utts = []
+        for loader in loaders:
+            loader.set_epoch(epoch)
+            rank_utts.append(
+                [tuple(egs["src"][0, 1:].tolist()) for egs in loader])
+        # each utterance appears once in one epoch
+        assert sorted(sum(rank_utts, [])) == kept_utts
+        # no overlap between the ranks
+        for i in range(world_size):
+            for j in range(i + 1, world_size):
+                assert not set(rank_utts[i]) & set(rank_utts[j])
+
+
+@pytest.mark.parametrize("mode", ["utt", "bptt"])
+def test_lm_shard_loader_sync(tmp_path, monkeypatch, mode):
+    egs_dir = "tests/data/dataloader/lm"
+    vocab = load_dict(f"{egs_dir}/dict")
+    dataset = Dataset(f"{egs_dir}/egs.token", vocab)
+    # unbalanced shards
+    shards = make_lm_shards(tmp_path, dataset, [150, 90, 40, 20])
+    world_size = 2
+    lock = threading.Lock()
+    barrier = threading.Barrier(world_size)
+    flags = []
+
+    def all_reduce(tensor):
+        with lock:
+            flags.append(tensor.item())
+        barrier.wait()
+        avg = sum(flags) / world_size
+        if barrier.wait() == 0:
+            flags.clear()
+        barrier.wait()
+        return th.tensor([avg])
+
+    monkeypatch.setattr(dist, "get_backend", lambda: "none")
+    monkeypatch.setattr(dist, "all_reduce", all_reduce)
+    kwargs = {"bptt_size": 10} if mode == "bptt" else {}
+    loaders = [
+        ShardDataLoader(shards,
+                        vocab_dict=vocab,
+                        sos=1,
+                        eos=2,
+                        mode=mode,
+                        shuffle_buffer=16,
+                        max_batch_size=4,
+                        min_batch_size=1,
+                        **kwargs) for _ in range(world_size)
+    ]
+    num_batches = [[] for _ in range(world_size)]
+
+    def run(rank):
+        loader = loaders[rank]
+        loader.distributed = True
+        loader.world_size, loader.rank = world_size, rank
+        for epoch in range(3):
+            loader.set_epoch(epoch)
+            num_batches[rank].append(sum(1 for _ in loader))
+
+    workers = [
+        threading.Thread(target=run, args=(rank,)) for rank in range(world_size)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    # same #steps on each rank
+    assert num_batches[0] == num_batches[1]
+    assert min(num_batches[0]) > 0
+
+
+@pytest.mark.parametrize("batch_size", [1, 2, 4])
+@pytest.mark.parametrize("chunk_size", [32000, 64000])
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_ss_chunk_plan_loader(tmp_path, batch_size, chunk_size, num_workers):
+    egs_dir = "tests/data/dataloader/se"
+    wav_reader = AudioReader(f"{egs_dir}/wav.1.scp", sr=16000)
+    utt2nsamps = tmp_path / "utt2nsamps"
+    with open(utt2nsamps, "w") as f:
+        for key, wav in wav_reader:
+            f.write(f"{key}\t{wav.shape[-1]}\n")
+    loader = aps_dataloader(fmt="se@chunk",
+                            mix_scp=f"{egs_dir}/wav.1.scp",
+                            ref_scp=f"{egs_dir}/wav.1.scp,{egs_dir}/wav.1.scp",
+                            utt2nsamps=str(utt2nsamps),
+                            sr=16000,
+                            max_batch_size=batch_size,
+                            chunk_size=chunk_size,
+                            num_workers=num_workers)
+    for epoch in range(2):
+        loader.set_epoch(epoch)
+        num_batches = 0
+        for egs in loader:
+            assert egs["mix"].shape == th.Size([batch_size, chunk_size])
+            assert len(egs["ref"]) == 2
+            assert egs["ref"][0].shape == th.Size([batch_size, chunk_size])
+            th.testing.assert_close(egs["mix"], egs["ref"][1])
+            num_batches += 1
+        assert num_batches == len(loader.dataset) // batch_size
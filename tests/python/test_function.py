@@ -3,15 +3,35 @@
 # Copyright 2020 Jian Wu
 # License: Apache 2.0 (http://www.apache.org/licenses/LICENSE-2.0)
 
+import math
+import yaml
 import pytest
+import numpy as np
 import torch as th
 import torch.nn as nn
 
+from collections import defaultdict
 from aps.libs import dynamic_importlib, ApsRegisters, ApsModules
 from aps.conf import load_dict
 from aps.asr.transformer.impl import ApsMultiheadAttention
 from aps.asr.transformer.utils import digit_shift, prep_sub_mask
 from aps.asr.base.attention import padding_mask
+from aps.asr.beam_search.ctc import CtcApi
+from aps.asr.beam_search.utils import BeamSearchParam, BeamTracker, BatchBeamTracker
+from aps.asr.beam_search.transducer import TransducerBeamSearch
+from aps.asr.transducer.decoder import TorchRNNDecoder
+from aps.asr.transformer.decoder import TorchTransformerDecoder
+from aps.asr.lm.rnn import TorchRNNLM
+from aps.asr.lm.transformer import TorchXfmrLM
+from aps.asr.lm import ngram
+from aps.const import MIN_F32
+from aps.eval.rescore import NbestRescorer
+from aps.eval.wrapper import NnetEvaluator
+from aps.eval.pipeline import DecodingPipeline, dynamic_batches
+from aps.eval.sse import ChunkStitcher
+from aps.cplx import ComplexTensor
+from aps.asr.filter.mvdr import MvdrBeamformer
+from aps.task.ml import hermitian_det
 
 external_dir = "tests/data/external"
 checkpoint_dir = "tests/data/checkpoint"
@@ -104,3 +124,511 @@ def test_aps_selfattn(index):
     assert my2.shape == th2.shape
     th.testing.assert_allclose(my2, th2)
     th.testing.assert_allclose(my1, th1)
+
+
+def ctc_prefix_beam_search(log_prob, blank, beam_size):
+    """
+    Reference implementation of CTC prefix beam search
+    """
+    topk_score, topk_token = th.topk(log_prob, beam_size, -1)
+    # prefix: (log_pb, log_pn)
+    beam = [((), (0.0, -math.inf))]
+    for t in range(log_prob.shape[0]):
+        next_beam = defaultdict(lambda: (-math.inf, -math.inf))
+        for logp, tok in zip(topk_score[t].tolist(), topk_token[t].tolist()):
+            for prefix, (log_pb, log_pn) in beam[:beam_size]:
+                score = np.logaddexp(log_pb, log_pn)
+                pb, pn = next_beam[prefix]
+                if tok == blank:
+                    next_beam[prefix] = (np.logaddexp(pb, score + logp), pn)
+                    continue
+                repeat = len(prefix) and prefix[-1] == tok
+                ext_pb, ext_pn = next_beam[prefix + (tok,)]
+                ext_pn = np.logaddexp(ext_pn,
+                                      (log_pb if repeat else score) + logp)
+                next_beam[prefix + (tok,)] = (ext_pb, ext_pn)
+                if repeat:
+                    pb, pn = next_beam[prefix]
+                    next_beam[prefix] = (pb, np.logaddexp(pn, log_pn + logp))
+        beam = sorted(next_beam.items(),
+                      key=lambda n: np.logaddexp(*n[1]),
+                      reverse=True)
+    return [(list(p), np.logaddexp(*s)) for p, s in beam]
+
+
+@pytest.mark.parametrize("T, V", [pytest.param(50, 10), pytest.param(30, 4)])
+@pytest.mark.parametrize("beam_size", [2, 4])
+def test_ctc_prefix_beam_search(T, V, beam_size):
+    ctc_api = CtcApi(V - 1)
+    ctc_prob = th.randn(T, V) * 2
+    nbest = ctc_api.beam_search(ctc_prob,
+                                beam_size=beam_size,
+                                nbest=beam_size,
+                                sos=V,
+                                eos=V + 1,
+                                len_norm=False)
+    ref = ctc_prefix_beam_search(th.log_softmax(ctc_prob, -1), V - 1, beam_size)
+    for hyp, (ref_seq, ref_score) in zip(nbest, ref):
+        assert hyp["trans"] == [V] + ref_seq + [V + 1]
+        assert abs(hyp["score"] - ref_score) < 1e-3
+    # batch version
+    batch_nbest = ctc_api.beam_search_batch(th.stack([ctc_prob, ctc_prob]),
+                                            ctc_len=th.tensor([T, T - 1]),
+                                            beam_size=beam_size,
+                                            nbest=beam_size)
+    assert batch_nbest[0] == ctc_api.beam_search(ctc_prob,
+                                                 beam_size=beam_size,
+                                                 nbest=beam_size)
+    assert batch_nbest[1] == ctc_api.beam_search(ctc_prob[:-1],
+                                                 beam_size=beam_size,
+                                                 nbest=beam_size)
+
+
+@pytest.mark.parametrize("num_seeds", [300])
+def test_ctc_prefix_beam_search_random(num_seeds):
+    T, V, beam_size = 40, 5, 3
+    ctc_api = CtcApi(V - 1)
+    rng = th.Generator().manual_seed(0)
+    for _ in range(num_seeds):
+        ctc_prob = th.randn(T, V, generator=rng) * 2
+        nbest = ctc_api.beam_search(ctc_prob,
+                                    beam_size=beam_size,
+                                    nbest=beam_size,
+                                    sos=V,
+                                    eos=V + 1,
+                                    len_norm=False)
+        ref = ctc_prefix_beam_search(th.log_softmax(ctc_prob, -1), V - 1,
+                                     beam_size)
+        for hyp, (ref_seq, ref_score) in zip(nbest, ref):
+            assert hyp["trans"] == [V] + ref_seq + [V + 1]
+            assert abs(hyp["score"] - ref_score) < 1e-3
+
+
+def run_beam_tracker(tracker, am_prob):
+    """
+    Run beam search with the AM score depends on (step, last token)
+    """
+    step, stop = 0, False
+    while not stop:
+        token, _ = tracker[-1]
+        stop = tracker.step(am_prob[step, token], 0)
+        step += 1
+
+
+@pytest.mark.parametrize("ctc_weight", [0.3, 1])
+def test_ctc_score_beam_search_batch(ctc_weight):
+    N, T, V, U, beam_size = 3, 30, 12, 40, 3
+    sos = eos = V - 2
+    am_prob = th.log_softmax(th.randn(U, V, V) * 2, -1)
+    ctc_prob = th.randn(N, T, V) * 2
+    ctc_len = th.tensor([T, T // 3, T // 2])
+    kwargs = {
+        "beam_size": beam_size,
+        "sos": sos,
+        "eos": eos,
+        "ctc_weight": ctc_weight,
+        "ctc_beam_size": 5,
+        "len_norm": False
+    }
+    tracker = BatchBeamTracker(N,
+                               BeamSearchParam(min_len=[1] * N,
+                                               max_len=[U - 1] * N,
+                                               **kwargs),
+                               ctc_prob=ctc_prob,
+                               ctc_len=ctc_len)
+    run_beam_tracker(tracker, am_prob)
+    batch_nbest = tracker.nbest_hypos(beam_size, auto_stop=False)
+    for n in range(N):
+        tracker = BeamTracker(BeamSearchParam(min_len=1,
+                                              max_len=U - 1,
+                                              **kwargs),
+                              ctc_prob=ctc_prob[n, :ctc_len[n]])
+        run_beam_tracker(tracker, am_prob)
+        nbest = tracker.nbest_hypos(beam_size)
+        assert [h["trans"] for h in nbest
+               ] == [h["trans"] for h in batch_nbest[n]]
+        for hyp, ref in zip(batch_nbest[n], nbest):
+            assert abs(hyp["score"] - ref["score"]) < 1e-3
+
+
+def ctc_viterbi_score(log_prob, dec_seq, blank):
+    """
+    Reference implementation of CTC viterbi (best path) score
+    """
+    ext_seq = [blank]
+    for tok in dec_seq:
+        ext_seq += [tok, blank]
+    S = len(ext_seq)
+    score = [-math.inf] * S
+    score[0] = log_prob[0, blank].item()
+    score[1] = log_prob[0, ext_seq[1]].item()
+    for t in range(1, log_prob.shape[0]):
+        prev = score
+        score = [-math.inf] * S
+        for s in range(S):
+            cand = [prev[s]]
+            if s >= 1:
+                cand.append(prev[s - 1])
+            if s >= 2 and ext_seq[s] != blank and ext_seq[s] != ext_seq[s - 2]:
+                cand.append(prev[s - 2])
+            score[s] = max(cand) + log_prob[t, ext_seq[s]].item()
+    return max(score[-1], score[-2])
+
+
+@pytest.mark.parametrize(
+    "T, V, U",
+    [pytest.param(40, 10, 8),
+     pytest.param(30, 4, 10),
+     pytest.param(20, 3, 9)])
+def test_ctc_viterbi_align(T, V, U):
+    ctc_api = CtcApi(V - 1)
+    ctc_prob = th.randn(T, V) * 2
+    dec_seq = th.randint(0, V - 1, (U,))
+    ali = ctc_api.viterbi_align(ctc_prob, dec_seq)
+    log_prob = th.log_softmax(ctc_prob, -1)
+    ref_score = ctc_viterbi_score(log_prob, dec_seq.tolist(), V - 1)
+    assert abs(ali["score"] - ref_score) < 1e-3
+    assert len(ali["align_seq"]) == T
+    assert [t for t in ali["align_seq"] if t != V - 1] == dec_seq.tolist()
+    # batch version (with padding)
+    dec_pad = th.cat([dec_seq[:-1], th.tensor([-1])])
+    batch_ali = ctc_api.viterbi_align_batch(th.stack([ctc_prob, ctc_prob]),
+                                            th.stack([dec_seq, dec_pad]),
+                                            enc_len=th.tensor([T, T - 2]),
+                                            dec_len=th.tensor([U, U - 1]))
+    assert batch_ali[0] == ali
+    assert batch_ali[1] == ctc_api.viterbi_align(ctc_prob[:-2], dec_seq[:-1])
+
+
+@pytest.mark.parametrize("beam_size", [1, 4])
+@pytest.mark.parametrize("max_sym_per_frame", [1, 2])
+def test_transducer_beam_search_batch(beam_size, max_sym_per_frame):
+    V, T = 20, 15
+    decoder = TorchRNNDecoder(V,
+                              embed_size=32,
+                              enc_dim=32,
+                              jot_dim=32,
+                              num_layers=2,
+                              hidden=32)
+    decoder.eval()
+    beam_search = TransducerBeamSearch(decoder, blank=V - 1)
+    enc_out = th.randn(3, T, 32)
+    enc_len = th.tensor([T, T - 3, T - 5])
+    with th.no_grad():
+        batch_nbest = beam_search.beam_search_batch(
+            enc_out,
+            enc_len,
+            beam_size=beam_size,
+            nbest=beam_size,
+            max_sym_per_frame=max_sym_per_frame)
+        for n, nbest in enumerate(batch_nbest):
+            assert len(nbest) == beam_size
+            assert nbest[0]["trans"][0] == nbest[0]["trans"][-1] == V - 1
+            ref = beam_search.beam_search_batch(
+                enc_out[n:n + 1, :enc_len[n]],
+                beam_size=beam_size,
+                nbest=beam_size,
+                max_sym_per_frame=max_sym_per_frame)
+            assert [h["trans"] for h in nbest] == [h["trans"] for h in ref[0]]
+
+
+@pytest.mark.parametrize("pre_norm", [True, False])
+def test_xfmr_decoder_incremental_step(pre_norm):
+    V, T, U = 30, 20, 8
+    decoder = TorchTransformerDecoder(V,
+                                      arch_kwargs={
+                                          "att_dim": 64,
+                                          "nhead": 4,
+                                          "feedforward_dim": 128,
+                                          "pre_norm": pre_norm
+                                      },
+                                      num_layers=2)
+    decoder.eval()
+    # 2 utterances x 2 beams
+    enc_out = th.repeat_interleave(th.rand(T, 2, 64), 2, 1)
+    enc_len = th.tensor([T, T, T - 4, T - 4])
+    tgt_pad = th.randint(0, V, (4, U))
+    with th.no_grad():
+        # reference: run decoder layers on the whole sequence
+        ref = decoder.abs_pos_enc(decoder.vocab_embed(tgt_pad))
+        for layer in decoder.decoder.layers:
+            ref = layer(ref,
+                        enc_out,
+                        tgt_mask=prep_sub_mask(U),
+                        memory_key_padding_mask=padding_mask(enc_len) == 1)
+        if decoder.decoder.norm is not None:
+            ref = decoder.decoder.norm(ref)
+        ref = decoder.output(ref)
+        cache = decoder.init_cache(enc_out, enc_len=enc_len)
+        dec_out = [decoder.incremental_step(tgt_pad[:, 0], cache)]
+        # with beam back-pointers
+        point = th.tensor([1, 0, 3, 2])
+        dec_out.append(decoder.incremental_step(tgt_pad[point, 1], cache,
+                                                point))
+        for u in range(2, U):
+            dec_out.append(decoder.incremental_step(tgt_pad[point, u], cache))
+    dec_out = th.stack(dec_out)
+    th.testing.assert_allclose(dec_out[0], ref[0])
+    th.testing.assert_allclose(dec_out[1:], ref[1:, point])
+
+
+@pytest.mark.parametrize("lm_type", ["rnn", "xfmr"])
+def test_nbest_rescorer(lm_type):
+    vocab_size = 20
+    if lm_type == "rnn":
+        lm = TorchRNNLM(embed_size=32,
+                        vocab_size=vocab_size,
+                        num_layers=2,
+                        hidden_size=64)
+    else:
+        lm = TorchXfmrLM(vocab_size=vocab_size,
+                         num_layers=2,
+                         arch_kwargs={
+                             "att_dim": 32,
+                             "nhead": 4,
+                             "feedforward_dim": 64
+                         })
+    lm.eval()
+    hypos = [
+        th.randint(0, vocab_size - 2, (th.randint(1, 10,
+                                                  (1,)).item(),)).tolist()
+        for _ in range(20)
+    ]
+    # duplicated hypothesis & prefixes
+    hypos += [hypos[0], hypos[1][:-1], hypos[2][:1], []]
+    rescorer = NbestRescorer(lm,
+                             sos=vocab_size - 2,
+                             eos=vocab_size - 1,
+                             batch_size=4)
+    with th.no_grad():
+        ref = [
+            lm.score(hyp, sos=vocab_size - 2, eos=vocab_size - 1)
+            for hyp in hypos
+        ]
+    np.testing.assert_allclose(rescorer.score(hypos), ref, rtol=1e-4, atol=1e-4)
+
+
+class StubKenlm(object):
+    """
+    Stub of the kenlm module: a bigram LM with deterministic scores
+    """
+
+    class State(object):
+
+        def __init__(self):
+            self.word = None
+
+        def __hash__(self):
+            return hash(self.word)
+
+        def __eq__(self, other):
+            return self.word == other.word
+
+    class LanguageModel(object):
+
+        def __init__(self, lm):
+            self.num_calls = 0
+
+        def BeginSentenceWrite(self, state):
+            state.word = "<s>"
+
+        def BaseScore(self, state, word, out_state):
+            self.num_calls += 1
+            out_state.word = word
+            return -(hash((state.word, word)) % 1000) / 100
+
+
+@pytest.mark.parametrize("topk", [0, 4])
+def test_ngram_lm(tmp_path, monkeypatch, topk):
+    vocab_size, beam_size = 20, 4
+    with open(tmp_path / "dict", "w") as f:
+        for i in range(vocab_size - 2):
+            f.write(f"t{i} {i}\n")
+        f.write(f"<sos> {vocab_size - 2}\n<eos> {vocab_size - 1}\n")
+    monkeypatch.setattr(ngram, "kenlm", StubKenlm, raising=False)
+    monkeypatch.setattr(ngram, "kenlm_available", True)
+    lm = ngram.NgramLM("stub", str(tmp_path / "dict"), cache_size=8, topk=topk)
+    assert lm.token[-2:] == ["<s>", "</s>"]
+
+    def ref_score(prev_word):
+        # per-token BaseScore, the path without context cache
+        state = StubKenlm.State()
+        state.word = prev_word
+        return th.tensor([
+            lm.ngram_lm.BaseScore(state, tok, StubKenlm.State())
+            for tok in lm.token
+        ])
+
+    prev_word = ["<s>"] * beam_size
+    state = None
+    prev_token = th.zeros(beam_size, dtype=th.int64)
+    for _ in range(5):
+        candidate = None
+        if topk:
+            candidate = th.stack(
+                [th.randperm(vocab_size)[:topk] for _ in range(beam_size)])
+        num_calls = lm.ngram_lm.num_calls
+        score, state = lm(prev_token, state, candidate=candidate)
+        # + beam_size: next states of the previous tokens
+        assert lm.ngram_lm.num_calls - num_calls <= beam_size * (
+            (topk if topk else vocab_size) + 1)
+        assert score.shape == (beam_size, vocab_size)
+        assert len(lm.cache) <= 8
+        for n in range(beam_size):
+            ref = ref_score(prev_word[n])
+            if topk:
+                # only the candidates are scored
+                mask = th.zeros(vocab_size, dtype=th.bool)
+                mask[candidate[n]] = True
+                th.testing.assert_close(score[n, mask], ref[mask])
+                assert (score[n, ~mask] == MIN_F32).all()
+            else:
+                th.testing.assert_close(score[n], ref)
+                assert state[n].score is None
+        prev_token = th.randint(0, vocab_size, (beam_size,))
+        prev_word = [lm.token[t] for t in prev_token.tolist()]
+    # LRU eviction
+    contexts = []
+    for t in range(vocab_size):
+        _, state = lm(th.tensor([t]), state[:1])
+        contexts.append(state[0])
+    assert len(lm.cache) == 8
+    assert list(lm.cache.values()) == contexts[-8:]
+    # hit on the cached context, moved to the end of the cache
+    _, state = lm(th.tensor([vocab_size - 8]), [contexts[-1]])
+    assert state[0] is contexts[-8]
+    assert list(lm.cache.values())[-1] is contexts[-8]
+
+
+def test_mmap_evaluator(tmp_path):
+    vocab_size = 20
+    nnet_conf = {
+        "embed_size": 32,
+        "vocab_size": vocab_size,
+        "num_layers": 2,
+        "hidden_size": 64,
+        "tie_weights": False
+    }
+    lm = TorchRNNLM(**nnet_conf)
+    th.save({
+        "model_state": lm.state_dict(),
+        "epoch": 10
+    }, tmp_path / "best.pt.tar")
+    with open(tmp_path / "train.yaml", "w") as f:
+        yaml.dump({"nnet": "asr@rnn_lm", "nnet_conf": nnet_conf}, f)
+    ref = NnetEvaluator(str(tmp_path)).nnet
+    token = th.randint(0, vocab_size, (2, 10))
+    with th.no_grad():
+        ref_out, _ = ref(token)
+    # the 1st one dumps the weights & the 2nd one loads them only
+    for _ in range(2):
+        evaluator = NnetEvaluator(str(tmp_path), mmap=True)
+        assert (tmp_path / "best.weights").exists()
+        with th.no_grad():
+            mmap_out, _ = evaluator.nnet(token)
+        th.testing.assert_close(ref_out, mmap_out)
+
+
+@pytest.mark.parametrize("batch_size, bucket_size", [(1, 0), (3, 8), (4, 100)])
+@pytest.mark.parametrize("num_workers", [1, 2])
+def test_decoding_pipeline(batch_size, bucket_size, num_workers):
+    inps = [
+        (f"utt-{i}", th.rand(th.randint(1, 20, (1,)).item())) for i in range(30)
+    ]
+    pipeline = DecodingPipeline(lambda inps: [inp.sum() for inp in inps],
+                                num_workers=num_workers,
+                                batch_size=batch_size,
+                                bucket_size=bucket_size,
+                                prefetch=4)
+    results = list(pipeline.run(iter(inps)))
+    # in input order
+    assert [key for key, _ in results] == [key for key, _ in inps]
+    for (_, out), (_, inp) in zip(results, inps):
+        th.testing.assert_close(out, inp.sum())
+
+
+@pytest.mark.parametrize("num_workers", [1, 2])
+def test_decoding_pipeline_reader_error(num_workers):
+
+    def src_iter():
+        for i in range(5):
+            if i == 3:
+                raise ValueError("broken input")
+            yield f"utt-{i}", th.rand(10)
+
+    pipeline = DecodingPipeline(lambda inps: [inp.sum() for inp in inps],
+                                num_workers=num_workers)
+    results = []
+    with pytest.raises(RuntimeError) as err:
+        for result in pipeline.run(src_iter()):
+            results.append(result)
+    assert isinstance(err.value.__cause__, ValueError)
+    assert len(results) <= 3
+
+
+@pytest.mark.parametrize("max_batch_len", [10, 40])
+@pytest.mark.parametrize("num_workers", [1, 2])
+def test_dynamic_batches(max_batch_len, num_workers):
+    utt2len = {f"utt-{i}": th.randint(1, 20, (1,)).item() for i in range(50)}
+    batches = dynamic_batches(utt2len, max_batch_len, max_batch_size=8)
+    assert sorted(i for b in batches for i, _ in b) == list(range(50))
+    for batch in batches:
+        assert len(batch) <= 8
+        lens = [utt2len[key] for _, key in batch]
+        assert len(batch) == 1 or len(batch) * max(lens) <= max_batch_len
+    keys = list(utt2len.keys())
+    pipeline = DecodingPipeline(lambda inps: [-inp for inp in inps],
+                                num_workers=num_workers)
+    results = pipeline.run(
+        ([(i, key, utt2len[key]) for i, key in batch] for batch in batches),
+        batched=True)
+    # restore the original order
+    assert list(results) == [(key, -utt2len[key]) for key in keys]
+
+
+@pytest.mark.parametrize("num_streams", [1, 2, 4])
+@pytest.mark.parametrize("crossfade", [True, False])
+def test_chunk_stitcher(num_streams, crossfade):
+    chunk_len, lctx, rctx = 400, 100, 50
+    num_chunks = 6
+    src = th.rand(num_streams, lctx + num_chunks * chunk_len + rctx)
+    chunks = []
+    for t in range(num_chunks):
+        beg = t * chunk_len
+        chunk = src[:, beg:beg + lctx + chunk_len + rctx]
+        # permutated output streams
+        permu = th.randperm(num_streams)
+        chunks.append(chunk[0] if num_streams == 1 else list(chunk[permu]))
+    stitcher = ChunkStitcher(chunk_len, lctx, rctx, crossfade=crossfade)
+    expected_length = src.shape[-1] - 120
+    stitched = stitcher.stitch(chunks, expected_length)
+    if num_streams == 1:
+        stitched = [stitched]
+    assert len(stitched) == num_streams
+    # streams are aligned with the ones in the first chunk
+    ref = src[:, :expected_length]
+    if num_streams > 1:
+        ref = ref[[int(th.nonzero(src[:, 0] == c[0])) for c in chunks[0]]]
+    for s, r in zip(stitched, ref):
+        assert s.shape == th.Size([expected_length])
+        assert th.allclose(s, r, atol=1e-5)
+
+
+@pytest.mark.parametrize("N,C,F,T", [(2, 4, 65, 50)])
+def test_native_cplx(N, C, F, T):
+    mvdr = MvdrBeamformer(F, att_dim=128)
+    mask = th.rand(N, T, F)
+    real, imag = th.rand(N, C, F, T), th.rand(N, C, F, T)
+    outs = []
+    for native in [False, True]:
+        x = ComplexTensor(real, imag, native=native)
+        assert x.is_native == native
+        y = mvdr(mask, x)
+        # N x F x C x T
+        xf = x.transpose(1, 2)
+        # N x F x C x C
+        Bk = (xf[..., None, :] * xf[..., None, :, :].conj()).sum(-1) / T
+        det = hermitian_det(Bk)
+        outs.append((y.real, y.imag, det))
+    for emu, nat in zip(*outs):
+        assert th.allclose(emu, nat, rtol=1e-3, atol=1e-4)
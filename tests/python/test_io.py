@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+# Copyright 2021 Jian Wu
+# License: Apache 2.0 (http://www.apache.org/licenses/LICENSE-2.0)
+
+import pytest
+import numpy as np
+
+from aps.io import AudioReader, PackedAudioWriter
+
+egs_dir = "tests/data/dataloader/se"
+
+
+@pytest.mark.parametrize("norm", [True, False])
+@pytest.mark.parametrize("dtype", ["int16", "float32"])
+def test_packed_audio(tmp_path, norm, dtype):
+    wav_reader = AudioReader(f"{egs_dir}/wav.1.scp", sr=16000, norm=norm)
+    pack, scp = str(tmp_path / "egs.pack"), str(tmp_path / "egs.scp")
+    with PackedAudioWriter(pack, scp, sr=16000, dtype=dtype) as writer:
+        for key, wav in wav_reader:
+            writer.write(key, wav, norm=norm)
+    pack_reader = AudioReader(scp, sr=16000, norm=norm)
+    assert len(pack_reader) == len(wav_reader)
+    for key, wav in wav_reader:
+        pack = pack_reader[key]
+        assert pack.shape == wav.shape
+        # owned & writable, not the memory map of the archive
+        assert pack.flags.writeable
+        np.testing.assert_allclose(pack, wav, rtol=1e-5, atol=1e-5)
+        beg, end = 1000, 16000
+        np.testing.assert_allclose(pack_reader.read(key, beg=beg, end=end),
+                                   wav[beg:end],
+                                   rtol=1e-5,
+                                   atol=1e-5)
+        np.testing.assert_allclose(wav_reader.read(key, beg=beg, end=end),
+                                   wav[beg:end])
+
+
+def test_packed_audio_multi_channel(tmp_path):
+    wav = np.random.uniform(-1, 1, (4, 16000)).astype("float32")
+    pack, scp = str(tmp_path / "egs.pack"), str(tmp_path / "egs.scp")
+    with PackedAudioWriter(pack, scp, sr=16000, dtype="float32") as writer:
+        writer.write("egs", wav)
+    pack_reader = AudioReader(scp, sr=16000, norm=True)
+    np.testing.assert_allclose(pack_reader["egs"], wav)
+    np.testing.assert_allclose(pack_reader.read("egs", beg=400, end=800),
+                               wav[:, 400:800])
+    pack_reader = AudioReader(scp, sr=16000, norm=True, channel=1)
+    np.testing.assert_allclose(pack_reader["egs"], wav[1])
+    assert pack_reader["egs"].flags.writeable
+
+
+@pytest.mark.parametrize("fmt", ["wav", "ark", "pack", "pipe"])
+def test_audio_nsamps(tmp_path, fmt):
+    wav_reader = AudioReader(f"{egs_dir}/wav.1.scp", sr=16000)
+    scp = str(tmp_path / "egs.scp")
+    if fmt == "pack":
+        with PackedAudioWriter(str(tmp_path / "egs.pack"), scp) as writer:
+            for key, wav in wav_reader:
+                writer.write(key, wav)
+    else:
+        ark = str(tmp_path / "egs.ark")
+        with open(scp, "w") as scp_f, open(ark, "wb") as ark_f:
+            for key, path in wav_reader.index_dict.items():
+                if fmt == "wav":
+                    scp_f.write(f"{key}\t{path}\n")
+                elif fmt == "pipe":
+                    scp_f.write(f"{key}\tcat {path} |\n")
+                else:
+                    ark_f.write(f"{key} ".encode())
+                    scp_f.write(f"{key}\t{ark}:{ark_f.tell()}\n")
+                    with open(path, "rb") as wav_f:
+                        ark_f.write(wav_f.read())
+    meta_cache = str(tmp_path / "meta.json")
+    reader = AudioReader(scp, sr=16000, meta_cache=meta_cache)
+    utt2nsamps = reader.utt2nsamps(num_threads=4)
+    for key, wav in wav_reader:
+        assert utt2nsamps[key] == wav.shape[-1]
+        assert reader.duration(key) == wav.shape[-1] / 16000
+    # load from the cache
+    reader = AudioReader(scp, sr=16000, meta_cache=meta_cache)
+    assert len(reader.meta) == (0 if fmt == "pipe" else len(wav_reader))
+    assert reader.utt2nsamps() == utt2nsamps
+
+
+@pytest.mark.parametrize("num_threads", [2, 4])
+def test_audio_prefetch(tmp_path, num_threads):
+    wav_reader = AudioReader(f"{egs_dir}/wav.1.scp", sr=16000)
+    # mix the pipe entries with the normal ones
+    scp = str(tmp_path / "egs.scp")
+    with open(scp, "w") as scp_f:
+        for n, (key, path) in enumerate(wav_reader.index_dict.items()):
+            scp_f.write(f"{key}\tcat {path} |\n" if n %
+                        2 else f"{key}\t{path}\n")
+    reader = AudioReader(scp, sr=16000, num_threads=num_threads, prefetch=3)
+    keys = []
+    for key, wav in reader:
+        keys.append(key)
+        assert np.array_equal(wav, wav_reader[key])
+    assert keys == wav_reader.index_keys
+    # stop early
+    for n, _ in enumerate(reader):
+        if n == 1:
+            break
+    keys = wav_reader.index_keys[::-1]
+    assert [key for key, _ in reader.iter_keys(keys)] == keys
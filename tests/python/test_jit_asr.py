@@ -13,6 +13,11 @@ from aps.asr.transformer.pose import RelPosEncoding
 from aps.streaming_asr.utils import compute_conv_context
 from aps.streaming_asr.transformer.impl import StreamingRelMultiheadAttention
 from aps.streaming_asr.transformer.encoder import StreamingTransformerEncoder
+from aps.streaming_asr.ctc import CtcASR
+from aps.streaming_asr.transducers import TransducerASR
+from aps.streaming_asr.session import StreamingDecodingSession
+from aps.asr.beam_search.transducer import TransducerBeamSearch
+from aps.transform.asr import FeatureTransform
 
 
 def test_streaming_lstm():
@@ -231,6 +236,94 @@ def test_streaming_cfmr_linear(lctx, chunk):
         th.testing.assert_allclose(c[:, :chunk], egs_out[:, t:t + chunk])
 
 
+@pytest.mark.parametrize("enc_type, lctx, rctx, enc_kwargs", [
+    pytest.param("pytorch_rnn", -1, -1, {
+        "num_layers": 2,
+        "hidden": 64
+    }),
+    pytest.param("fsmn", 4, 2, {
+        "dim": 64,
+        "project": 32,
+        "num_layers": 2,
+        "lctx": 2,
+        "rctx": 1
+    }),
+    pytest.param("conv1d", 3, 3, {
+        "dim": 64,
+        "num_layers": 2,
+        "kernel": 3,
+        "stride": 2
+    }),
+    pytest.param(
+        "xfmr", -1, -1, {
+            "num_layers": 2,
+            "chunk": 4,
+            "lctx": 2,
+            "proj": "linear",
+            "proj_kwargs": {
+                "norm": "BN"
+            },
+            "arch_kwargs": {
+                "att_dim": 32,
+                "nhead": 4,
+                "feedforward_dim": 64
+            }
+        })
+])
+@pytest.mark.parametrize("transducer", [True, False])
+def test_streaming_session(enc_type, lctx, rctx, enc_kwargs, transducer):
+    V, S, beam_size = 20, 17234, 4
+    asr_transform = FeatureTransform(feats="fbank-log",
+                                     frame_len=400,
+                                     frame_hop=160)
+    if transducer:
+        nnet = TransducerASR(80,
+                             V,
+                             lctx=lctx,
+                             rctx=rctx,
+                             asr_transform=asr_transform,
+                             enc_type=enc_type,
+                             enc_proj=32,
+                             enc_kwargs=enc_kwargs,
+                             dec_kwargs={
+                                 "embed_size": 16,
+                                 "jot_dim": 32,
+                                 "num_layers": 1,
+                                 "hidden": 32
+                             })
+    else:
+        nnet = CtcASR(80,
+                      V,
+                      lctx=lctx,
+                      rctx=rctx,
+                      asr_transform=asr_transform,
+                      enc_type=enc_type,
+                      enc_kwargs=enc_kwargs)
+    nnet.eval()
+    wav = th.randn(S)
+    with th.no_grad():
+        if transducer:
+            beam_search = TransducerBeamSearch(nnet.decoder, blank=nnet.blank)
+            ref = beam_search.beam_search_batch(nnet._decoding_prep(wav),
+                                                beam_size=beam_size,
+                                                nbest=beam_size)[0]
+        else:
+            ref = nnet.beam_search(wav, beam_size=beam_size, nbest=beam_size)
+    session = StreamingDecodingSession(nnet,
+                                       beam_size=beam_size,
+                                       nbest=beam_size)
+    for _ in range(2):
+        session.reset()
+        for t in range(0, S, 1600):
+            partial = session.step(wav[t:t + 1600])
+            assert "trans" in partial
+        nbest = session.flush()
+        assert [h["trans"] for h in nbest] == [h["trans"] for h in ref]
+        for hyp, ref_hyp in zip(nbest, ref):
+            assert abs(hyp["score"] - ref_hyp["score"]) < 1e-3
+        assert session.latency()["num_chunks"] == (S + 1599) // 1600
+
+
 if __name__ == "__main__":
     # test_streaming_conv1d(3, 2, 3)
     # test_streaming_conv2d(3, 2, 3, 32)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+# Copyright 2021 Jian Wu
+# License: Apache 2.0 (http://www.apache.org/licenses/LICENSE-2.0)
+
+import os
+import sys
+import pytest
+import subprocess
+import numpy as np
+
+from aps.metric.sse import aps_sisnr, aps_sisnr_matrix, permute_sse_metric
+
+
+@pytest.mark.parametrize("snr", [10, 50, 70])
+@pytest.mark.parametrize("num_spks", [2, 3])
+def test_sisnr_matrix(snr, num_spks):
+    ref = np.random.randn(num_spks, 32000).astype(np.float32)
+    noise = np.random.randn(num_spks, 32000) * 10**(-snr / 20)
+    est = (ref + noise).astype(np.float32)
+    matrix = aps_sisnr_matrix(ref, est)
+    for n in range(num_spks):
+        for m in range(num_spks):
+            assert abs(matrix[n, m] - aps_sisnr(ref[n], est[m])) < 1e-2
+    # permutated estimation
+    perm = np.random.permutation(num_spks)
+    sisnr, ali = permute_sse_metric("sisnr",
+                                    ref,
+                                    est[perm],
+                                    compute_permutation=True)
+    ref_sisnr = np.mean([aps_sisnr(ref[n], est[n]) for n in range(num_spks)])
+    assert abs(sisnr - ref_sisnr) < 1e-2
+    assert (perm[ali] == np.arange(num_spks)).all()
+
+
+def test_compute_ss_metric_jobs(tmp_path):
+    egs_dir = "tests/data/metric/sse"
+    per_utt = []
+    env = {**os.environ, "PYTHONPATH": os.getcwd()}
+    for num_jobs in [1, 2]:
+        per_utt.append(tmp_path / f"sisnr.{num_jobs}")
+        subprocess.run([
+            sys.executable, "cmd/compute_ss_metric.py", "--metric", "sisnr",
+            "--num-jobs", f"{num_jobs}", "--per-utt", per_utt[-1],
+            f"{egs_dir}/bss_spk1.scp,{egs_dir}/bss_spk2.scp",
+            f"{egs_dir}/ref_spk1.scp,{egs_dir}/ref_spk2.scp"
+        ],
+                       env=env,
+                       check=True)
+    assert per_utt[0].read_text() == per_utt[1].read_text()
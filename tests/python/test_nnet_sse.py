@@ -334,3 +334,48 @@ def test_sepformer():
     assert bss.shape == th.Size([2, 32000])
     bss = sepformer.infer(mix[1])
     assert bss.shape == th.Size([32000])
+
+
+@pytest.mark.parametrize("num_spks", [1, 2])
+def test_infer_batch(num_spks):
+    nnet_cls = aps_sse_nnet("sse@time_tcn")
+    tasnet = nnet_cls(L=40,
+                      N=64,
+                      X=3,
+                      R=2,
+                      B=64,
+                      H=128,
+                      P=3,
+                      norm="gLN",
+                      num_spks=num_spks,
+                      non_linear="relu",
+                      causal=False)
+    tasnet.eval()
+    inp = th.rand(3, 16000)
+    sep = tasnet.infer_batch(inp, mode="time")
+    assert len(sep) == 3
+    for n in range(3):
+        ref = tasnet.infer(inp[n], mode="time")
+        if num_spks == 1:
+            assert th.allclose(sep[n], ref, atol=1e-5)
+        else:
+            assert len(sep[n]) == num_spks
+            for s, r in zip(sep[n], ref):
+                assert th.allclose(s, r, atol=1e-5)
+    # variable-length inputs
+    sep = tasnet.infer_batch([inp[0], inp[1, :12000]], mode="time")
+    lens = [
+        s.shape[-1] for s in (sep if num_spks == 1 else [s[0] for s in sep])
+    ]
+    assert lens == [16000, 12000]
+    # fall back to infer()
+    nnet_cls = aps_sse_nnet("sse@rnn_enh_ml")
+    rnn_enh_ml = nnet_cls(enh_transform=with_ipd_transform,
+                          num_bins=num_bins,
+                          input_size=num_bins * 4,
+                          input_proj=128,
+                          num_layers=1,
+                          hidden=128)
+    inp = th.rand(2, 5, 16000)
+    masks = rnn_enh_ml.infer_batch(inp)
+    assert len(masks) == 2 and masks[0].shape == th.Size([63, num_bins])
@@ -10,6 +10,7 @@ import torch as th
 from torch.nn.utils import clip_grad_norm_
 from aps.libs import aps_task, aps_sse_nnet
 from aps.transform import EnhTransform
+from aps.task.objf import permu_invarint_objf, sisnr_objf
 
 
 def toy_rnn(mode, num_spks):
@@ -49,6 +50,36 @@ def run_epochs(task, egs, iters):
         assert not math.isnan(norm.item())
 
 
+@pytest.mark.parametrize("num_spks", [2, 3, 4, 5])
+def test_pairwise_pit(num_spks):
+    batch_size, chunk_size = 4, 1000
+
+    def objf(out, ref):
+        return -sisnr_objf(out, ref)
+
+    ref = [th.rand(batch_size, chunk_size) for _ in range(num_spks)]
+    # references with noise in random order
+    inp = []
+    for s in th.randperm(num_spks).tolist():
+        noisy = ref[s] + th.rand(batch_size, chunk_size) * 0.5
+        inp.append(noisy.requires_grad_())
+    ref_loss, ref_permu = permu_invarint_objf(inp,
+                                              ref,
+                                              objf,
+                                              return_permutation=True,
+                                              pairwise=False)
+    for max_enum_spks in [0, 5]:
+        loss, permu = permu_invarint_objf(inp,
+                                          ref,
+                                          objf,
+                                          return_permutation=True,
+                                          max_enum_spks=max_enum_spks)
+        th.testing.assert_allclose(loss, ref_loss)
+        assert th.all(permu == ref_permu)
+    loss.mean().backward()
+    assert all(i.grad is not None for i in inp)
+
+
 @pytest.mark.parametrize("num_branch,num_spks,permute", [
     pytest.param(2, 2, True),
     pytest.param(2, 2, False),
@@ -11,6 +11,7 @@ import torch as th
 from aps.transform.utils import forward_stft, inverse_stft, STFT, iSTFT
 from aps.transform.streaming import StreamingSTFT, StreamingiSTFT
 from aps.transform.asr import SpeedPerturbTransform
+from aps.transform.augment import perturb_speed, perturb_speed_batch
 from aps.transform import AsrTransform, EnhTransform, FixedBeamformer, DfTransform
 from aps.io import read_audio
 
@@ -65,6 +66,43 @@ def test_streaming_stft(wav, frame_len, frame_hop, window):
     th.testing.assert_allclose(wav, streaming_wav)
 
 
+@pytest.mark.parametrize("wav", [egs1_wav])
+@pytest.mark.parametrize("mode", ["librosa", "kaldi"])
+@pytest.mark.parametrize("frame_len, frame_hop", [(512, 256), (400, 160)])
+@pytest.mark.parametrize("pre_emphasis", [0, 0.97])
+@pytest.mark.parametrize("onesided", [True, False])
+def test_stft_backend(wav, mode, frame_len, frame_hop, pre_emphasis, onesided):
+    wav = th.from_numpy(wav)[None, ...]
+    cfg = {
+        "frame_len": frame_len,
+        "frame_hop": frame_hop,
+        "window": "hamm",
+        "center": True,
+        "onesided": onesided,
+        "mode": mode
+    }
+    ref_stft = STFT(**cfg, pre_emphasis=pre_emphasis, backend="conv")
+    ref_packed = ref_stft(wav)
+    # conv1d by default (deterministic)
+    th.testing.assert_close(STFT(**cfg, pre_emphasis=pre_emphasis)(wav),
+                            ref_packed,
+                            rtol=0,
+                            atol=0)
+    for backend in ref_stft.backends + ["auto"]:
+        stft = STFT(**cfg, pre_emphasis=pre_emphasis, backend=backend)
+        packed = stft(wav)
+        th.testing.assert_allclose(packed, ref_packed, atol=1e-3, rtol=1e-4)
+    if pre_emphasis > 0:
+        return
+    ref_wav = iSTFT(**cfg, backend="conv")(ref_packed)
+    th.testing.assert_close(iSTFT(**cfg)(ref_packed), ref_wav, rtol=0, atol=0)
+    for backend in ["rfft", "auto"]:
+        istft = iSTFT(**cfg, backend=backend)
+        th.testing.assert_allclose(istft(ref_packed), ref_wav)
+        # cached OLA normalizer
+        th.testing.assert_allclose(istft(ref_packed), ref_wav)
+
+
 @pytest.mark.parametrize("wav", [egs1_wav, egs2_wav[0].copy()])
 @pytest.mark.parametrize("frame_len, frame_hop", [(512, 256), (1024, 256),
                                                   (400, 160)])
@@ -132,6 +170,36 @@ def test_speed_perturb(max_length):
         assert wav_out.shape[-1] == out_len.item()
 
 
+@pytest.mark.parametrize("batch_size", [1, 8])
+@pytest.mark.parametrize("num_channels", [1, 2])
+def test_speed_perturb_batch(batch_size, num_channels):
+    speed_perturb = SpeedPerturbTransform(sr=16000)
+    shape = [batch_size, 16000
+            ] if num_channels == 1 else [batch_size, num_channels, 16000]
+    wav = th.randn(shape)
+    wav_len = th.randint(8000, 16000, (batch_size,))
+    wav_out = speed_perturb(wav)
+    out_len = speed_perturb.output_length(wav_len)
+    assert wav_out.shape[-1] == speed_perturb.output_length(
+        th.tensor([16000] * batch_size)).max().item()
+    # same as the one processed per utterance
+    for i, c in enumerate(speed_perturb.last_choice.tolist()):
+        wav_ref = wav[i].view(-1, 16000)
+        if c != len(speed_perturb.weights):
+            wav_ref = perturb_speed(wav_ref, speed_perturb.weights[c])
+        wav_ref = wav_ref.view(wav[i].shape[:-1] + (-1,))
+        L = wav_ref.shape[-1]
+        th.testing.assert_allclose(wav_out[i, ..., :L], wav_ref)
+        assert th.sum(wav_out[i, ..., L:].abs()) == 0
+        assert out_len[i] <= L
+    # grouped conv1d (used on GPU)
+    wav_grp = perturb_speed_batch(wav,
+                                  list(speed_perturb.weights),
+                                  speed_perturb.last_choice,
+                                  group=True)
+    th.testing.assert_allclose(wav_grp, wav_out)
+
+
 @pytest.mark.parametrize("wav", [egs2_wav])
 @pytest.mark.parametrize("feats,shape",
                          [("spectrogram-cmvn-aug-ipd", [1, 366, 257 * 5]),